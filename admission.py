@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""AI 呼叫的准入控制：每位用戶與全域各一組 token bucket，文字、拍照（生成圖片）與看圖（vision）分開計算。
+
+超過上限的請求立即拒絕（附上建議的等待秒數），不排隊等待，避免單一用戶洗版耗盡 provider 配額。
+上限以「每分鐘幾次」與「可瞬間連發幾次（burst）」設定，預設值見 DEFAULT_LIMITS，
+可用 ADMISSION_<工作類型>_<USER|GLOBAL>_PER_MIN / _BURST 覆寫；ADMISSION=0 時停用。
+"""
+
+import os
+import threading
+import time
+from collections import Counter, OrderedDict
+from typing import Callable, NamedTuple
+
+# 最多追蹤幾位用戶的 bucket；超過時淘汰最久沒使用的（已回滿的 bucket 淘汰後不影響結果）
+DEFAULT_MAX_USERS = 10000
+
+
+class Limit(NamedTuple):
+    """每分鐘補充的 token 數與 bucket 容量。"""
+
+    per_min: float
+    burst: float
+
+
+# 工作類型 -> (每位用戶上限, 全域上限)
+DEFAULT_LIMITS: dict[str, tuple[Limit, Limit]] = {
+    "text": (Limit(20, 5), Limit(600, 60)),
+    "image": (Limit(4, 2), Limit(30, 10)),
+    "vision": (Limit(6, 3), Limit(60, 20)),
+}
+
+
+class TokenBucket:
+    """經典 token bucket：以固定速率補充，容量為 burst。"""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, limit: Limit, now: float):
+        self.rate = limit.per_min / 60.0
+        self.capacity = max(1.0, limit.burst)
+        self.tokens = self.capacity
+        self.updated = now
+
+    def _refill(self, now: float) -> None:
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def available(self, now: float) -> float:
+        self._refill(now)
+        return self.tokens
+
+    def retry_after(self, now: float) -> float:
+        """還要等幾秒才有 1 個 token。"""
+        missing = 1.0 - self.available(now)
+        if missing <= 0:
+            return 0.0
+        return missing / self.rate if self.rate > 0 else float("inf")
+
+    def take(self) -> None:
+        self.tokens -= 1.0
+
+
+class Decision(NamedTuple):
+    """准入結果：allowed 為 False 時，scope 為擋下的範圍（user / global），retry_after 為建議等待秒數。"""
+
+    allowed: bool
+    scope: str | None = None
+    retry_after: float = 0.0
+
+
+ALLOWED = Decision(True)
+
+
+class AdmissionController:
+    """依工作類型分別管理每位用戶與全域的 token bucket（執行緒安全）。"""
+
+    def __init__(
+        self,
+        limits: dict[str, tuple[Limit, Limit]] | None = None,
+        max_users: int = DEFAULT_MAX_USERS,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.limits = dict(DEFAULT_LIMITS if limits is None else limits)
+        self.max_users = max(1, max_users)
+        self.clock = clock
+        self._lock = threading.Lock()
+        now = clock()
+        self._global = {workload: TokenBucket(limit[1], now) for workload, limit in self.limits.items()}
+        # (workload, user_id) -> bucket
+        self._users: OrderedDict[tuple[str, int], TokenBucket] = OrderedDict()
+        self.counters: Counter = Counter()
+
+    def _user_bucket(self, workload: str, user_id: int, now: float) -> TokenBucket:
+        key = (workload, user_id)
+        bucket = self._users.get(key)
+        if bucket is None:
+            bucket = TokenBucket(self.limits[workload][0], now)
+            self._users[key] = bucket
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+        else:
+            self._users.move_to_end(key)
+        return bucket
+
+    def admit(self, workload: str, user_id: int | None) -> Decision:
+        """嘗試取得一個 token；用戶與全域 bucket 都有 token 時才一起扣除。"""
+        if workload not in self.limits:
+            return ALLOWED
+        with self._lock:
+            now = self.clock()
+            global_bucket = self._global[workload]
+            user_bucket = self._user_bucket(workload, user_id, now) if user_id is not None else None
+            if user_bucket is not None and user_bucket.available(now) < 1.0:
+                self.counters[f"{workload}_rejected_user"] += 1
+                return Decision(False, "user", user_bucket.retry_after(now))
+            if global_bucket.available(now) < 1.0:
+                self.counters[f"{workload}_rejected_global"] += 1
+                return Decision(False, "global", global_bucket.retry_after(now))
+            global_bucket.take()
+            if user_bucket is not None:
+                user_bucket.take()
+            self.counters[f"{workload}_admitted"] += 1
+            return ALLOWED
+
+    def user_state(self, user_id: int) -> dict:
+        """某位用戶目前各工作類型剩餘的 token 數。"""
+        with self._lock:
+            now = self.clock()
+            state = {}
+            for workload, (user_limit, _) in self.limits.items():
+                bucket = self._users.get((workload, user_id))
+                state[workload] = bucket.available(now) if bucket is not None else float(user_limit.burst)
+            return state
+
+    def stats(self) -> dict:
+        """各工作類型全域 bucket 的剩餘 token、被追蹤的用戶數與准入 / 拒絕次數。"""
+        with self._lock:
+            now = self.clock()
+            return {
+                **self.counters,
+                "global_tokens": {workload: round(bucket.available(now), 2) for workload, bucket in self._global.items()},
+                "tracked_users": len(self._users),
+            }
+
+
+def _limit_from_env(prefix: str, default: Limit) -> Limit:
+    return Limit(
+        float(os.getenv(f"{prefix}_PER_MIN") or default.per_min),
+        float(os.getenv(f"{prefix}_BURST") or default.burst),
+    )
+
+
+def create_admission_controller() -> AdmissionController | None:
+    """依環境變數建立准入控制；ADMISSION=0 時回傳 None（停用）。"""
+    if (os.getenv("ADMISSION") or "1").strip().lower() in {"0", "false", "no", "off"}:
+        return None
+    limits = {
+        workload: (
+            _limit_from_env(f"ADMISSION_{workload.upper()}_USER", user_limit),
+            _limit_from_env(f"ADMISSION_{workload.upper()}_GLOBAL", global_limit),
+        )
+        for workload, (user_limit, global_limit) in DEFAULT_LIMITS.items()
+    }
+    return AdmissionController(limits)
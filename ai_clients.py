@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+"""AI 服務用戶端註冊表：每個 provider / 用途在整個程序只建立一次用戶端，重複使用 keep-alive 連線池。
+
+只有 API Key 改變時才會重建用戶端（模型是每次請求的參數，換模型不必換連線池），
+被取代的舊用戶端在 RETIRE_GRACE 秒後關閉，讓仍在使用它的請求先完成。
+連線池上限可用 AI_HTTP_MAX_CONNECTIONS / AI_HTTP_MAX_KEEPALIVE / AI_HTTP_KEEPALIVE_EXPIRY 調整。
+文字 / 圖片 / 圖片分析三種用途各有獨立的並行上限（AI_TEXT_CONCURRENCY / AI_IMAGE_CONCURRENCY /
+AI_VISION_CONCURRENCY），慢的圖片生成不會佔滿文字回覆的名額。
+"""
+
+import asyncio
+import logging
+import os
+import threading
+from collections import Counter
+from typing import Any, AsyncIterator, Callable
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_CONNECTIONS = 20
+DEFAULT_MAX_KEEPALIVE = 10
+DEFAULT_KEEPALIVE_EXPIRY = 60.0  # 秒
+# 用戶端被取代後，等多久再關閉（秒）
+RETIRE_GRACE = 120.0
+
+# 各用途同時進行中的 AI 請求上限
+DEFAULT_CONCURRENCY = {
+    "text": 16,
+    "image": 4,
+    "vision": 4,
+}
+
+
+def _http_limits():
+    """依環境變數建立 httpx 連線池上限。"""
+    import httpx
+
+    return httpx.Limits(
+        max_connections=int(os.getenv("AI_HTTP_MAX_CONNECTIONS") or DEFAULT_MAX_CONNECTIONS),
+        max_keepalive_connections=int(os.getenv("AI_HTTP_MAX_KEEPALIVE") or DEFAULT_MAX_KEEPALIVE),
+        keepalive_expiry=float(os.getenv("AI_HTTP_KEEPALIVE_EXPIRY") or DEFAULT_KEEPALIVE_EXPIRY),
+    )
+
+
+async def _close_client(client: Any) -> None:
+    """關閉用戶端的連線池（httpx / AsyncOpenAI 為 aclose / close，genai.Client 為 aio.aclose）。"""
+    for owner, method in ((client, "aclose"), (getattr(client, "aio", None), "aclose"), (client, "close")):
+        close = getattr(owner, method, None) if owner is not None else None
+        if close is None:
+            continue
+        result = close()
+        if asyncio.iscoroutine(result):
+            await result
+        return
+
+
+class ClientRegistry:
+    """以名稱保存用戶端；fingerprint（API Key）改變時才重建，並在寬限時間後關閉舊的。"""
+
+    def __init__(self, retire_grace: float = RETIRE_GRACE):
+        self.retire_grace = retire_grace
+        self._lock = threading.Lock()
+        self._clients: dict[str, tuple[tuple, Any]] = {}
+        # 等待關閉的舊用戶端（保留 task 參照，避免被回收）
+        self._retiring: set[asyncio.Task] = set()
+        self.created: Counter = Counter()
+        self.reused: Counter = Counter()
+
+    def get(self, name: str, fingerprint: tuple, factory: Callable[[], Any]) -> Any:
+        """取得名稱為 name 的用戶端；不存在或 fingerprint 不同時呼叫 factory 建立。"""
+        with self._lock:
+            entry = self._clients.get(name)
+            if entry is not None and entry[0] == fingerprint:
+                self.reused[name] += 1
+                return entry[1]
+            client = factory()
+            if entry is not None:
+                logger.info("AI 用戶端 %s 的 API Key 已變更，重新建立", name)
+                self._retire(name, entry[1])
+            self._clients[name] = (fingerprint, client)
+            self.created[name] += 1
+            return client
+
+    def _retire(self, name: str, client: Any) -> None:
+        """排程在 retire_grace 秒後關閉被取代的用戶端；沒有執行中的 event loop 時交給 GC。"""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+
+        async def close_later() -> None:
+            await asyncio.sleep(self.retire_grace)
+            try:
+                await _close_client(client)
+            except Exception as e:
+                logger.debug("關閉舊的 AI 用戶端 %s 失敗: %s", name, e)
+
+        task = loop.create_task(close_later())
+        self._retiring.add(task)
+        task.add_done_callback(self._retiring.discard)
+
+    def clear(self) -> None:
+        """丟棄所有用戶端（下次使用時重建）。"""
+        with self._lock:
+            self._clients.clear()
+
+    def stats(self) -> dict:
+        """回傳每個用戶端的建立 / 重用次數與重用率。"""
+        with self._lock:
+            result = {}
+            for name in set(self.created) | set(self.reused):
+                created, reused = self.created[name], self.reused[name]
+                total = created + reused
+                result[name] = {
+                    "created": created,
+                    "reused": reused,
+                    "reuse_rate": (reused / total) if total else 0.0,
+                }
+            return result
+
+
+_registry = ClientRegistry()
+
+
+def _build_gemini_client(api_key: str):
+    from google import genai
+    from google.genai import types
+
+    limits = _http_limits()
+    try:
+        http_options = types.HttpOptions(
+            client_args={"limits": limits},
+            async_client_args={"limits": limits},
+        )
+        return genai.Client(api_key=api_key, http_options=http_options)
+    except (TypeError, ValueError):
+        # 舊版 google-genai 不支援 client_args，使用 SDK 預設連線池
+        return genai.Client(api_key=api_key)
+
+
+def _build_openai_client(api_key: str):
+    from openai import AsyncOpenAI
+
+    try:
+        from openai import DefaultAsyncHttpxClient
+
+        http_client = DefaultAsyncHttpxClient(limits=_http_limits())
+    except ImportError:
+        import httpx
+
+        http_client = httpx.AsyncClient(limits=_http_limits())
+    return AsyncOpenAI(api_key=api_key, http_client=http_client)
+
+
+def get_gemini_client(api_key: str, workload: str = "text"):
+    """取得共用的 genai.Client（workload 為 text / image / vision）。"""
+    return _registry.get(f"gemini-{workload}", (api_key,), lambda: _build_gemini_client(api_key))
+
+
+def get_openai_client(api_key: str, workload: str = "text"):
+    """取得共用的 AsyncOpenAI（workload 為 text / image / vision）。"""
+    return _registry.get(f"openai-{workload}", (api_key,), lambda: _build_openai_client(api_key))
+
+
+def get_http_client():
+    """取得共用的 httpx.AsyncClient（例如下載 DALL-E 圖片）。"""
+    import httpx
+
+    return _registry.get("http", (), lambda: httpx.AsyncClient(limits=_http_limits()))
+
+
+_semaphores: dict[str, asyncio.Semaphore] = {}
+
+
+def get_semaphore(workload: str) -> asyncio.Semaphore:
+    """取得用途（text / image / vision）專屬的並行上限 semaphore。"""
+    semaphore = _semaphores.get(workload)
+    if semaphore is None:
+        env_name = f"AI_{workload.upper()}_CONCURRENCY"
+        limit = int(os.getenv(env_name) or DEFAULT_CONCURRENCY.get(workload, 4))
+        semaphore = _semaphores.setdefault(workload, asyncio.Semaphore(max(1, limit)))
+    return semaphore
+
+
+class _StreamFailure:
+    __slots__ = ("error",)
+
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+_STREAM_END = object()
+
+
+async def stream_outside_semaphore(workload: str, produce: Callable[[], AsyncIterator[str]]) -> AsyncIterator[str]:
+    """
+    在持有 workload semaphore 的背景 task 中讀完 provider 串流、放進 queue，呼叫端在 semaphore 外消費。
+    呼叫端每段之間要等 Telegram 送出 / 編輯訊息，不應讓這段時間佔住 provider 的並行名額；
+    provider 串流結束（或失敗）時名額立即釋放。呼叫端提前停止讀取時取消背景 task。
+    """
+    queue: asyncio.Queue = asyncio.Queue()
+
+    async def pump() -> None:
+        try:
+            async with get_semaphore(workload):
+                async for item in produce():
+                    queue.put_nowait(item)
+        except Exception as e:
+            queue.put_nowait(_StreamFailure(e))
+        else:
+            queue.put_nowait(_STREAM_END)
+
+    task = asyncio.create_task(pump())
+    try:
+        while True:
+            item = await queue.get()
+            if item is _STREAM_END:
+                return
+            if isinstance(item, _StreamFailure):
+                raise item.error
+            yield item
+    finally:
+        if not task.done():
+            task.cancel()
+
+
+def client_stats() -> dict:
+    """回傳各用戶端的重用統計。"""
+    return _registry.stats()
@@ -4,11 +4,25 @@
 import asyncio
 import os
 import logging
-from io import BytesIO
-import json
-from pathlib import Path
 from typing import Optional
 
+import ai_clients
+import user_store
+from circuit_breaker import CircuitOpenError, guarded, provider_round_trip
+from image_cache import ImageCache, get_image_cache, prompt_key
+from image_pipeline import get_image_pipeline
+from image_pregen import (
+    PregenScheduler,
+    create_scheduler,
+    pregen_enabled,
+    record_trigger,
+    release_provider_call,
+    reserve_provider_call,
+)
+from keyword_matcher import ReloadableKeywordMatcher
+from metrics import STAGE_SECONDS, provider_call
+from singleflight import SingleFlight
+
 logger = logging.getLogger(__name__)
 
 # 生成圖片時的人物一致性與風格（每張圖都套用）
@@ -64,131 +78,135 @@ IMAGE_TRIGGER_KEYWORDS = frozenset({
     "謝謝", "辛苦了", "加油", "掰掰", "再見",
 })
 
+_trigger_matcher: ReloadableKeywordMatcher | None = None
+
+
+def get_trigger_matcher() -> ReloadableKeywordMatcher:
+    """
+    取得觸發關鍵字的自動機（第一次呼叫時編譯）。
+    設定 IMAGE_TRIGGER_KEYWORDS_FILE（每行一個關鍵字）時改用該檔案，檔案修改後自動重新載入。
+    """
+    global _trigger_matcher
+    if _trigger_matcher is None:
+        path = (os.getenv("IMAGE_TRIGGER_KEYWORDS_FILE") or "").strip() or None
+        _trigger_matcher = ReloadableKeywordMatcher(IMAGE_TRIGGER_KEYWORDS, path)
+    return _trigger_matcher
+
+
 def get_trigger_keyword(message: str) -> str | None:
     """
     若訊息包含任一觸發關鍵字，回傳該關鍵字（用於觸發拍照）；否則回傳 None。
-    先完全符合，再依關鍵字長度由長到短匹配「包含」。
+    一次掃描找出最長的命中關鍵字（完全符合自然是最長的），長度相同時取最先出現者。
     """
     if not message or not message.strip():
         return None
-    text = message.strip()
-    if text in IMAGE_TRIGGER_KEYWORDS:
-        return text
-    for keyword in sorted(IMAGE_TRIGGER_KEYWORDS, key=len, reverse=True):
-        if keyword in text:
-            return keyword
-    return None
+    return get_trigger_matcher().longest_match(message.strip())
 
 
-def _load_user_config(user_id: int) -> dict:
-    """從 users_config.json 讀取特定用戶配置。"""
-    config_file = Path(__file__).parent / "users_config.json"
-    default_config = {
-        "girlfriend_type": None,
-        "user_name": None,
-    }
-    
-    if not config_file.exists():
-        return default_config
-    
-    try:
-        with open(config_file, encoding="utf-8") as f:
-            all_configs = json.load(f)
-        return all_configs.get(str(user_id), default_config)
-    except Exception as e:
-        logger.warning(f"讀取用戶配置失敗: {e}")
-        return default_config
-
-def _get_image_gen_prompt(user_id: int = None, keyword: str = "") -> str:
-    """根據用戶 ID 和女友類型生成圖片生成提示。強調自拍感、台灣年輕女性、黑色長直髮、人物一致。"""
-    base_no_user = (
-        f"{IMAGE_CHARACTER_TRAITS} "
-        "一個台灣年輕女性，黑色長直髮，第一人稱自拍角度，臉部特寫"
-    )
+async def _load_user_config(user_id: int) -> dict:
+    """讀取特定用戶配置（由 user_store 記憶體快取回應；在執行緒中查詢，不阻塞 event loop）。"""
+    return await user_store.aload_user_config(user_id)
+
+# 沒有 user_id（不知道女友類型）時使用的圖片提示
+IMAGE_PROMPT_NO_USER = (
+    f"{IMAGE_CHARACTER_TRAITS} "
+    "一個台灣年輕女性，黑色長直髮，第一人稱自拍角度，臉部特寫"
+)
+
+
+async def _get_image_persona(user_id: int = None) -> str | None:
+    """回傳用戶的女友類型（未設定時為 highschool）；沒有 user_id 時回傳 None。"""
     if not user_id:
-        return base_no_user + (f"，情境或背景：{keyword}" if keyword else "")
+        return None
     
-    user_config = _load_user_config(user_id)
+    user_config = await _load_user_config(user_id)
     girlfriend_type = user_config.get("girlfriend_type", "highschool")
     
     if girlfriend_type not in GIRLFRIEND_PERSONALITIES:
         girlfriend_type = "highschool"
+    return girlfriend_type
+
+
+def _render_image_prompt(persona: str | None, keyword: str = "") -> str:
+    """以女友類型與關鍵字組出圖片生成提示。強調自拍感、台灣年輕女性、黑色長直髮、人物一致。"""
+    if persona is None:
+        return IMAGE_PROMPT_NO_USER + (f"，情境或背景：{keyword}" if keyword else "")
     
-    personality = GIRLFRIEND_PERSONALITIES[girlfriend_type]
-    prompt_prefix = personality.get("prompt_prefix", base_no_user)
+    personality = GIRLFRIEND_PERSONALITIES[persona]
+    prompt_prefix = personality.get("prompt_prefix", IMAGE_PROMPT_NO_USER)
     
     if keyword:
         return f"{prompt_prefix}，情境或背景：{keyword}"
     return prompt_prefix
 
+
 # ---------- Gemini Image Generation ----------
 # 圖片生成需使用支援 image generation 的模型，並設定 response_modalities
 GEMINI_IMAGE_DEFAULT_MODEL = "gemini-2.0-flash-exp-image-generation"  # 實驗性圖片生成
 
-def _gemini_generate_image_sync(
+def _extract_gemini_image(response) -> bytes | None:
+    """從 Gemini 回應取出原始圖片 bytes（不解碼，格式轉換交給 image_pipeline）。"""
+    image_bytes = None
+    parts = getattr(response, "parts", None) or []
+    if not parts and getattr(response, "candidates", None):
+        c0 = response.candidates[0]
+        if getattr(c0, "content", None) and getattr(c0.content, "parts", None):
+            parts = c0.content.parts
+    
+    for part in parts:
+        if getattr(part, "inline_data", None) is not None:
+            data = getattr(part.inline_data, "data", None)
+            if data:
+                image_bytes = data if isinstance(data, bytes) else data
+                break
+        if getattr(part, "as_image", None) is not None:
+            try:
+                img = part.as_image()
+                # google.genai 的 Image 已帶有編碼好的 bytes，不需經過 PIL 重新編碼
+                data = getattr(img, "image_bytes", None) if img is not None else None
+                if data:
+                    image_bytes = data
+                    break
+            except Exception:
+                pass
+    
+    if not image_bytes:
+        return None
+    logger.info(f"Gemini 圖片生成成功，圖片大小: {len(image_bytes)} bytes")
+    return image_bytes
+
+
+async def _gemini_generate_image(
     prompt: str,
 ) -> bytes | None:
-    """同步呼叫 Gemini Image Generation API 生成圖片。"""
-    from google import genai
+    """
+    非同步呼叫 Gemini Image Generation API 生成圖片（受圖片並行上限限制），回傳原始圖片 bytes。
+    provider 的例外照常拋出，由斷路器記錄、_generate_image 處理。
+    """
     from google.genai import types
 
     api_key = (os.getenv("GEMINI_API_KEY") or "").strip()
     if not api_key:
         return None
 
-    client = genai.Client(api_key=api_key)
     model = (os.getenv("GEMINI_IMAGE_MODEL") or "").strip() or GEMINI_IMAGE_DEFAULT_MODEL
+    client = ai_clients.get_gemini_client(api_key, workload="image")
 
-    try:
-        # 圖片生成必須設定 response_modalities=["TEXT", "IMAGE"]（API 規定須含 TEXT）
-        response = client.models.generate_content(
-            model=model,
-            contents=[prompt],
-            config=types.GenerateContentConfig(
-                response_modalities=["TEXT", "IMAGE"],
-            ),
-        )
-        
-        image_bytes = None
-        parts = getattr(response, "parts", None) or []
-        if not parts and getattr(response, "candidates", None):
-            c0 = response.candidates[0]
-            if getattr(c0, "content", None) and getattr(c0.content, "parts", None):
-                parts = c0.content.parts
-        
-        for part in parts:
-            if getattr(part, "inline_data", None) is not None:
-                data = getattr(part.inline_data, "data", None)
-                if data:
-                    image_bytes = data if isinstance(data, bytes) else data
-                    break
-            if getattr(part, "as_image", None) is not None:
-                try:
-                    img = part.as_image()
-                    if img is not None:
-                        output = BytesIO()
-                        img.save(output, format="PNG")
-                        image_bytes = output.getvalue()
-                        break
-                except Exception:
-                    pass
-        
-        if image_bytes:
-            from PIL import Image
-            logger.info(f"Gemini 圖片生成成功，圖片大小: {len(image_bytes)} bytes")
-            img = Image.open(BytesIO(image_bytes))
-            output_buffer = BytesIO()
-            img.save(output_buffer, format="JPEG")
-            return output_buffer.getvalue()
-            
+    # 圖片生成必須設定 response_modalities=["TEXT", "IMAGE"]（API 規定須含 TEXT）
+    async with ai_clients.get_semaphore("image"):
+        with provider_call("gemini", model, "image"), provider_round_trip():
+            response = await client.aio.models.generate_content(
+                model=model,
+                contents=[prompt],
+                config=types.GenerateContentConfig(
+                    response_modalities=["TEXT", "IMAGE"],
+                ),
+            )
+
+    image_bytes = _extract_gemini_image(response)
+    if not image_bytes:
         logger.warning("Gemini API 回應沒有圖片資料。response 結構: %s", type(response).__name__)
-        return None
-    except ImportError as e:
-        logger.warning("google-genai 未安裝或缺少 types: %s", e)
-        return None
-    except Exception as e:
-        logger.error(f"Gemini 圖片生成失敗: {e}", exc_info=True)
-        return None
+    return image_bytes
      
 # ---------- OpenAI DALL-E ----------
 OPENAI_DALLE_DEFAULT_MODEL = "dall-e-3" 
@@ -197,42 +215,137 @@ async def _openai_dalle_generate_image(
     prompt: str,
     user_id: int = None,
 ) -> str | None:
-    """非同步呼叫 OpenAI DALL-E API 生成圖片。"""
+    """非同步呼叫 OpenAI DALL-E API 生成圖片，回傳圖片 URL；provider 的例外照常拋出。"""
     api_key = (os.getenv("OPENAI_API_KEY") or "").strip()
     if not api_key:
         return None
 
-    from openai import AsyncOpenAI
-
-    client = AsyncOpenAI(api_key=api_key)
     model = (os.getenv("OPENAI_DALLE_MODEL") or "").strip() or OPENAI_DALLE_DEFAULT_MODEL
+    client = ai_clients.get_openai_client(api_key, workload="image")
 
-    try:
-        response = await client.images.generate(
-            model=model,
-            prompt=prompt,
-            size="1024x1024",
-            quality="standard",
-            n=1,
-        )
-        image_url = response.data[0].url
-        return image_url
-    except Exception as e:
-        logger.error(f"OpenAI DALL-E 圖片生成失敗: {e}", exc_info=True)
-        return None
+    async with ai_clients.get_semaphore("image"):
+        with provider_call("openai", model, "image"), provider_round_trip():
+            response = await client.images.generate(
+                model=model,
+                prompt=prompt,
+                size="1024x1024",
+                quality="standard",
+                n=1,
+            )
+    return response.data[0].url
 
 # ---------- 統一入口 ----------
 IMAGE_GEN_FALLBACK_MSG = "目前暫時無法生成圖片，請稍後再試。"
 
+# 正在背景補圖的 prompt key，以及對應的 task（保留強參照避免被回收）
+_filling: dict[str, asyncio.Task] = {}
+
+
+def _schedule_cache_fill(cache: ImageCache, prompt: str, user_id: int = None) -> None:
+    """在背景多生成一張圖存入快取（同一個 prompt 同時只補一張）。"""
+    key = prompt_key(prompt)
+    if key in _filling:
+        return
+
+    async def fill() -> None:
+        try:
+            image_bytes = await _generate_image(prompt, user_id)
+            if image_bytes:
+                await asyncio.to_thread(cache.put, prompt, image_bytes)
+        except Exception as e:
+            logger.warning("背景補充圖片快取失敗: %s", e)
+        finally:
+            _filling.pop(key, None)
+
+    _filling[key] = asyncio.create_task(fill())
+
+
+def create_pregen_scheduler() -> PregenScheduler | None:
+    """建立熱門觸發圖片的預先生成排程；IMAGE_PREGEN 未開啟或圖片快取停用時回傳 None。"""
+    cache = get_image_cache()
+    if not pregen_enabled() or cache is None:
+        return None
+    return create_scheduler(
+        cache,
+        render=_render_image_prompt,
+        # _generate_cached 會寫入快取，並與同一 prompt 的即時生成合併
+        generate=lambda prompt: _generate_cached(cache, prompt),
+        keywords=lambda: get_trigger_matcher().keywords,
+    )
+
+
+# 相同 prompt 的即時生成合併為一次（key 為 (是否寫入快取, prompt 雜湊)）
+_generation_flight = SingleFlight("image_generation")
+
+
+def generation_flight_stats() -> dict:
+    """即時生成的合併統計：leader 為實際生成次數，shared 為共用他人結果的次數。"""
+    return _generation_flight.stats()
+
+
+async def _generate_cached(
+    cache: ImageCache,
+    prompt: str,
+    user_id: int = None,
+    timeout: float | None = None,
+) -> bytes | None:
+    """生成圖片並存入快取；相同 prompt 同時只會生成一張，其他請求共用結果。"""
+
+    async def work() -> bytes | None:
+        image_bytes = await _generate_image(prompt, user_id)
+        if image_bytes:
+            try:
+                await asyncio.to_thread(cache.put, prompt, image_bytes)
+            except Exception as e:
+                logger.warning("寫入圖片快取失敗: %s", e)
+        return image_bytes
+
+    return await _generation_flight.do((True, prompt_key(prompt)), work, timeout)
+
+
 async def generate_image_by_keyword(
     keyword: str,
     user_id: int = None,
+    use_cache: bool = True,
+    timeout: float | None = None,
 ) -> bytes | None: # 回傳 bytes 方便 Telegram send_photo
     """
     根據關鍵字生成圖片。
-    優先使用 Gemini，未設定或失敗時退回 OpenAI DALL-E。
+    use_cache 時先查圖片快取（以完整 prompt 為 key）：命中就直接回傳，variant 未存滿則在背景補圖；
+    未命中才即時生成並存入快取。相同 prompt 同時間的請求共用同一次生成。
+    timeout 只限制這次呼叫的等待時間（逾時拋出 asyncio.TimeoutError），共用的生成會繼續完成並寫入快取。
+    """
+    persona = await _get_image_persona(user_id)
+    with STAGE_SECONDS.time("prompt_render"):
+        prompt = _render_image_prompt(persona, keyword)
+    cache = get_image_cache() if use_cache else None
+    if cache is None:
+        return await _generation_flight.do(
+            (False, prompt_key(prompt)), lambda: _generate_image(prompt, user_id), timeout
+        )
+
+    # 記錄熱門的 (女友類型, 關鍵字)，供背景預先生成參考；
+    # 未開啟預先生成時不記錄（第一次取統計會同步讀檔，不應在 event loop 上發生）
+    if pregen_enabled():
+        record_trigger(persona, keyword)
+
+    image_bytes = await asyncio.to_thread(cache.get, prompt)
+    if image_bytes:
+        logger.info("圖片快取命中，關鍵字: %s", keyword)
+        if cache.needs_fill(prompt):
+            _schedule_cache_fill(cache, prompt, user_id)
+        return image_bytes
+
+    return await _generate_cached(cache, prompt, user_id, timeout)
+
+
+async def _generate_image(prompt: str, user_id: int = None) -> bytes | None:
+    """
+    實際呼叫 provider 生成圖片。
+    優先使用 Gemini，未設定、失敗或斷路器為 open 時退回 OpenAI DALL-E；
+    兩者的斷路器都為 open 時立即回傳 None（快取命中的請求不受影響）。
+    由預先生成發起時，每次呼叫 provider 前扣一次每日預算，預算用完就不再呼叫。
     """
-    prompt = _get_image_gen_prompt(user_id, keyword)
     image_provider = (os.getenv("AI_IMAGE_PROVIDER") or "").strip().lower()
     
     gemini_key = (os.getenv("GEMINI_API_KEY") or "").strip()
@@ -247,13 +360,20 @@ async def generate_image_by_keyword(
     # 優先使用 Gemini
     if gemini_key and (not image_provider or image_provider == "gemini"):
         logger.info(f"嘗試使用 Gemini 生成圖片，prompt: {prompt}")
+        if not reserve_provider_call():
+            logger.info("預先生成的每日預算已用完，略過")
+            return None
         try:
-            # Gemini 是同步 API，在 async context 中需用 to_thread 運行
-            image_bytes = await asyncio.to_thread(_gemini_generate_image_sync, prompt)
+            image_bytes = await guarded("gemini:image", lambda: _gemini_generate_image(prompt))
             if image_bytes:
-                return image_bytes
+                # 編碼在斷路器之外：本地 CPU 忙碌不算 provider 慢
+                return await get_image_pipeline().encode_photo(image_bytes)
             logger.warning("Gemini 圖片生成未回傳有效圖片。")
+        except CircuitOpenError:
+            release_provider_call()
+            logger.info("Gemini 圖片生成斷路器為 open，略過")
         except ImportError:
+            release_provider_call()
             logger.warning("google-genai 套件未安裝，略過 Gemini 圖片生成")
         except Exception as e:
             logger.warning("Gemini 圖片生成錯誤: %s", e, exc_info=True)
@@ -261,23 +381,26 @@ async def generate_image_by_keyword(
     # 退回使用 OpenAI DALL-E
     if openai_key and (not image_provider or image_provider == "openai"):
         logger.info(f"嘗試使用 DALL-E 生成圖片，prompt: {prompt}")
+        if not reserve_provider_call():
+            logger.info("預先生成的每日預算已用完，略過")
+            return None
         try:
-            image_url = await _openai_dalle_generate_image(prompt, user_id)
+            image_url = await guarded("openai:image", lambda: _openai_dalle_generate_image(prompt, user_id))
             if image_url:
-                # DALL-E 回傳 URL，需要下載轉換為 bytes
-                import httpx
-                async with httpx.AsyncClient() as client:
+                # DALL-E 回傳 URL，需要下載轉換為 bytes（共用連線池）
+                client = ai_clients.get_http_client()
+                with STAGE_SECONDS.time("image_download"):
                     response = await client.get(image_url)
-                    response.raise_for_status() # 檢查 HTTP 錯誤
-                    image_bytes = response.content
-                    logger.info(f"DALL-E 圖片下載成功，大小: {len(image_bytes)} bytes")
-                    from PIL import Image
-                    img = Image.open(BytesIO(image_bytes))
-                    output_buffer = BytesIO()
-                    img.save(output_buffer, format="JPEG")
-                    return output_buffer.getvalue()
+                response.raise_for_status() # 檢查 HTTP 錯誤
+                image_bytes = response.content
+                logger.info(f"DALL-E 圖片下載成功，大小: {len(image_bytes)} bytes")
+                return await get_image_pipeline().encode_photo(image_bytes)
             logger.warning("DALL-E 圖片生成未回傳有效圖片 URL。")
+        except CircuitOpenError:
+            release_provider_call()
+            logger.info("DALL-E 斷路器為 open，略過")
         except ImportError:
+            release_provider_call()
             logger.warning("openai 套件未安裝，略過 DALL-E 圖片生成")
         except Exception as e:
             logger.warning("OpenAI DALL-E 圖片生成錯誤: %s", e, exc_info=True)
@@ -1,11 +1,17 @@
 #!/usr/bin/env python3
 """使用 AI（Gemini / OpenAI）產生回覆。未設定 API Key 或錯誤時回傳 None，由邏輯層 fallback。"""
 
-import asyncio
 import os
 import logging
-import json
-from pathlib import Path
+from typing import AsyncIterator
+
+import ai_clients
+import user_store
+from gemini_context_cache import get_context_cache
+from circuit_breaker import CircuitOpenError, guarded, guarded_stream, is_open, provider_round_trip
+from hedging import get_hedger, hedging_enabled
+from metrics import provider_call
+from prompt_cache import create_prompt_cache
 
 logger = logging.getLogger(__name__)
 
@@ -56,62 +62,39 @@ GIRLFRIEND_PERSONALITIES = {
 }
 
 
-def _load_user_config(user_id: int) -> dict:
-    """從 users_config.json 讀取特定用戶配置。"""
-    config_file = Path(__file__).parent / "users_config.json"
-    default_config = {
-        "girlfriend_type": None,
-        "user_name": None,
-    }
-    
-    if not config_file.exists():
-        return default_config
-    
-    try:
-        with open(config_file, encoding="utf-8") as f:
-            all_configs = json.load(f)
-        return all_configs.get(str(user_id), default_config)
-    except Exception as e:
-        logger.warning(f"讀取用戶配置失敗: {e}")
-        return default_config
+async def _load_user_config(user_id: int) -> dict:
+    """讀取特定用戶配置（由 user_store 記憶體快取回應；在執行緒中查詢，不阻塞 event loop）。"""
+    return await user_store.aload_user_config(user_id)
 
 
 def save_user_config(user_id: int, config: dict) -> bool:
     """保存用戶配置到 users_config.json。"""
-    config_file = Path(__file__).parent / "users_config.json"
-    
-    try:
-        all_configs = {}
-        if config_file.exists():
-            with open(config_file, encoding="utf-8") as f:
-                all_configs = json.load(f)
-        
-        all_configs[str(user_id)] = config
-        
-        with open(config_file, "w", encoding="utf-8") as f:
-            json.dump(all_configs, f, ensure_ascii=False, indent=2)
-        return True
-    except Exception as e:
-        logger.error(f"保存用戶配置失敗: {e}")
-        return False
-
-
-def _get_system_prompt(user_id: int = None) -> str:
-    """根據用戶 ID 和女友類型生成系統提示。"""
-    custom_prompt = (os.getenv("AI_SYSTEM_PROMPT") or "").strip()
-    if custom_prompt:
-        return custom_prompt
-    
+    return user_store.save_user_config(user_id, config)
+
+
+_prompt_cache = create_prompt_cache("ai_reply")
+
+
+def _render_system_prompt(girlfriend_type: str, girlfriend_name: str, user_name: str) -> str:
+    """以女友類型的模板產生系統提示（結果由 _prompt_cache 快取）。"""
+    return _prompt_cache.get(
+        (girlfriend_type, girlfriend_name, user_name),
+        lambda: GIRLFRIEND_PERSONALITIES[girlfriend_type]["prompt"].format(
+            girlfriend_name=girlfriend_name,
+            user_name=user_name
+        ),
+    )
+
+
+async def _get_persona(user_id: int = None) -> tuple[str, str, str]:
+    """根據用戶 ID 取得 (女友類型, 女友名字, 用戶名字)。"""
     if not user_id:
         # 沒有 user_id，使用預設
         girlfriend_name = (os.getenv("GIRLFRIEND_NAME") or "寶貝").strip()
-        return GIRLFRIEND_PERSONALITIES["highschool"]["prompt"].format(
-            girlfriend_name=girlfriend_name,
-            user_name="親愛的"
-        )
+        return "highschool", girlfriend_name, "親愛的"
     
     # 讀取用戶配置
-    user_config = _load_user_config(user_id)
+    user_config = await _load_user_config(user_id)
     girlfriend_type = user_config.get("girlfriend_type", "highschool")
     user_name = user_config.get("user_name", "親愛的")
     girlfriend_name = user_config.get("girlfriend_name", "寶貝")
@@ -120,11 +103,20 @@ def _get_system_prompt(user_id: int = None) -> str:
     if girlfriend_type not in GIRLFRIEND_PERSONALITIES:
         girlfriend_type = "highschool"
     
-    personality = GIRLFRIEND_PERSONALITIES[girlfriend_type]
-    return personality["prompt"].format(
-        girlfriend_name=girlfriend_name,
-        user_name=user_name
-    )
+    return girlfriend_type, girlfriend_name, user_name
+
+
+async def _get_system_prompt(user_id: int = None) -> str:
+    """根據用戶 ID 和女友類型生成系統提示。"""
+    custom_prompt = (os.getenv("AI_SYSTEM_PROMPT") or "").strip()
+    if custom_prompt:
+        return custom_prompt
+    return _render_system_prompt(*await _get_persona(user_id))
+
+
+# context cache 中的人設模板以佔位文字代替名字，同一女友類型的所有用戶共用一份 cache
+_GIRLFRIEND_NAME_PLACEHOLDER = "〔你的名字〕"
+_USER_NAME_PLACEHOLDER = "〔男朋友的名字〕"
 
 
 # ---------- Gemini ----------
@@ -132,26 +124,80 @@ def _get_system_prompt(user_id: int = None) -> str:
 GEMINI_DEFAULT_MODEL = "gemini-2.0-flash"
 
 
-def _gemini_reply_sync(user_message: str, user_id: int = None) -> str | None:
-    """同步呼叫 Gemini API（會在 async 裡用 to_thread 執行）。"""
-    from google import genai
-
+async def _gemini_reply(user_message: str, user_id: int = None) -> str | None:
+    """非同步呼叫 Gemini API（使用 SDK 的 aio 介面，受文字並行上限限制）。"""
     api_key = (os.getenv("GEMINI_API_KEY") or "").strip()
     if not api_key:
         return None
 
-    client = genai.Client(api_key=api_key)
     model = (os.getenv("GEMINI_MODEL") or "").strip() or GEMINI_DEFAULT_MODEL
-    # 將系統提示與使用者訊息一併傳入（Gemini generate_content 可用 contents 多段）
-    full_prompt = f"{_get_system_prompt(user_id)}\n\n使用者：{user_message}"
-    response = client.models.generate_content(
-        model=model,
-        contents=full_prompt,
-    )
+    client = ai_clients.get_gemini_client(api_key, workload="text")
+    config, contents = await _gemini_request(model, user_message, user_id)
+    async with ai_clients.get_semaphore("text"):
+        with provider_call("gemini", model, "text"), provider_round_trip():
+            response = await client.aio.models.generate_content(
+                model=model,
+                contents=contents,
+                config=config,
+            )
     text = getattr(response, "text", None) or ""
     return (text or "").strip() or None
 
 
+async def _gemini_reply_stream(user_message: str, user_id: int = None) -> AsyncIterator[str]:
+    """以串流方式呼叫 Gemini API，逐段產出文字。"""
+    api_key = (os.getenv("GEMINI_API_KEY") or "").strip()
+    if not api_key:
+        return
+
+    model = (os.getenv("GEMINI_MODEL") or "").strip() or GEMINI_DEFAULT_MODEL
+    client = ai_clients.get_gemini_client(api_key, workload="text")
+    config, contents = await _gemini_request(model, user_message, user_id)
+
+    async def produce() -> AsyncIterator[str]:
+        with provider_call("gemini", model, "text_stream"), provider_round_trip():
+            stream = await client.aio.models.generate_content_stream(
+                model=model,
+                contents=contents,
+                config=config,
+            )
+            async for chunk in stream:
+                text = getattr(chunk, "text", None)
+                if text:
+                    yield text
+
+    # 只有讀 provider 串流時佔用文字並行名額，等 Telegram 送出 / 編輯訊息時不佔用
+    async for text in ai_clients.stream_outside_semaphore("text", produce):
+        yield text
+
+
+async def _gemini_request(model: str, user_message: str, user_id: int = None):
+    """
+    回傳 (config, contents)。一般情況下是代入名字的 system_instruction 與使用者訊息。
+    只有在 context cache 真的可用時（模板長度達到 Gemini 的最小快取 token 數，見 gemini_context_cache）
+    才改為只帶 cache 名稱：cache 的是名字換成佔位文字的人設模板，這位用戶的名字放在請求內容的第一段。
+    內建人設太短，不會走 cache，模型看到的提示與未開 cache 時相同。
+    """
+    from google.genai import types
+
+    custom_prompt = (os.getenv("AI_SYSTEM_PROMPT") or "").strip()
+    if custom_prompt:
+        shared_prompt, names = custom_prompt, None
+    else:
+        girlfriend_type, girlfriend_name, user_name = await _get_persona(user_id)
+        shared_prompt = _render_system_prompt(girlfriend_type, _GIRLFRIEND_NAME_PLACEHOLDER, _USER_NAME_PLACEHOLDER)
+        names = f"{_GIRLFRIEND_NAME_PLACEHOLDER}是「{girlfriend_name}」，{_USER_NAME_PLACEHOLDER}是「{user_name}」。"
+
+    context_cache = get_context_cache()
+    if context_cache is not None:
+        cache_name = await context_cache.get_cache_name(model, shared_prompt)
+        if cache_name:
+            contents = [names, user_message] if names else user_message
+            return types.GenerateContentConfig(cached_content=cache_name), contents
+    system_prompt = custom_prompt or _render_system_prompt(girlfriend_type, girlfriend_name, user_name)
+    return types.GenerateContentConfig(system_instruction=system_prompt), user_message
+
+
 # ---------- OpenAI ----------
 OPENAI_DEFAULT_MODEL = "gpt-4o-mini"
 
@@ -162,23 +208,57 @@ async def _openai_reply(user_message: str, user_id: int = None) -> str | None:
     if not api_key:
         return None
 
-    from openai import AsyncOpenAI
-
-    client = AsyncOpenAI(api_key=api_key)
     model = (os.getenv("OPENAI_MODEL") or "").strip() or OPENAI_DEFAULT_MODEL
-    response = await client.chat.completions.create(
-        model=model,
-        messages=[
-            {"role": "system", "content": _get_system_prompt(user_id)},
-            {"role": "user", "content": user_message},
-        ],
-        temperature=0.7,
-        max_tokens=500,
-    )
+    client = ai_clients.get_openai_client(api_key, workload="text")
+    system_prompt = await _get_system_prompt(user_id)
+    async with ai_clients.get_semaphore("text"):
+        with provider_call("openai", model, "text"), provider_round_trip():
+            response = await client.chat.completions.create(
+                model=model,
+                messages=[
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": user_message},
+                ],
+                temperature=0.7,
+                max_tokens=500,
+            )
     content = response.choices[0].message.content
     return (content or "").strip() or None
 
 
+async def _openai_reply_stream(user_message: str, user_id: int = None) -> AsyncIterator[str]:
+    """以串流方式呼叫 OpenAI Chat Completions，逐段產出文字。"""
+    api_key = (os.getenv("OPENAI_API_KEY") or "").strip()
+    if not api_key:
+        return
+
+    model = (os.getenv("OPENAI_MODEL") or "").strip() or OPENAI_DEFAULT_MODEL
+    client = ai_clients.get_openai_client(api_key, workload="text")
+    system_prompt = await _get_system_prompt(user_id)
+
+    async def produce() -> AsyncIterator[str]:
+        with provider_call("openai", model, "text_stream"), provider_round_trip():
+            stream = await client.chat.completions.create(
+                model=model,
+                messages=[
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": user_message},
+                ],
+                temperature=0.7,
+                max_tokens=500,
+                stream=True,
+            )
+            async for chunk in stream:
+                if not chunk.choices:
+                    continue
+                text = chunk.choices[0].delta.content
+                if text:
+                    yield text
+
+    async for text in ai_clients.stream_outside_semaphore("text", produce):
+        yield text
+
+
 # ---------- 統一入口 ----------
 
 # 有設 GEMINI_API_KEY 但 API 失敗時的回覆（不再用關鍵字）
@@ -188,20 +268,35 @@ GEMINI_FALLBACK_MSG = "目前暫時無法回覆，請稍後再試。"
 async def get_ai_reply(user_message: str, user_id: int = None) -> str | None:
     """
     有 GEMINI_API_KEY 時：只打 Gemini，失敗則回傳固定提示。
+    （AI_HEDGING=1 且也有 OPENAI_API_KEY 時，Gemini 太慢或失敗會同時改打 OpenAI，先到者勝出。）
     沒有時：試 OpenAI，再沒有則回傳 None（由呼叫端用關鍵字回覆）。
+    Gemini 斷路器為 open 時視同沒有 Gemini：直接試 OpenAI，再不行由呼叫端用關鍵字回覆。
     """
     if not (user_message or (user_message and user_message.strip())):
         return None
 
     gemini_key = (os.getenv("GEMINI_API_KEY") or "").strip()
+    openai_key = (os.getenv("OPENAI_API_KEY") or "").strip()
+    message = user_message.strip()
+
+    if gemini_key and openai_key and hedging_enabled():
+        reply = await get_hedger("text").run(
+            lambda: guarded("gemini:text", lambda: _gemini_reply(message, user_id)),
+            lambda: guarded("openai:text", lambda: _openai_reply(message, user_id)),
+        )
+        if reply:
+            return reply
+        return None if is_open("gemini:text") else GEMINI_FALLBACK_MSG
 
     # 有設 Gemini → 直接打 Gemini，不試 OpenAI、不退回關鍵字
     if gemini_key:
         try:
-            reply = await asyncio.to_thread(_gemini_reply_sync, user_message.strip(), user_id)
+            reply = await guarded("gemini:text", lambda: _gemini_reply(message, user_id))
             if reply:
                 return reply
             return GEMINI_FALLBACK_MSG
+        except CircuitOpenError:
+            logger.info("Gemini 斷路器為 open，改用 OpenAI / 關鍵字回覆")
         except ImportError:
             logger.warning("google-genai 未安裝，請執行 pip install google-genai")
             return GEMINI_FALLBACK_MSG
@@ -209,14 +304,60 @@ async def get_ai_reply(user_message: str, user_id: int = None) -> str | None:
             logger.warning("Gemini API 錯誤: %s", e, exc_info=True)
             return GEMINI_FALLBACK_MSG
 
-    # 未設 Gemini：試 OpenAI
-    openai_key = (os.getenv("OPENAI_API_KEY") or "").strip()
+    # 未設 Gemini（或斷路器為 open）：試 OpenAI
     if openai_key:
         try:
-            return await _openai_reply(user_message, user_id)
+            return await guarded("openai:text", lambda: _openai_reply(user_message, user_id))
+        except CircuitOpenError:
+            logger.info("OpenAI 斷路器為 open，改用關鍵字回覆")
         except ImportError:
             logger.debug("openai 套件未安裝，略過 OpenAI")
         except Exception as e:
             logger.warning("OpenAI API 錯誤，改用關鍵字回覆: %s", e)
 
     return None
+
+
+async def get_ai_reply_stream(user_message: str, user_id: int = None) -> AsyncIterator[str]:
+    """
+    get_ai_reply 的串流版本，逐段產出回覆文字；provider 選擇與錯誤處理規則相同：
+    有 GEMINI_API_KEY 時只打 Gemini，尚未產出任何文字就失敗則產出固定提示。
+    沒有時（或 Gemini 斷路器為 open）試 OpenAI；完全沒有產出代表沒有 AI 可用（由呼叫端用關鍵字回覆）。
+    """
+    if not (user_message and user_message.strip()):
+        return
+
+    gemini_key = (os.getenv("GEMINI_API_KEY") or "").strip()
+
+    if gemini_key:
+        produced = False
+        circuit_open = False
+        message = user_message.strip()
+        try:
+            async for text in guarded_stream("gemini:text", lambda: _gemini_reply_stream(message, user_id)):
+                produced = True
+                yield text
+        except CircuitOpenError:
+            circuit_open = True
+            logger.info("Gemini 斷路器為 open，改用 OpenAI / 關鍵字回覆")
+        except ImportError:
+            logger.warning("google-genai 未安裝，請執行 pip install google-genai")
+        except Exception as e:
+            logger.warning("Gemini API 串流錯誤: %s", e, exc_info=True)
+        if produced:
+            return
+        if not circuit_open:
+            yield GEMINI_FALLBACK_MSG
+            return
+
+    openai_key = (os.getenv("OPENAI_API_KEY") or "").strip()
+    if openai_key:
+        try:
+            async for text in guarded_stream("openai:text", lambda: _openai_reply_stream(user_message, user_id)):
+                yield text
+        except CircuitOpenError:
+            logger.info("OpenAI 斷路器為 open，改用關鍵字回覆")
+        except ImportError:
+            logger.debug("openai 套件未安裝，略過 OpenAI")
+        except Exception as e:
+            logger.warning("OpenAI API 串流錯誤: %s", e)
@@ -1,13 +1,21 @@
 #!/usr/bin/env python3
 """使用 AI（Gemini / OpenAI）分析圖片並產生回覆。未設定 API Key 或錯誤時回傳 None，由邏輯層 fallback。"""
 
-import asyncio
+import base64
 import os
 import logging
-import json
-from pathlib import Path
+import re
+from collections import Counter
 from typing import Optional
 
+import ai_clients
+import ai_reply
+import user_store
+from circuit_breaker import CircuitOpenError, guarded, provider_round_trip
+from metrics import provider_call
+from prompt_cache import create_prompt_cache
+from vision_cache import get_vision_cache
+
 logger = logging.getLogger(__name__)
 
 # 三種女友個性定義 (與 ai_reply.py 保持一致)
@@ -26,84 +34,122 @@ GIRLFRIEND_PERSONALITIES = {
     }
 }
 
-def _load_user_config(user_id: int) -> dict:
-    """從 users_config.json 讀取特定用戶配置。"""
-    config_file = Path(__file__).parent / "users_config.json"
-    default_config = {
-        "girlfriend_type": None,
-        "user_name": None,
-    }
-    
-    if not config_file.exists():
-        return default_config
-    
-    try:
-        with open(config_file, encoding="utf-8") as f:
-            all_configs = json.load(f)
-        return all_configs.get(str(user_id), default_config)
-    except Exception as e:
-        logger.warning(f"讀取用戶配置失敗: {e}")
-        return default_config
-
-def _get_system_prompt(user_id: int = None) -> str:
+async def _load_user_config(user_id: int) -> dict:
+    """讀取特定用戶配置（由 user_store 記憶體快取回應；在執行緒中查詢，不阻塞 event loop）。"""
+    return await user_store.aload_user_config(user_id)
+
+_prompt_cache = create_prompt_cache("ai_reply_image")
+
+# 實際送往各 provider 的圖片 bytes（OpenAI 為 base64 後的長度）與請求數
+_upstream: Counter = Counter()
+
+
+def _render_system_prompt(girlfriend_type: str, girlfriend_name: str, user_name: str) -> str:
+    """以女友類型的模板產生系統提示（結果由 _prompt_cache 快取）。"""
+    return _prompt_cache.get(
+        (girlfriend_type, girlfriend_name, user_name),
+        lambda: GIRLFRIEND_PERSONALITIES[girlfriend_type]["prompt"].format(
+            girlfriend_name=girlfriend_name,
+            user_name=user_name
+        ),
+    )
+
+
+async def _get_system_prompt(user_id: int = None) -> str:
     """根據用戶 ID 和女友類型生成系統提示。"""
     custom_prompt = (os.getenv("AI_SYSTEM_PROMPT") or "").strip()
     if custom_prompt:
         return custom_prompt
     
     if not user_id:
+        # 沒有 user_id，使用預設
         girlfriend_name = (os.getenv("GIRLFRIEND_NAME") or "寶貝").strip()
-        return GIRLFRIEND_PERSONALITIES["highschool"]["prompt"].format(
-            girlfriend_name=girlfriend_name,
-            user_name="親愛的"
-        )
+        return _render_system_prompt("highschool", girlfriend_name, "親愛的")
     
-    user_config = _load_user_config(user_id)
+    # 讀取用戶配置
+    user_config = await _load_user_config(user_id)
     girlfriend_type = user_config.get("girlfriend_type", "highschool")
     user_name = user_config.get("user_name", "親愛的")
     girlfriend_name = user_config.get("girlfriend_name", "寶貝")
     
+    # 如果用戶還沒選擇女友類型，使用預設
     if girlfriend_type not in GIRLFRIEND_PERSONALITIES:
         girlfriend_type = "highschool"
     
-    personality = GIRLFRIEND_PERSONALITIES[girlfriend_type]
-    return personality["prompt"].format(
-        girlfriend_name=girlfriend_name,
-        user_name=user_name
+    return _render_system_prompt(girlfriend_type, girlfriend_name, user_name)
+
+
+async def _get_persona(user_id: int = None) -> str:
+    """看圖描述快取的人設 key：女友類型（自訂系統提示時為 custom）。"""
+    if (os.getenv("AI_SYSTEM_PROMPT") or "").strip():
+        return "custom"
+    if not user_id:
+        return "highschool"
+    girlfriend_type = (await _load_user_config(user_id)).get("girlfriend_type", "highschool")
+    return girlfriend_type if girlfriend_type in GIRLFRIEND_PERSONALITIES else "highschool"
+
+
+# vision 回覆分成「描述」與「回覆」兩段：描述存進 vision_cache，近似圖只需重新產生回覆
+_SPLIT_PATTERN = re.compile(r"描述\W{0,4}?[:：](.+?)回覆\W{0,4}?[:：](.+)", re.S)
+
+
+def _vision_instruction(user_message: Optional[str]) -> str:
+    """給 vision 模型的使用者指示（要求以描述 / 回覆兩段格式作答）。"""
+    ask = f"請看這張圖片並結合以下文字回覆：{user_message}" if user_message else "請看這張圖片並回覆。"
+    return (
+        f"{ask}\n"
+        "請用以下格式回答：\n"
+        "描述：客觀描述圖片內容（一到三句，不要加入語氣）\n"
+        "回覆：以你的身分回覆我"
     )
 
+
+def _split_description(text: str) -> tuple[str | None, str]:
+    """把 vision 回覆拆成 (描述, 回覆)；模型沒照格式回答時描述為 None、回覆為原文。"""
+    match = _SPLIT_PATTERN.search(text)
+    if not match:
+        return None, text
+    description = match.group(1).strip(" *\n")
+    reply = match.group(2).strip(" *\n")
+    if not reply:
+        return None, text
+    return description or None, reply
+
+
 # ---------- Gemini Vision ----------
 GEMINI_VISION_DEFAULT_MODEL = "gemini-pro-vision"
 
-def _gemini_vision_reply_sync(
+async def _gemini_vision_reply(
     image_bytes: bytes,
     user_message: Optional[str],
     user_id: int = None,
 ) -> str | None:
-    """同步呼叫 Gemini Vision API。"""
-    from google import genai
-
+    """非同步呼叫 Gemini Vision API（使用 SDK 的 aio 介面，受圖片分析並行上限限制）。"""
     api_key = (os.getenv("GEMINI_API_KEY") or "").strip()
     if not api_key:
         return None
 
-    client = genai.Client(api_key=api_key)
     model = (os.getenv("GEMINI_VISION_MODEL") or "").strip() or GEMINI_VISION_DEFAULT_MODEL
+    client = ai_clients.get_gemini_client(api_key, workload="vision")
 
-    # 準備內容
+    from google.genai import types
+
+    # 準備內容（圖片以 Part 傳入，SDK 不接受舊版的 {"mime_type", "data"} dict）
     contents = [
-        {"mime_type": "image/jpeg", "data": image_bytes}
+        types.Part.from_bytes(data=image_bytes, mime_type="image/jpeg")
     ]
     
     # 將系統提示與使用者訊息一併傳入
-    full_prompt = f"{_get_system_prompt(user_id)}\n\n使用者：請描述圖片並結合以下文字回覆：{user_message}" if user_message else \
-                  f"{_get_system_prompt(user_id)}\n\n使用者：請描述圖片並回覆。"
-    contents.append(full_prompt)
+    contents.append(f"{await _get_system_prompt(user_id)}\n\n使用者：{_vision_instruction(user_message)}")
+    _upstream["gemini_requests"] += 1
+    _upstream["gemini_bytes"] += len(image_bytes)
     
-    response = client.models.generate_content(
-        model=model,
-        contents=contents,
-    )
+    async with ai_clients.get_semaphore("vision"):
+        with provider_call("gemini", model, "vision"), provider_round_trip():
+            response = await client.aio.models.generate_content(
+                model=model,
+                contents=contents,
+            )
     text = getattr(response, "text", None) or ""
     return (text or "").strip() or None
 
@@ -112,26 +158,27 @@ def _gemini_vision_reply_sync(
 OPENAI_VISION_DEFAULT_MODEL = "gpt-4o-mini"
 
 async def _openai_vision_reply(
-    image_base64: str,
+    image_bytes: bytes,
     user_message: Optional[str],
     user_id: int = None,
 ) -> str | None:
-    """非同步呼叫 OpenAI Vision API。"""
+    """非同步呼叫 OpenAI Vision API（只有走到這裡才把圖片轉成 base64）。"""
     api_key = (os.getenv("OPENAI_API_KEY") or "").strip()
     if not api_key:
         return None
 
-    from openai import AsyncOpenAI
-
-    client = AsyncOpenAI(api_key=api_key)
     model = (os.getenv("OPENAI_VISION_MODEL") or "").strip() or OPENAI_VISION_DEFAULT_MODEL
+    client = ai_clients.get_openai_client(api_key, workload="vision")
+    image_base64 = base64.b64encode(image_bytes).decode("ascii")
+    _upstream["openai_requests"] += 1
+    _upstream["openai_bytes"] += len(image_base64)
     
     messages = [
-        {"role": "system", "content": _get_system_prompt(user_id)},
+        {"role": "system", "content": await _get_system_prompt(user_id)},
         {
             "role": "user",
             "content": [
-                {"type": "text", "text": user_message if user_message else "請描述圖片並回覆。"},
+                {"type": "text", "text": _vision_instruction(user_message)},
                 {
                     "type": "image_url",
                     "image_url": {"url": f"data:image/jpeg;base64,{image_base64}"},
@@ -140,12 +187,14 @@ async def _openai_vision_reply(
         },
     ]
 
-    response = await client.chat.completions.create(
-        model=model,
-        messages=messages,
-        temperature=0.7,
-        max_tokens=500,
-    )
+    async with ai_clients.get_semaphore("vision"):
+        with provider_call("openai", model, "vision"), provider_round_trip():
+            response = await client.chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=0.7,
+                max_tokens=500,
+            )
     content = response.choices[0].message.content
     return (content or "").strip() or None
 
@@ -153,27 +202,26 @@ async def _openai_vision_reply(
 # ---------- 統一入口 ----------
 GEMINI_FALLBACK_MSG = "目前暫時無法分析圖片並回覆，請稍後再試。"
 
-async def get_ai_image_reply(
+async def _vision_text(
     image_bytes: bytes,
-    image_base64: str,
-    user_message: Optional[str] = None,
+    user_message: Optional[str],
     user_id: int = None,
 ) -> str | None:
     """
     有 GEMINI_API_KEY 時：只打 Gemini Vision，失敗則回傳固定提示。
-    沒有時：試 OpenAI Vision，再沒有則回傳 None（由呼叫端處理）。
+    沒有時（或 Gemini Vision 斷路器為 open）：試 OpenAI Vision，再沒有則回傳 None。
+    回傳的是模型原文（描述 / 回覆兩段格式）。
     """
-    if not (image_bytes or image_base64):
-        return None
-
     gemini_key = (os.getenv("GEMINI_API_KEY") or "").strip()
 
     if gemini_key:
         try:
-            reply = await asyncio.to_thread(_gemini_vision_reply_sync, image_bytes, user_message, user_id)
+            reply = await guarded("gemini:vision", lambda: _gemini_vision_reply(image_bytes, user_message, user_id))
             if reply:
                 return reply
             return GEMINI_FALLBACK_MSG
+        except CircuitOpenError:
+            logger.info("Gemini Vision 斷路器為 open，改用 OpenAI Vision")
         except ImportError:
             logger.warning("google-genai 未安裝，請執行 pip install google-genai")
             return GEMINI_FALLBACK_MSG
@@ -184,10 +232,62 @@ async def get_ai_image_reply(
     openai_key = (os.getenv("OPENAI_API_KEY") or "").strip()
     if openai_key:
         try:
-            return await _openai_vision_reply(image_base64, user_message, user_id)
+            return await guarded("openai:vision", lambda: _openai_vision_reply(image_bytes, user_message, user_id))
+        except CircuitOpenError:
+            logger.info("OpenAI Vision 斷路器為 open")
         except ImportError:
             logger.debug("openai 套件未安裝，略過 OpenAI Vision")
         except Exception as e:
             logger.warning("OpenAI Vision API 錯誤，無法處理圖片: %s", e)
 
-    return None
\ No newline at end of file
+    return None
+
+
+async def _reply_from_description(description: str, user_message: Optional[str], user_id: int = None) -> str | None:
+    """以快取的圖片描述改用文字模型回覆（人設語氣由 ai_reply 的系統提示負責）；無法回覆時回傳 None。"""
+    message = f"（我傳了一張照片給你，照片內容：{description}）"
+    if user_message:
+        message += f"\n{user_message}"
+    reply = await ai_reply.get_ai_reply(message, user_id)
+    if not reply or reply == ai_reply.GEMINI_FALLBACK_MSG:
+        return None
+    return reply
+
+
+async def get_ai_image_reply(
+    image_bytes: bytes,
+    user_message: Optional[str] = None,
+    user_id: int = None,
+    image_hash: int | None = None,
+) -> str | None:
+    """
+    看圖回覆。image_bytes 應為 JPEG（由 image_pipeline.prepare_vision 縮圖）；base64 只在 OpenAI 路徑才產生。
+    有 image_hash（dHash）時先查 vision_cache：近似圖沿用描述，只用文字模型重新回覆；
+    沒命中（或文字模型無法回覆）時才呼叫 vision，並存下回覆中的描述。
+    沒有可用的 AI 時回傳 None（由呼叫端處理）。
+    """
+    if not image_bytes:
+        return None
+
+    cache = get_vision_cache() if image_hash is not None else None
+    persona = await _get_persona(user_id)
+    if cache is not None:
+        hit = cache.get(persona, user_message, image_hash)
+        if hit is not None:
+            reply = await _reply_from_description(hit.description, user_message, user_id)
+            if reply:
+                logger.info("看圖描述快取命中（距離 %d），改用文字模型回覆", hit.distance)
+                return reply
+
+    text = await _vision_text(image_bytes, user_message, user_id)
+    if not text or text == GEMINI_FALLBACK_MSG:
+        return text
+    description, reply = _split_description(text)
+    if description and cache is not None:
+        cache.put(persona, user_message, image_hash, description)
+    return reply
+
+
+def vision_stats() -> dict:
+    """回傳送往各 vision provider 的請求數與圖片 bytes。"""
+    return dict(_upstream)
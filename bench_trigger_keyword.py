@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+比較觸發關鍵字比對的新舊做法。
+執行：python bench_trigger_keyword.py
+  - legacy：舊做法，每則訊息都依長度排序全部關鍵字，再逐一做子字串搜尋
+  - aho-corasick：keyword_matcher.AhoCorasick，一次掃過訊息
+分別以內建約 100 個關鍵字與 5000 個合成關鍵字量測。
+"""
+
+import random
+import time
+
+from ai_image_gen import IMAGE_TRIGGER_KEYWORDS
+from keyword_matcher import AhoCorasick
+
+ROUNDS = 20000
+
+MESSAGES = [
+    "早安",
+    "我今天好累喔，剛下班",
+    "你在幹嘛呀？想你了",
+    "晚上要不要一起去看電影，然後吃宵夜",
+    "這是一則完全沒有關鍵字的普通訊息，只是想說說話而已",
+    "哈哈哈哈哈哈哈哈哈哈哈哈哈哈哈哈哈哈哈哈哈哈哈哈哈哈哈哈哈哈",
+]
+
+
+def legacy_match(keywords: frozenset, message: str) -> str | None:
+    text = message.strip()
+    if text in keywords:
+        return text
+    for keyword in sorted(keywords, key=len, reverse=True):
+        if keyword in text:
+            return keyword
+    return None
+
+
+def _synthetic_keywords(count: int) -> frozenset:
+    rng = random.Random(0)
+    alphabet = "的一是不了人我在有他這中大來上國個到說們為子和你地出道也時年得就那要下以生會自著去之過家學對可她裡後小麼心多天而能好都然沒日於起還發成事只作當想看文無開手十用主行方又如前所本見經頭面公同三已老從動兩長"
+    words = set(IMAGE_TRIGGER_KEYWORDS)
+    while len(words) < count:
+        words.add("".join(rng.choice(alphabet) for _ in range(rng.randint(2, 5))))
+    return frozenset(words)
+
+
+def _bench(name: str, fn) -> float:
+    start = time.perf_counter()
+    for i in range(ROUNDS):
+        fn(MESSAGES[i % len(MESSAGES)])
+    per_call_us = (time.perf_counter() - start) * 1_000_000 / ROUNDS
+    print(f"  {name:<14} {per_call_us:>10.2f} µs / 則")
+    return per_call_us
+
+
+def main():
+    print("=" * 60)
+    print("觸發關鍵字比對效能比較")
+    print("=" * 60)
+    for keywords in (IMAGE_TRIGGER_KEYWORDS, _synthetic_keywords(5000)):
+        automaton = AhoCorasick(keywords)
+        for message in MESSAGES:
+            expected = legacy_match(keywords, message)
+            actual = automaton.longest_match(message.strip())
+            if (expected is None) != (actual is None) or (actual and len(actual) != len(expected)):
+                print(f"  ⚠ 結果不同: {message!r} legacy={expected!r} ac={actual!r}")
+        print(f"\n關鍵字數: {len(keywords)}")
+        legacy = _bench("legacy", lambda m: legacy_match(keywords, m))
+        ac = _bench("aho-corasick", lambda m: automaton.longest_match(m.strip()))
+        print(f"  加速 {legacy / ac:.1f} 倍")
+
+
+if __name__ == "__main__":
+    main()
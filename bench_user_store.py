@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+比較用戶配置的 JSON 與 SQLite 後端效能。
+執行：python bench_user_store.py [用戶數 ...]（預設 10000 100000 1000000）
+每個規模會產生假資料到暫存目錄，量測：
+  - json-raw：舊做法，每次查詢 / 寫入都重新解析並重寫整份 users_config.json
+  - json：user_store.JsonUserStore（記憶體快取，寫入只附加 journal；另量一次寫回主檔的時間）
+  - sqlite：user_store.SqliteUserStore（冷查詢繞過 LRU 快取，直接走主鍵索引）
+"""
+
+import json
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from user_store import JsonUserStore, SqliteUserStore
+
+LOOKUPS = 2000
+WRITES = 200
+# 舊做法每次都解析整份檔案，大規模時只量少數幾次
+RAW_ITERATIONS = 3
+
+
+def _profile(i: int) -> dict:
+    return {
+        "girlfriend_type": ("highschool", "mature", "spicy")[i % 3],
+        "girlfriend_name": f"寶貝{i}",
+        "user_name": f"user{i}",
+    }
+
+
+def _write_fixture(path: Path, users: int) -> None:
+    data = {"comment": "bench", "example": {}}
+    data.update({str(1_000_000_000 + i): _profile(i) for i in range(users)})
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+
+
+def _timeit(fn, iterations: int) -> float:
+    """回傳平均每次耗時（毫秒）。"""
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - start) * 1000 / iterations
+
+
+def _bench_raw(path: Path, ids: list[int]) -> tuple[float, float]:
+    def lookup():
+        with open(path, encoding="utf-8") as f:
+            json.load(f).get(str(random.choice(ids)))
+
+    def write():
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        data[str(random.choice(ids))] = _profile(0)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+
+    return _timeit(lookup, RAW_ITERATIONS), _timeit(write, RAW_ITERATIONS)
+
+
+def _bench_json(path: Path, ids: list[int]) -> tuple[float, float, float, float]:
+    store = JsonUserStore(path, check_interval=1.0, flush_interval=0)
+    start = time.perf_counter()
+    store.get(ids[0])
+    load_ms = (time.perf_counter() - start) * 1000
+    lookup = _timeit(lambda: store.get(random.choice(ids)), LOOKUPS)
+    write = _timeit(lambda: store.save(random.choice(ids), _profile(0)), WRITES)
+    flush = _timeit(store.flush, 1)
+    return load_ms, lookup, write, flush
+
+
+def _bench_sqlite(json_path: Path, db_path: Path, ids: list[int]) -> tuple[float, float, float]:
+    store = SqliteUserStore(db_path, cache_size=0)
+    with open(json_path, encoding="utf-8") as f:
+        profiles = json.load(f)
+    start = time.perf_counter()
+    store.import_profiles(profiles)
+    migrate_ms = (time.perf_counter() - start) * 1000
+    lookup = _timeit(lambda: store.get(random.choice(ids)), LOOKUPS)
+    write = _timeit(lambda: store.save(random.choice(ids), _profile(0)), WRITES)
+    store.close()
+    return migrate_ms, lookup, write
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [10_000, 100_000, 1_000_000]
+
+    print("=" * 72)
+    print("用戶配置後端效能比較（毫秒 / 次）")
+    print("=" * 72)
+    print(f"{'用戶數':>10} {'後端':<10} {'載入/遷移':>12} {'查詢':>12} {'寫入':>12}")
+
+    for users in sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            json_path = Path(tmp) / "users_config.json"
+            db_path = Path(tmp) / "users_config.db"
+            _write_fixture(json_path, users)
+            ids = [1_000_000_000 + i for i in range(users)]
+
+            raw_lookup, raw_write = _bench_raw(json_path, ids)
+            print(f"{users:>10} {'json-raw':<10} {'-':>12} {raw_lookup:>12.3f} {raw_write:>12.3f}")
+            load_ms, lookup, write, flush = _bench_json(json_path, ids)
+            print(f"{users:>10} {'json':<10} {load_ms:>12.1f} {lookup:>12.4f} {write:>12.4f}")
+            print(f"{users:>10} {'json 寫回':<10} {'-':>12} {'-':>12} {flush:>12.3f}")
+            migrate_ms, lookup, write = _bench_sqlite(json_path, db_path, ids)
+            print(f"{users:>10} {'sqlite':<10} {migrate_ms:>12.1f} {lookup:>12.4f} {write:>12.4f}")
+
+
+if __name__ == "__main__":
+    main()
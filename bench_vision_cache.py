@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+量測看圖描述快取（dHash）的近似圖命中率、誤判率與查詢耗時。
+執行：python bench_vision_cache.py [--images 200] [--max-distance 6]
+  - 產生 --images 張不同的合成圖（隨機色塊與文字般的線條，模擬梗圖）
+  - 對每張圖做轉傳常見的變化：重新壓縮、縮小、Telegram 尺寸（800 / 320）、裁掉邊緣、加浮水印
+  - 命中率：變化後的圖與原圖距離 ≤ 門檻的比例；誤判率：不同圖之間距離 ≤ 門檻的比例
+  - 查詢耗時：快取存滿 VISION_CACHE_SIZE 預設筆數後，單一分組內查詢未命中的平均耗時（最壞情況）
+"""
+
+import argparse
+import random
+import time
+from io import BytesIO
+
+from PIL import Image, ImageDraw
+
+from vision_cache import DEFAULT_MAX_ENTRIES, VisionCache, dhash, hamming
+
+
+def _synthetic_image(seed: int) -> Image.Image:
+    rng = random.Random(seed)
+    img = Image.new("RGB", (1024, 768), tuple(rng.randrange(256) for _ in range(3)))
+    draw = ImageDraw.Draw(img)
+    for _ in range(12):
+        x, y = rng.randrange(1024), rng.randrange(768)
+        w, h = rng.randrange(50, 400), rng.randrange(50, 300)
+        draw.rectangle([x, y, x + w, y + h], fill=tuple(rng.randrange(256) for _ in range(3)))
+    for _ in range(6):
+        y = rng.randrange(768)
+        draw.line([(rng.randrange(200), y), (rng.randrange(600, 1024), y)], fill=(0, 0, 0), width=rng.randrange(4, 16))
+    return img
+
+
+def _jpeg(img: Image.Image, quality: int = 90) -> bytes:
+    output = BytesIO()
+    img.save(output, format="JPEG", quality=quality)
+    return output.getvalue()
+
+
+def _variants(img: Image.Image) -> dict[str, bytes]:
+    w, h = img.size
+    watermarked = img.copy()
+    ImageDraw.Draw(watermarked).text((w - 160, h - 40), "@meme_channel", fill=(255, 255, 255))
+    return {
+        "重新壓縮 q60": _jpeg(img, 60),
+        "telegram 800": _jpeg(img.resize((800, 600), Image.LANCZOS), 80),
+        "telegram 320": _jpeg(img.resize((320, 240), Image.LANCZOS), 80),
+        "裁掉 3% 邊緣": _jpeg(img.crop((int(w * 0.03), int(h * 0.03), int(w * 0.97), int(h * 0.97)))),
+        "加浮水印": _jpeg(watermarked),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="量測 dHash 近似圖快取")
+    parser.add_argument("--images", type=int, default=200, help="不同圖片數")
+    parser.add_argument("--max-distance", type=int, default=6, help="視為同一張圖的漢明距離上限")
+    args = parser.parse_args()
+
+    images = [_synthetic_image(seed) for seed in range(args.images)]
+    hashes = [dhash(_jpeg(img)) for img in images]
+
+    print(f"{'變化':<16} {'命中率':>8} {'平均距離':>10} {'最大距離':>10}")
+    for name in _variants(images[0]):
+        distances = [hamming(hashes[i], dhash(_variants(img)[name])) for i, img in enumerate(images)]
+        hit = sum(d <= args.max_distance for d in distances) / len(distances)
+        print(f"{name:<16} {hit:>8.1%} {sum(distances) / len(distances):>10.1f} {max(distances):>10}")
+
+    pairs = [(i, j) for i in range(len(hashes)) for j in range(i + 1, len(hashes))]
+    false_hits = sum(hamming(hashes[i], hashes[j]) <= args.max_distance for i, j in pairs)
+    closest = min(hamming(hashes[i], hashes[j]) for i, j in pairs)
+    print(f"不同圖誤判率：{false_hits / len(pairs):.3%}（{len(pairs)} 組，最近距離 {closest}）")
+
+    cache = VisionCache(max_entries=DEFAULT_MAX_ENTRIES, max_distance=args.max_distance)
+    rng = random.Random(0)
+    for _ in range(DEFAULT_MAX_ENTRIES):
+        cache.put("highschool", None, rng.getrandbits(64), "描述")
+    queries = [rng.getrandbits(64) for _ in range(1000)]
+    started = time.perf_counter()
+    for value in queries:
+        cache.get("highschool", None, value)
+    elapsed = (time.perf_counter() - started) / len(queries)
+    print(f"查詢耗時：同一分組 {DEFAULT_MAX_ENTRIES} 筆，平均 {elapsed * 1e6:.0f}µs / 次")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+"""
+用本地的假 Telegram 量測 long polling 與 webhook 模式的吞吐量。
+執行：python bench_webhook.py [--updates 500] [--workers 2] [--mode both]
+  - 假 Telegram：本地 HTTP server，實作 bot 會呼叫的 Bot API（getMe、getUpdates、setWebhook、sendMessage…），
+    bot 以 TELEGRAM_API_BASE_URL 指向它
+  - polling：一個 bot 行程，從假 Telegram 的 getUpdates 取得合成訊息
+  - webhook：啟動 --workers 個 bot 行程，本腳本充當負載平衡器，輪流把合成訊息 POST 給各 worker
+量測從送出第一則到假 Telegram 收到全部回覆（sendMessage）的時間。
+不會連到真正的 Telegram，也不會呼叫 AI API（清空 API Key，使用關鍵字回覆）。
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs
+
+import httpx
+
+TOKEN = "123456:bench"
+SECRET = "bench-secret"
+MESSAGE_TEXT = "bench"
+
+
+class FakeTelegram:
+    """假 Telegram Bot API 的狀態：待取的更新與收到的回覆數。"""
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.updates: list[dict] = []
+        self.replies = 0
+        self.polls = 0
+        self.message_id = 0
+
+    def push(self, updates: list[dict]) -> None:
+        with self.cond:
+            self.updates.extend(updates)
+            self.cond.notify_all()
+
+    def get_updates(self, offset: int, timeout: float) -> list[dict]:
+        with self.cond:
+            self.polls += 1
+            self.updates = [u for u in self.updates if u["update_id"] >= offset]
+            if not self.updates:
+                self.cond.wait(min(timeout, 1.0))
+            return self.updates[:100]
+
+    def reply(self, chat_id: int) -> dict:
+        with self.cond:
+            self.replies += 1
+            self.message_id += 1
+            self.cond.notify_all()
+            return {
+                "message_id": self.message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": "ok",
+            }
+
+    def wait_replies(self, count: int, timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while self.replies < count:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.cond.wait(remaining)
+        return True
+
+
+def _make_handler(state: FakeTelegram):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            body = self.rfile.read(length).decode("utf-8") if length else ""
+            if "json" in (self.headers.get("Content-Type") or ""):
+                params = json.loads(body or "{}")
+            else:
+                params = {k: v[0] for k, v in parse_qs(body).items()}
+            method = self.path.rsplit("/", 1)[-1]
+
+            if method == "getMe":
+                result = {"id": 123456, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+            elif method == "getUpdates":
+                result = state.get_updates(int(params.get("offset") or 0), float(params.get("timeout") or 0))
+            elif method.startswith("send"):
+                result = state.reply(int(params.get("chat_id") or 0))
+            else:
+                # setWebhook / deleteWebhook / 其他：直接成功
+                result = True
+
+            payload = json.dumps({"ok": True, "result": result}).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+    return Handler
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _wait_port(port: int, timeout: float = 30.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"worker 沒有在 {timeout} 秒內監聽 {port}")
+
+
+def _synthetic_updates(count: int, users: int) -> list[dict]:
+    now = int(time.time())
+    updates = []
+    for i in range(1, count + 1):
+        user_id = 1_000_000 + i % users
+        updates.append({
+            "update_id": i,
+            "message": {
+                "message_id": i,
+                "date": now,
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": user_id, "is_bot": False, "first_name": "bench"},
+                "text": MESSAGE_TEXT,
+            },
+        })
+    return updates
+
+
+def _start_bot(api_base: str, extra_env: dict) -> subprocess.Popen:
+    env = {
+        **os.environ,
+        "TELEGRAM_BOT_TOKEN": TOKEN,
+        "TELEGRAM_API_BASE_URL": api_base,
+        # 不呼叫 AI，也不限流，只量測 Telegram 端的吞吐量
+        "GEMINI_API_KEY": "",
+        "OPENAI_API_KEY": "",
+        "ADMISSION": "0",
+        "IMAGE_PREGEN": "0",
+        **extra_env,
+    }
+    return subprocess.Popen(
+        [sys.executable, str(Path(__file__).parent / "main.py")],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+def _stop(procs: list[subprocess.Popen]) -> None:
+    for proc in procs:
+        proc.send_signal(signal.SIGINT)
+    for proc in procs:
+        try:
+            proc.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+
+def bench_polling(state: FakeTelegram, api_base: str, count: int, users: int) -> float:
+    proc = _start_bot(api_base, {"TELEGRAM_MODE": "polling"})
+    try:
+        deadline = time.monotonic() + 30
+        while state.polls == 0:
+            if time.monotonic() > deadline:
+                raise RuntimeError("bot 沒有開始 getUpdates")
+            time.sleep(0.1)
+        started = time.perf_counter()
+        state.push(_synthetic_updates(count, users))
+        if not state.wait_replies(count, timeout=300):
+            raise RuntimeError(f"逾時：只收到 {state.replies}/{count} 則回覆")
+        return time.perf_counter() - started
+    finally:
+        _stop([proc])
+
+
+async def _post_all(ports: list[int], updates: list[dict], concurrency: int) -> None:
+    semaphore = asyncio.Semaphore(concurrency)
+    headers = {"X-Telegram-Bot-Api-Secret-Token": SECRET}
+    async with httpx.AsyncClient(timeout=30) as client:
+        # secret token 不符的請求應被拒絕
+        bad = await client.post(f"http://127.0.0.1:{ports[0]}/telegram", json=updates[0])
+        if bad.status_code != 403:
+            print(f"警告：未帶 secret token 的請求回應 {bad.status_code}（預期 403）")
+
+        async def post(i: int, update: dict) -> None:
+            async with semaphore:
+                port = ports[i % len(ports)]  # 輪流分配，模擬負載平衡器
+                response = await client.post(f"http://127.0.0.1:{port}/telegram", json=update, headers=headers)
+                response.raise_for_status()
+
+        await asyncio.gather(*(post(i, u) for i, u in enumerate(updates)))
+
+
+def bench_webhook(state: FakeTelegram, api_base: str, count: int, users: int, workers: int, concurrency: int) -> float:
+    ports = [_free_port() for _ in range(workers)]
+    procs = [
+        _start_bot(api_base, {
+            "TELEGRAM_MODE": "webhook",
+            "TELEGRAM_WEBHOOK_URL": "http://127.0.0.1",
+            "TELEGRAM_WEBHOOK_SECRET": SECRET,
+            "TELEGRAM_WEBHOOK_LISTEN": "127.0.0.1",
+            "TELEGRAM_WEBHOOK_PORT": str(port),
+        })
+        for port in ports
+    ]
+    try:
+        for port in ports:
+            _wait_port(port)
+        started = time.perf_counter()
+        asyncio.run(_post_all(ports, _synthetic_updates(count, users), concurrency))
+        if not state.wait_replies(count, timeout=300):
+            raise RuntimeError(f"逾時：只收到 {state.replies}/{count} 則回覆")
+        return time.perf_counter() - started
+    finally:
+        _stop(procs)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="量測 polling / webhook 模式的吞吐量")
+    parser.add_argument("--updates", type=int, default=500, help="合成訊息數")
+    parser.add_argument("--users", type=int, default=50, help="不同用戶數")
+    parser.add_argument("--workers", type=int, default=2, help="webhook 模式的 worker 行程數")
+    parser.add_argument("--concurrency", type=int, default=32, help="webhook 模式同時 POST 的數量")
+    parser.add_argument("--mode", choices=["polling", "webhook", "both"], default="both")
+    args = parser.parse_args()
+
+    print(f"{'模式':<20} {'訊息數':>8} {'耗時(s)':>10} {'吞吐量(則/s)':>14}")
+    modes = ["polling", "webhook"] if args.mode == "both" else [args.mode]
+    for mode in modes:
+        state = FakeTelegram()
+        server = ThreadingHTTPServer(("127.0.0.1", 0), _make_handler(state))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        api_base = f"http://127.0.0.1:{server.server_address[1]}"
+        try:
+            if mode == "polling":
+                label = "polling"
+                elapsed = bench_polling(state, api_base, args.updates, args.users)
+            else:
+                label = f"webhook x{args.workers}"
+                elapsed = bench_webhook(state, api_base, args.updates, args.users, args.workers, args.concurrency)
+        finally:
+            server.shutdown()
+        print(f"{label:<20} {args.updates:>8} {elapsed:>10.2f} {args.updates / elapsed:>14.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,14 @@
 #!/usr/bin/env python3
 """Telegram 自動回覆機器人。"""
 
+import asyncio
+import math
 import os
 import logging
+import time
+from typing import NamedTuple
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, TelegramError
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -21,20 +26,60 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-from logic import get_reply
-from ai_reply import get_ai_reply, GIRLFRIEND_PERSONALITIES, save_user_config, _load_user_config
-from ai_image_gen import generate_image_by_keyword, get_trigger_keyword, IMAGE_GEN_FALLBACK_MSG
+from message_router import classify_message
+from ai_reply import get_ai_reply, get_ai_reply_stream, GIRLFRIEND_PERSONALITIES, GEMINI_FALLBACK_MSG
+from ai_reply_image import get_ai_image_reply, vision_stats, GEMINI_FALLBACK_MSG as VISION_ERROR_MSG
+from vision_cache import get_vision_cache
+from user_store import aload_user_config, asave_user_config, flush_user_store, cache_stats as user_cache_stats
+from ai_clients import client_stats
+from prompt_cache import prompt_cache_stats
+from image_cache import get_image_cache
+from gemini_context_cache import get_context_cache
+from hedging import hedging_stats
+from circuit_breaker import breaker_stats
+from admission import AdmissionController, create_admission_controller
+from latency import LatencyWindow
+from ai_image_gen import (
+    create_pregen_scheduler,
+    generate_image_by_keyword,
+    generation_flight_stats,
+    IMAGE_GEN_FALLBACK_MSG,
+)
+from telegram_file_ids import get_file_id_registry, image_key
+from image_pipeline import get_image_pipeline
+from update_processor import ChatOrderedUpdateProcessor, DEFAULT_CONCURRENT_UPDATES
+from metrics import FALLBACKS, STAGE_SECONDS, instrument_handler, register_stats, start_from_env
 
 # 對話狀態定義
 CHOOSING_GIRLFRIEND = 1
 ENTERING_NAME = 2
 CONFIRMING = 3
 
+# 串流回覆時兩次編輯訊息的最短間隔（秒），避免超過 Telegram 的編輯頻率限制
+DEFAULT_STREAM_EDIT_INTERVAL = 1.0
+# Telegram 單則訊息長度上限
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+# 文字回覆延遲：首段文字出現（time-to-first-byte）與完整回覆送達分開記錄
+REPLY_LATENCY = {
+    "ttfb": LatencyWindow(),
+    "total": LatencyWindow(),
+}
+# 傳送圖片的耗時：上傳 bytes 與送 file_id 分開記錄
+PHOTO_SEND_LATENCY = {
+    "upload": LatencyWindow(),
+    "file_id": LatencyWindow(),
+}
+# 看圖回覆：從收到照片到送出回覆的總耗時
+VISION_LATENCY = LatencyWindow()
+# 沒有設定任何 vision API Key 時的回覆
+VISION_FALLBACK_MSG = "收到你的照片了～不過我現在沒辦法好好看，晚點再傳給我好嗎？💕"
+
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """處理 /start 指令，引導用戶選擇女友類型。"""
     user = update.effective_user
-    user_config = _load_user_config(user.id)
+    user_config = await aload_user_config(user.id)
     
     # 如果已經配置過，直接顯示歡迎訊息
     if user_config.get("girlfriend_type") and user_config.get("user_name"):
@@ -135,7 +180,7 @@ async def confirm_default_name(update: Update, context: ContextTypes.DEFAULT_TYP
         "girlfriend_name": girlfriend_name,
         "user_name": user_name,
     }
-    save_user_config(user.id, config)
+    await asave_user_config(user.id, config)
     
     girlfriend_type_name = GIRLFRIEND_PERSONALITIES[girlfriend_type]['name']
     
@@ -186,7 +231,7 @@ async def process_girlfriend_name(update: Update, context: ContextTypes.DEFAULT_
         "girlfriend_name": girlfriend_name,
         "user_name": user_name,
     }
-    save_user_config(user.id, config)
+    await asave_user_config(user.id, config)
     
     girlfriend_type_name = GIRLFRIEND_PERSONALITIES[girlfriend_type]['name']
     
@@ -218,10 +263,189 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         "/imagine <文字> - 生成圖片\n"
         "/help - 顯示此訊息\n\n"
         "傳送「吃飯」「睡覺」「自拍」「想你了」等約 100 個關鍵字會自動觸發拍照～ 📷\n"
+        "傳照片給我，我會看看再回你～ 👀\n"
         "其他訊息我會用 AI 回覆你～ 💕"
     )
 
 
+def _streaming_enabled() -> bool:
+    return (os.getenv("AI_STREAMING") or "").strip().lower() in {"1", "true", "yes", "on"}
+
+
+async def _stream_reply(message, chunks, started: float) -> str | None:
+    """
+    收到第一段文字就先送出訊息，之後依 STREAM_EDIT_INTERVAL 節流編輯同一則訊息。
+    回傳完整回覆；完全沒有產出時回傳 None（尚未送出任何訊息）。
+    """
+    interval = float(os.getenv("STREAM_EDIT_INTERVAL") or DEFAULT_STREAM_EDIT_INTERVAL)
+    sent = None
+    text = ""
+    shown = ""
+    last_edit = 0.0
+    async for piece in chunks:
+        text = (text + piece)[:TELEGRAM_MESSAGE_LIMIT]
+        now = time.monotonic()
+        if sent is None:
+            if not text.strip():
+                continue
+            sent = await message.reply_text(text)
+            REPLY_LATENCY["ttfb"].record(time.perf_counter() - started)
+            shown, last_edit = text, now
+        elif now - last_edit >= interval and text != shown:
+            try:
+                await sent.edit_text(text)
+                shown = text
+            except TelegramError as e:
+                # 中途編輯失敗（例如被限流）不影響後續，最後一次編輯會補上完整內容
+                logger.debug("串流編輯訊息失敗: %s", e)
+            last_edit = now
+    if sent is None:
+        return None
+    text = text.strip()
+    # Telegram 會去掉訊息前後的空白，顯示中的內容以 strip 後比較，避免「Message is not modified」
+    if text and text != shown.strip():
+        try:
+            await sent.edit_text(text)
+        except TelegramError as e:
+            # 回覆已送達（只差最後一次補齊），編輯失敗不應讓整則回覆變成錯誤
+            logger.warning("串流最後一次編輯訊息失敗: %s", e)
+    REPLY_LATENCY["total"].record(time.perf_counter() - started)
+    return text
+
+
+async def _send_ai_reply(message, text: str, user_id: int, fallback_reply: str) -> str:
+    """送出 AI 文字回覆（AI_STREAMING=1 時串流），沒有 AI 可用時送關鍵字回覆。"""
+    started = time.perf_counter()
+    if _streaming_enabled():
+        reply = await _stream_reply(message, get_ai_reply_stream(text, user_id), started)
+        if reply is not None:
+            if reply == GEMINI_FALLBACK_MSG:
+                FALLBACKS.inc("gemini_text")
+            return reply
+    else:
+        reply = await get_ai_reply(text, user_id)
+    if reply is None:
+        reply = fallback_reply
+        FALLBACKS.inc("keyword_reply")
+    elif reply == GEMINI_FALLBACK_MSG:
+        FALLBACKS.inc("gemini_text")
+    with STAGE_SECONDS.time("telegram_send_text"):
+        await message.reply_text(reply)
+    # 非串流時使用者要等到整則回覆才看到第一個字
+    elapsed = time.perf_counter() - started
+    REPLY_LATENCY["ttfb"].record(elapsed)
+    REPLY_LATENCY["total"].record(elapsed)
+    return reply
+
+
+async def _upload_photo(message, image_bytes: bytes):
+    """上傳圖片 bytes 並記錄上傳耗時。"""
+    started = time.perf_counter()
+    sent = await message.reply_photo(photo=image_bytes)
+    elapsed = time.perf_counter() - started
+    PHOTO_SEND_LATENCY["upload"].record(elapsed)
+    STAGE_SECONDS.observe(elapsed, "telegram_send_photo")
+    logger.info("上傳圖片 %d bytes，耗時 %.0fms", len(image_bytes), elapsed * 1000)
+    return sent
+
+
+async def _send_photo(message, image_bytes: bytes) -> None:
+    """
+    傳送圖片：同一張圖之前上傳過就直接送 Telegram 的 file_id（不必重新上傳），
+    否則上傳 bytes 並記下回傳的 file_id。file_id 失效時改回上傳。
+    """
+    registry = get_file_id_registry()
+    if registry is None:
+        await _upload_photo(message, image_bytes)
+        return
+
+    key = image_key(image_bytes)
+    file_id = await asyncio.to_thread(registry.get, key)
+    if file_id:
+        try:
+            started = time.perf_counter()
+            await message.reply_photo(photo=file_id)
+            elapsed = time.perf_counter() - started
+            PHOTO_SEND_LATENCY["file_id"].record(elapsed)
+            STAGE_SECONDS.observe(elapsed, "telegram_send_photo_file_id")
+            return
+        except BadRequest as e:
+            logger.info("file_id 已失效，改為重新上傳: %s", e)
+            await asyncio.to_thread(registry.forget, key)
+
+    sent = await _upload_photo(message, image_bytes)
+    if sent is not None and sent.photo:
+        # photo 由小到大排列，最後一個是原尺寸
+        await asyncio.to_thread(registry.put, key, sent.photo[-1].file_id)
+
+
+async def _reply_with_photo(message, text: str, user_id: int, route) -> None:
+    """
+    關鍵字觸發拍照：圖片生成最慢且不依賴文字回覆，所以一開始就啟動，
+    同時送 AI 文字回覆（例如：我也好想你～）與「正在拍」提示，總耗時約為 max(文字, 圖片)。
+    任何一步出錯時取消其餘工作，再由呼叫端回覆錯誤訊息。
+    """
+    started = time.perf_counter()
+    image_task = asyncio.create_task(generate_image_by_keyword(route.trigger, user_id))
+    text_task = asyncio.create_task(_send_ai_reply(message, text, user_id, route.fallback_reply))
+    status_task = asyncio.create_task(message.reply_text("鼻鼻我拍照給你看~~~"))
+    tasks = (image_task, text_task, status_task)
+    try:
+        await asyncio.gather(text_task, status_task)
+        image_bytes = await image_task
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+
+    if image_bytes:
+        await _send_photo(message, image_bytes)
+        await message.reply_text("拍好了～ 💕")
+        logger.info(
+            "關鍵字觸發拍照 用戶=%s 關鍵字=%s 耗時=%.1fs",
+            user_id, route.trigger, time.perf_counter() - started,
+        )
+    else:
+        await _reply_image_fallback(message)
+
+
+async def _reply_image_fallback(message) -> None:
+    """圖片生成失敗時回覆固定提示（並計入 fallback 指標）。"""
+    FALLBACKS.inc("image_gen")
+    await message.reply_text(IMAGE_GEN_FALLBACK_MSG)
+
+
+# AI 呼叫的准入控制（於 run_bot 建立：.env 在 import 之後才載入）；None 表示停用
+_admission: AdmissionController | None = None
+
+
+async def _admit(message, workload: str, user_id: int, fallback: str | None = None) -> str | None:
+    """
+    檢查准入控制，回傳實際准入的工作類型。workload 超過上限且有 fallback 時改試 fallback
+    （例如拍照名額用完時改為只回文字）；都不准入時立即回覆友善的拒絕訊息並回傳 None。
+    """
+    if _admission is None:
+        return workload
+    decision = _admission.admit(workload, user_id)
+    if decision.allowed:
+        return workload
+    if fallback is not None:
+        logger.info("用戶 %s 的 %s 請求超過上限（%s），改為 %s", user_id, workload, decision.scope, fallback)
+        workload = fallback
+        decision = _admission.admit(workload, user_id)
+        if decision.allowed:
+            return workload
+    wait = max(1, math.ceil(decision.retry_after))
+    logger.info("拒絕用戶 %s 的 %s 請求（%s 上限），建議等待 %d 秒", user_id, workload, decision.scope, wait)
+    if decision.scope == "user":
+        text = f"你傳太快了啦～讓我喘口氣，{wait} 秒後再找我好嗎？💕"
+    else:
+        text = f"現在好多人在找我，忙不過來了 🥺 {wait} 秒後再試一次好嗎？"
+    await message.reply_text(text)
+    return None
+
+
+@instrument_handler("auto_reply")
 async def auto_reply(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """對所有文字訊息：若為觸發關鍵字則拍照，否則 AI 或關鍵字回覆。"""
     if not update.message:
@@ -231,37 +455,30 @@ async def auto_reply(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
     user_id = update.effective_user.id
     text = update.message.text or ""
     
-    # 約 100 個關鍵字觸發拍照（例如：吃飯、睡覺、自拍、想你了）
-    trigger = get_trigger_keyword(text)
-    if trigger is not None:
+    # 一次掃描同時取得拍照觸發關鍵字（例如：吃飯、睡覺、自拍、想你了）與關鍵字回覆
+    with STAGE_SECONDS.time("trigger_match"):
+        route = classify_message(text)
+    trigger = route.trigger
+    if trigger is None:
+        workload = await _admit(update.message, "text", user_id)
+    else:
+        # 拍照名額用完時仍以文字回覆（AI 或關鍵字），文字名額也用完才拒絕
+        workload = await _admit(update.message, "image", user_id, fallback="text")
+    if workload is None:
+        return
+    if workload == "image":
         try:
-            # 先送 AI 文字回覆，更像真人（例如：我也好想你～）
-            ai_reply = await get_ai_reply(text, user_id)
-            if ai_reply is None:
-                ai_reply = get_reply(text)
-            await update.message.reply_text(ai_reply)
-            # 再說正在拍、送圖、拍好了
-            await update.message.reply_text("鼻鼻我拍照給你看~~~")
-            image_bytes = await generate_image_by_keyword(trigger, user_id)
-            if image_bytes:
-                await update.message.reply_photo(photo=image_bytes)
-                await update.message.reply_text("拍好了～ 💕")
-                logger.info("關鍵字觸發拍照 用戶=%s 關鍵字=%s", user_id, trigger)
-            else:
-                await update.message.reply_text(IMAGE_GEN_FALLBACK_MSG)
+            await _reply_with_photo(update.message, text, user_id, route)
         except Exception as e:
             logger.exception("關鍵字觸發拍照錯誤: %s", e)
             try:
-                await update.message.reply_text(IMAGE_GEN_FALLBACK_MSG)
+                await _reply_image_fallback(update.message)
             except Exception:
                 pass
         return
     
     try:
-        reply = await get_ai_reply(text, user_id)
-        if reply is None:
-            reply = get_reply(text)
-        await update.message.reply_text(reply)
+        reply = await _send_ai_reply(update.message, text, user_id, route.fallback_reply)
         logger.info("回覆使用者 %s: %s", user_id, (reply[:50] + "..." if len(reply) > 50 else reply))
     except Exception as e:
         logger.exception("auto_reply 發生錯誤: %s", e)
@@ -271,6 +488,54 @@ async def auto_reply(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
             pass
 
 
+def _pick_photo_size(sizes, min_edge: int):
+    """
+    從 Telegram 提供的多個尺寸（由小到大）挑最長邊 ≥ min_edge 的最小者；都不夠大時用最大的。
+    vision 模型用不到原尺寸，少下載也少縮圖。
+    """
+    for size in sizes:
+        if max(size.width, size.height) >= min_edge:
+            return size
+    return sizes[-1]
+
+
+@instrument_handler("photo_reply")
+async def photo_reply(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """用戶傳照片：下載適合的尺寸、縮圖後交給 AI 看圖回覆（照片說明文字一併傳入）。"""
+    message = update.message
+    if not message or not message.photo:
+        return
+
+    user_id = update.effective_user.id
+    if not await _admit(message, "vision", user_id):
+        return
+
+    started = time.perf_counter()
+    try:
+        pipeline = get_image_pipeline()
+        photo = _pick_photo_size(message.photo, pipeline.vision_max_edge)
+        file = await photo.get_file()
+        downloaded = await file.download_as_bytearray()
+        image_bytes, image_hash = await pipeline.prepare_vision(downloaded)
+        reply = await get_ai_image_reply(image_bytes, message.caption, user_id, image_hash)
+        if reply is None or reply == VISION_ERROR_MSG:
+            FALLBACKS.inc("vision")
+        await message.reply_text(reply or VISION_FALLBACK_MSG)
+        elapsed = time.perf_counter() - started
+        VISION_LATENCY.record(elapsed)
+        logger.info(
+            "看圖回覆 用戶=%s 照片 %dx%d 下載 %d bytes，送出 %d bytes，耗時 %.1fs",
+            user_id, photo.width, photo.height, len(downloaded), len(image_bytes), elapsed,
+        )
+    except Exception as e:
+        logger.exception("看圖回覆發生錯誤: %s", e)
+        try:
+            await message.reply_text("看照片時發生錯誤，請稍後再試。")
+        except Exception:
+            pass
+
+
+@instrument_handler("imagine")
 async def imagine_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """處理 /imagine 指令，生成圖片。"""
     if not update.message:
@@ -283,25 +548,148 @@ async def imagine_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     if not prompt_text:
         await update.message.reply_text("請在 /imagine 後面加上圖片描述，例如：/imagine 一隻可愛的貓咪")
         return
+    if not await _admit(update.message, "image", user_id):
+        return
 
     await update.message.reply_text(f"正在為您生成圖片：『{prompt_text}』，請稍候... ✨")
     logger.info(f"用戶 {user_id} 請求生成圖片，prompt: {prompt_text}")
 
     try:
-        image_bytes = await generate_image_by_keyword(prompt_text, user_id)
+        # /imagine 是使用者自訂描述，每次都即時生成，不走圖片快取
+        image_bytes = await generate_image_by_keyword(prompt_text, user_id, use_cache=False)
         if image_bytes:
-            await update.message.reply_photo(photo=image_bytes)
+            await _send_photo(update.message, image_bytes)
             logger.info(f"成功為用戶 {user_id} 生成圖片")
         else:
-            await update.message.reply_text(IMAGE_GEN_FALLBACK_MSG)
+            await _reply_image_fallback(update.message)
     except Exception as e:
         logger.exception(f"圖片生成指令 /imagine 發生錯誤: {e}")
-        await update.message.reply_text(IMAGE_GEN_FALLBACK_MSG)
+        await _reply_image_fallback(update.message)
 
 
-def run_bot(token: str) -> None:
-    """建立並啟動 Bot。"""
-    application = Application.builder().token(token).build()
+# 背景預先生成熱門觸發圖片的排程與其 task
+_pregen_scheduler = None
+_pregen_task: asyncio.Task | None = None
+# /metrics 端點（METRICS_PORT 設定時）
+_metrics_server = None
+
+
+def _register_metrics(processor: ChatOrderedUpdateProcessor | None) -> None:
+    """把各子系統的 stats() 登記到 /metrics（抓取時才讀取）。"""
+    register_stats("update_processor", lambda: processor and {
+        "in_flight": processor.in_flight(),
+        "max_concurrent": processor.max_concurrent_updates,
+        "queued_chats": processor.queued_chats(),
+    })
+    register_stats("admission", lambda: _admission and _admission.stats())
+    register_stats("circuit_breaker", breaker_stats, label="name")
+    register_stats("hedging", hedging_stats, label="name")
+    register_stats("ai_client", client_stats, label="name")
+    register_stats("prompt_cache", prompt_cache_stats, label="cache")
+    register_stats("user_store", user_cache_stats)
+    register_stats("image_cache", lambda: (cache := get_image_cache()) and cache.stats())
+    register_stats("image_generation_flight", generation_flight_stats)
+    register_stats("image_pipeline", lambda: get_image_pipeline().stats())
+    register_stats("file_id", lambda: (registry := get_file_id_registry()) and registry.stats())
+    register_stats("vision_cache", lambda: (cache := get_vision_cache()) and cache.stats())
+    register_stats("vision_upstream", vision_stats)
+    register_stats("context_cache", lambda: (cache := get_context_cache()) and cache.stats())
+    register_stats("pregen", lambda: _pregen_scheduler and _pregen_scheduler.stats())
+
+
+async def _post_init(application: Application) -> None:
+    """啟動後開始背景預先生成排程（IMAGE_PREGEN=1 時）與 /metrics 端點（METRICS_PORT 設定時）。"""
+    global _pregen_scheduler, _pregen_task, _metrics_server
+    _metrics_server = start_from_env()
+    _pregen_scheduler = create_pregen_scheduler()
+    if _pregen_scheduler is not None:
+        _pregen_task = asyncio.create_task(_pregen_scheduler.run_forever())
+        logger.info("已啟用熱門觸發圖片預先生成")
+
+
+async def _post_shutdown(application: Application) -> None:
+    """關閉前寫回用戶配置、刪除 Gemini context cache，並記錄 AI 用戶端重用與提示快取統計。"""
+    if _pregen_task is not None:
+        _pregen_task.cancel()
+        try:
+            await _pregen_task
+        except asyncio.CancelledError:
+            pass
+        logger.info("預先生成統計: %s", _pregen_scheduler.stats())
+    await asyncio.to_thread(flush_user_store)
+    context_cache = get_context_cache()
+    if context_cache is not None:
+        logger.info("Gemini context cache 統計: %s", context_cache.stats())
+        await context_cache.aclose()
+    logger.info("AI 用戶端重用統計: %s", client_stats())
+    logger.info("系統提示快取統計: %s", prompt_cache_stats())
+    file_ids = get_file_id_registry()
+    if file_ids is not None:
+        logger.info("Telegram file_id 重用統計: %s", file_ids.stats())
+    logger.info("圖片生成合併統計: %s", generation_flight_stats())
+    pipeline = get_image_pipeline()
+    logger.info("圖片後處理統計: %s", pipeline.stats())
+    logger.info(
+        "傳送圖片耗時（秒）上傳=%s file_id=%s",
+        PHOTO_SEND_LATENCY["upload"].snapshot(),
+        PHOTO_SEND_LATENCY["file_id"].snapshot(),
+    )
+    logger.info("看圖回覆耗時（秒）: %s，送出圖片: %s", VISION_LATENCY.snapshot(), vision_stats())
+    vision_cache = get_vision_cache()
+    if vision_cache is not None:
+        logger.info("看圖描述快取統計: %s", vision_cache.stats())
+    pipeline.shutdown()
+    logger.info(
+        "文字回覆延遲（秒）首段=%s 完整=%s",
+        REPLY_LATENCY["ttfb"].snapshot(),
+        REPLY_LATENCY["total"].snapshot(),
+    )
+    if _admission is not None:
+        logger.info("准入控制統計: %s", _admission.stats())
+    breakers = breaker_stats()
+    if breakers:
+        logger.info("斷路器狀態: %s", breakers)
+    hedging = hedging_stats()
+    if hedging:
+        logger.info("對沖請求統計: %s", hedging)
+    if _metrics_server is not None:
+        _metrics_server.shutdown()
+
+
+class WebhookConfig(NamedTuple):
+    """webhook 模式設定（由 main 依環境變數建立）。"""
+
+    # Telegram 呼叫的公開網址（含路徑），通常指向反向代理 / 負載平衡器
+    url: str
+    # Telegram 會放在 X-Telegram-Bot-Api-Secret-Token 標頭，不符的請求一律拒絕
+    secret_token: str
+    listen: str = "0.0.0.0"
+    port: int = 8443
+    url_path: str = "telegram"
+
+
+def run_bot(token: str, webhook: WebhookConfig | None = None) -> None:
+    """建立並啟動 Bot：webhook 為 None 時使用 long polling，否則啟動 webhook HTTP server。"""
+    global _admission
+    _admission = create_admission_controller()
+    builder = (
+        Application.builder()
+        .token(token)
+        .post_init(_post_init)
+        .post_shutdown(_post_shutdown)
+    )
+    concurrent_updates = int(os.getenv("TELEGRAM_CONCURRENT_UPDATES") or DEFAULT_CONCURRENT_UPDATES)
+    processor = None
+    if concurrent_updates > 1:
+        # 不同聊天室同時處理，同一聊天室依序處理（對話流程與多則回覆不交錯）
+        processor = ChatOrderedUpdateProcessor(concurrent_updates)
+        builder = builder.concurrent_updates(processor)
+    _register_metrics(processor)
+    api_base = (os.getenv("TELEGRAM_API_BASE_URL") or "").strip().rstrip("/")
+    if api_base:
+        # 自架的 Bot API server，或本地測試用的假 Telegram（見 bench_webhook.py）
+        builder = builder.base_url(f"{api_base}/bot").base_file_url(f"{api_base}/file/bot")
+    application = builder.build()
 
     # 設置對話處理器
     conv_handler = ConversationHandler(
@@ -329,6 +717,7 @@ def run_bot(token: str) -> None:
     application.add_handler(CommandHandler("reset", reset))
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("imagine", imagine_command)) # 新增圖片生成指令
+    application.add_handler(MessageHandler(filters.PHOTO, photo_reply))
     application.add_handler(
         MessageHandler(filters.TEXT & ~filters.COMMAND, auto_reply)
     )
@@ -341,10 +730,25 @@ def run_bot(token: str) -> None:
         logger.info("GEMINI_API_KEY 未設定，將使用關鍵字回覆")
     
     try:
-        application.run_polling(
-            allowed_updates=Update.ALL_TYPES,
-            drop_pending_updates=True,  # 啟動時忽略舊訊息
-        )
+        if webhook is None:
+            application.run_polling(
+                allowed_updates=Update.ALL_TYPES,
+                drop_pending_updates=True,  # 啟動時忽略舊訊息
+            )
+        else:
+            logger.info(
+                "以 webhook 模式啟動，監聽 %s:%d/%s", webhook.listen, webhook.port, webhook.url_path
+            )
+            # 多個 worker 共用同一個公開網址，重複 set_webhook 沒有副作用；
+            # 不丟棄待處理的更新，其他 worker 可能仍在服務
+            application.run_webhook(
+                listen=webhook.listen,
+                port=webhook.port,
+                url_path=webhook.url_path,
+                webhook_url=webhook.url,
+                secret_token=webhook.secret_token,
+                allowed_updates=Update.ALL_TYPES,
+            )
     except KeyboardInterrupt:
         logger.info("收到停止訊號，正在關閉機器人...")
     except Exception as e:
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+檢查 ChatOrderedUpdateProcessor 的行為（不連網，不需要 Token）。
+執行：python check_update_processor.py
+會依序檢查：
+  1. 沒有 head-of-line blocking：A 聊天室的慢更新（模擬拍照）不會延遲 B 聊天室的回覆
+  2. 同一聊天室依序處理：交錯送進來的更新，各聊天室內的處理順序與收到順序相同、不重疊
+  3. 並行上限：同時處理的更新數不超過上限，且同一聊天室排隊中的更新不會佔用名額
+  4. 出錯隔離：某則更新拋出例外時，同一聊天室後面排隊的更新仍會處理
+全部通過時結束碼為 0。
+"""
+
+import asyncio
+import logging
+import sys
+import time
+from types import SimpleNamespace
+
+from update_processor import ChatOrderedUpdateProcessor
+
+
+def _update(chat_id: int, seq: int):
+    return SimpleNamespace(effective_chat=SimpleNamespace(id=chat_id), effective_user=None, seq=seq)
+
+
+async def check_no_head_of_line_blocking() -> bool:
+    processor = ChatOrderedUpdateProcessor(limit=4)
+    finished: dict[str, float] = {}
+    started = time.perf_counter()
+
+    async def handle(name: str, seconds: float) -> None:
+        await asyncio.sleep(seconds)
+        finished[name] = time.perf_counter() - started
+
+    tasks = [asyncio.create_task(processor.process_update(_update(1, 0), handle("A 拍照", 1.0)))]
+    # A 在拍照期間又傳了一則，會排在 A 的佇列中
+    tasks.append(asyncio.create_task(processor.process_update(_update(1, 1), handle("A 第二則", 0.01))))
+    for i in range(5):
+        tasks.append(asyncio.create_task(processor.process_update(_update(2 + i, 0), handle(f"用戶{2 + i}", 0.05))))
+    await asyncio.gather(*tasks)
+
+    others = max(t for name, t in finished.items() if name.startswith("用戶"))
+    ok = others < 0.5 and finished["A 第二則"] >= finished["A 拍照"]
+    print(f"  A 拍照完成 {finished['A 拍照']:.2f}s，其他 5 位用戶最晚 {others:.2f}s 完成，A 第二則 {finished['A 第二則']:.2f}s")
+    return ok
+
+
+async def check_per_chat_order() -> bool:
+    processor = ChatOrderedUpdateProcessor(limit=8)
+    processed: dict[int, list[int]] = {}
+    active: dict[int, int] = {}
+    overlap = False
+
+    async def handle(chat_id: int, seq: int) -> None:
+        nonlocal overlap
+        active[chat_id] = active.get(chat_id, 0) + 1
+        overlap |= active[chat_id] > 1
+        # 後送的更新處理得比較快，若沒有依序處理就會先完成
+        await asyncio.sleep(0.02 * (10 - seq) / 10)
+        processed.setdefault(chat_id, []).append(seq)
+        active[chat_id] -= 1
+
+    tasks = []
+    for seq in range(10):
+        for chat_id in range(5):
+            tasks.append(asyncio.create_task(processor.process_update(_update(chat_id, seq), handle(chat_id, seq))))
+    await asyncio.gather(*tasks)
+
+    in_order = all(seqs == list(range(10)) for seqs in processed.values())
+    print(f"  5 個聊天室各 10 則交錯送入：依序={in_order}，同聊天室重疊={overlap}，剩餘佇列={processor.queued_chats()}")
+    return in_order and not overlap and processor.queued_chats() == 0
+
+
+async def check_limit() -> bool:
+    limit = 3
+    processor = ChatOrderedUpdateProcessor(limit=limit)
+    peak = 0
+    running = 0
+
+    async def handle() -> None:
+        nonlocal peak, running
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.05)
+        running -= 1
+
+    started = time.perf_counter()
+    # 聊天室 0 先塞 20 則排隊，再來 6 個不同聊天室
+    tasks = [asyncio.create_task(processor.process_update(_update(0, i), handle())) for i in range(20)]
+    others = [asyncio.create_task(processor.process_update(_update(100 + i, 0), handle())) for i in range(6)]
+    await asyncio.gather(*others)
+    others_done = time.perf_counter() - started
+    await asyncio.gather(*tasks)
+
+    # 6 個其他聊天室加上聊天室 0 的 1 則，在上限 3 之下約 3 輪（~0.15s）就能完成
+    ok = peak <= limit and others_done < 0.5
+    print(f"  上限 {limit}：同時處理最多 {peak} 個，其他聊天室在 {others_done:.2f}s 內完成（聊天室 0 仍有 20 則排隊）")
+    return ok
+
+
+async def check_error_isolation() -> bool:
+    processor = ChatOrderedUpdateProcessor(limit=2)
+    processed: list[int] = []
+
+    async def handle(seq: int) -> None:
+        await asyncio.sleep(0.01)
+        if seq == 1:
+            raise RuntimeError("模擬 handler 錯誤")
+        processed.append(seq)
+
+    logging.getLogger("update_processor").setLevel(logging.CRITICAL)
+    await asyncio.gather(*(processor.process_update(_update(1, seq), handle(seq)) for seq in range(4)))
+    print(f"  第 1 則拋出例外，其餘處理結果：{processed}，剩餘佇列={processor.queued_chats()}")
+    return processed == [0, 2, 3] and processor.queued_chats() == 0
+
+
+async def main_async() -> bool:
+    results = []
+    for title, check in (
+        ("1. 沒有 head-of-line blocking", check_no_head_of_line_blocking),
+        ("2. 同一聊天室依序處理", check_per_chat_order),
+        ("3. 並行上限", check_limit),
+        ("4. 出錯隔離", check_error_isolation),
+    ):
+        print(title)
+        ok = await check()
+        print("  ✓ 通過" if ok else "  ✗ 失敗")
+        results.append(ok)
+    return all(results)
+
+
+def main():
+    ok = asyncio.run(main_async())
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+"""AI provider 的斷路器：每個 provider × 類型（例如 gemini:text、openai:image）各一個。
+
+- closed（正常）：記錄最近 CB_WINDOW 次呼叫；至少 CB_MIN_CALLS 次且失敗率 ≥ CB_ERROR_RATE，
+  或慢呼叫（超過 CB_SLOW_SECONDS）比例 ≥ CB_SLOW_RATE 時跳開。
+- open（斷開）：CB_OPEN_SECONDS 秒內直接拋出 CircuitOpenError，不等 SDK 逾時，呼叫端立即改走備援
+  （OpenAI、圖片快取或 logic.get_reply 的關鍵字回覆）。
+- half-open（試探）：斷開時間到後放行一個試探請求；成功且不慢則恢復 closed，否則再次 open。
+
+慢呼叫只看 provider 來回的時間（呼叫端以 provider_round_trip() 標記），
+不含等待本地並行上限或編碼圖片，本地排隊或 CPU 忙碌不會讓健康的 provider 被斷開。
+
+狀態轉換都會寫入日誌。CIRCUIT_BREAKER=0 時停用（guarded 直接呼叫）。
+"""
+
+import logging
+import os
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager, suppress
+from contextvars import ContextVar
+from typing import AsyncIterator, Awaitable, Callable, Iterator, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+DEFAULT_WINDOW = 20
+DEFAULT_MIN_CALLS = 5
+DEFAULT_ERROR_RATE = 0.5
+DEFAULT_SLOW_SECONDS = 20.0
+DEFAULT_SLOW_RATE = 0.5
+DEFAULT_OPEN_SECONDS = 30.0
+
+
+class CircuitOpenError(RuntimeError):
+    """斷路器為 open，請求未送出。"""
+
+
+class CircuitBreaker:
+    """依失敗率與慢呼叫比例決定是否跳開的斷路器（執行緒安全）。"""
+
+    def __init__(
+        self,
+        name: str,
+        window: int = DEFAULT_WINDOW,
+        min_calls: int = DEFAULT_MIN_CALLS,
+        error_rate: float = DEFAULT_ERROR_RATE,
+        slow_seconds: float = DEFAULT_SLOW_SECONDS,
+        slow_rate: float = DEFAULT_SLOW_RATE,
+        open_seconds: float = DEFAULT_OPEN_SECONDS,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.name = name
+        self.min_calls = max(1, min_calls)
+        self.error_rate = error_rate
+        self.slow_seconds = slow_seconds
+        self.slow_rate = slow_rate
+        self.open_seconds = open_seconds
+        self.clock = clock
+        self._lock = threading.Lock()
+        # 最近的呼叫結果：(失敗, 慢)
+        self._calls: deque[tuple[bool, bool]] = deque(maxlen=max(1, window))
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._probing = False
+        self.counters: Counter = Counter()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._current_state(self.clock())
+
+    def _current_state(self, now: float) -> str:
+        if self._state == OPEN and now - self._opened_at >= self.open_seconds:
+            self._transition(HALF_OPEN, "斷開時間已到，開始試探")
+        return self._state
+
+    def _transition(self, state: str, reason: str) -> None:
+        previous, self._state = self._state, state
+        self.counters[f"to_{state}"] += 1
+        if state == OPEN:
+            self._opened_at = self.clock()
+        if state == CLOSED:
+            self._calls.clear()
+        log = logger.warning if state == OPEN else logger.info
+        log("斷路器 %s：%s -> %s（%s）", self.name, previous, state, reason)
+
+    def allow(self) -> bool:
+        """是否放行這次請求；half-open 時同時只放行一個試探請求。"""
+        with self._lock:
+            state = self._current_state(self.clock())
+            if state == CLOSED:
+                return True
+            if state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            self.counters["rejected"] += 1
+            return False
+
+    def record(self, failed: bool, elapsed: float) -> None:
+        """記錄一次已放行請求的結果。"""
+        slow = elapsed >= self.slow_seconds
+        with self._lock:
+            self.counters["failure" if failed else "success"] += 1
+            if slow:
+                self.counters["slow"] += 1
+            if self._state == HALF_OPEN:
+                self._probing = False
+                if failed or slow:
+                    self._transition(OPEN, "試探請求" + ("失敗" if failed else f"太慢（{elapsed:.1f}s）"))
+                else:
+                    self._transition(CLOSED, "試探請求成功")
+                return
+            if self._state != CLOSED:
+                return
+            self._calls.append((failed, slow))
+            if len(self._calls) < self.min_calls:
+                return
+            failures = sum(1 for f, _ in self._calls if f) / len(self._calls)
+            slows = sum(1 for _, s in self._calls if s) / len(self._calls)
+            if failures >= self.error_rate:
+                self._transition(OPEN, f"失敗率 {failures:.0%}")
+            elif slows >= self.slow_rate:
+                self._transition(OPEN, f"慢呼叫比例 {slows:.0%}")
+
+    def cancelled(self, elapsed: float) -> None:
+        """
+        放行的請求被取消（例如對沖請求的輸家）。已經慢到門檻的算一次慢呼叫，
+        否則不計入結果，只讓 half-open 可以再放行下一個試探。
+        """
+        if elapsed >= self.slow_seconds:
+            self.record(False, elapsed)
+            return
+        with self._lock:
+            self._probing = False
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {**self.counters, "state": self._current_state(self.clock())}
+
+
+class _RoundTrip:
+    """一次 guarded 呼叫中 provider 來回的計時（可能有多段，例如串流或重試）。"""
+
+    __slots__ = ("first_started", "seconds", "active_since")
+
+    def __init__(self):
+        self.first_started: float | None = None
+        self.seconds = 0.0
+        self.active_since: float | None = None
+
+    def begin(self, now: float) -> None:
+        if self.first_started is None:
+            self.first_started = now
+        self.active_since = now
+
+    def end(self, now: float) -> None:
+        if self.active_since is not None:
+            self.seconds += now - self.active_since
+            self.active_since = None
+
+    def elapsed(self, now: float) -> float:
+        """目前累計的來回秒數（含進行中的一段）；還沒送出請求時為 0。"""
+        return self.seconds + (now - self.active_since if self.active_since is not None else 0.0)
+
+    def since_first(self, now: float) -> float:
+        """從第一次送出請求到現在的秒數（串流以此計算第一段文字的延遲）。"""
+        return now - self.first_started if self.first_started is not None else 0.0
+
+
+_round_trip: ContextVar[_RoundTrip | None] = ContextVar("circuit_breaker_round_trip", default=None)
+
+
+@contextmanager
+def provider_round_trip() -> Iterator[None]:
+    """標記一次 provider 來回；所在的 guarded / guarded_stream 以這段時間判斷慢呼叫。"""
+    round_trip = _round_trip.get()
+    if round_trip is None:
+        yield
+        return
+    round_trip.begin(time.perf_counter())
+    try:
+        yield
+    finally:
+        round_trip.end(time.perf_counter())
+
+
+_breakers: dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def breakers_enabled() -> bool:
+    return (os.getenv("CIRCUIT_BREAKER") or "1").strip().lower() not in {"0", "false", "no", "off"}
+
+
+def get_breaker(name: str) -> CircuitBreaker:
+    """取得（或依環境變數建立）指定名稱的斷路器，名稱格式為「provider:類型」。"""
+    with _breakers_lock:
+        breaker = _breakers.get(name)
+        if breaker is None:
+            breaker = CircuitBreaker(
+                name,
+                window=int(os.getenv("CB_WINDOW") or DEFAULT_WINDOW),
+                min_calls=int(os.getenv("CB_MIN_CALLS") or DEFAULT_MIN_CALLS),
+                error_rate=float(os.getenv("CB_ERROR_RATE") or DEFAULT_ERROR_RATE),
+                slow_seconds=float(os.getenv("CB_SLOW_SECONDS") or DEFAULT_SLOW_SECONDS),
+                slow_rate=float(os.getenv("CB_SLOW_RATE") or DEFAULT_SLOW_RATE),
+                open_seconds=float(os.getenv("CB_OPEN_SECONDS") or DEFAULT_OPEN_SECONDS),
+            )
+            _breakers[name] = breaker
+        return breaker
+
+
+def is_open(name: str) -> bool:
+    """斷路器目前是否為 open（不放行）；停用時永遠回傳 False。"""
+    return breakers_enabled() and get_breaker(name).state == OPEN
+
+
+async def guarded(name: str, call: Callable[[], Awaitable[T | None]]) -> T | None:
+    """
+    經過斷路器呼叫 provider：open 時立即拋出 CircuitOpenError。
+    例外與空結果（None / 空字串）都算失敗，例外會照常往上拋。
+    耗時只計 call 中以 provider_round_trip() 標記的部分。
+    """
+    if not breakers_enabled():
+        return await call()
+    breaker = get_breaker(name)
+    if not breaker.allow():
+        raise CircuitOpenError(f"{name} 斷路器為 open")
+    round_trip = _RoundTrip()
+    token = _round_trip.set(round_trip)
+    recorded = False
+    try:
+        result = await call()
+        breaker.record(not result, round_trip.elapsed(time.perf_counter()))
+        recorded = True
+        return result
+    except Exception:
+        breaker.record(True, round_trip.elapsed(time.perf_counter()))
+        recorded = True
+        raise
+    finally:
+        if not recorded:
+            breaker.cancelled(round_trip.elapsed(time.perf_counter()))
+        _round_trip.reset(token)
+
+
+async def guarded_stream(name: str, stream: Callable[[], AsyncIterator[str]]) -> AsyncIterator[str]:
+    """
+    guarded 的串流版本：open 時立即拋出 CircuitOpenError。
+    以送出請求（provider_round_trip 開始）到第一段文字出現的時間判斷慢呼叫，
+    串流中途出錯或完全沒有產出算失敗。
+    """
+    if not breakers_enabled():
+        async for text in stream():
+            yield text
+        return
+    breaker = get_breaker(name)
+    if not breaker.allow():
+        raise CircuitOpenError(f"{name} 斷路器為 open")
+    round_trip = _RoundTrip()
+    token = _round_trip.set(round_trip)
+    first_chunk: float | None = None
+    recorded = False
+    try:
+        async for text in stream():
+            if first_chunk is None:
+                first_chunk = round_trip.since_first(time.perf_counter())
+            yield text
+        breaker.record(first_chunk is None, first_chunk if first_chunk is not None else round_trip.elapsed(time.perf_counter()))
+        recorded = True
+    except Exception:
+        breaker.record(True, round_trip.elapsed(time.perf_counter()))
+        recorded = True
+        raise
+    finally:
+        if not recorded:
+            if first_chunk is not None:
+                # 呼叫端提前停止讀取：已經有產出，視為成功
+                breaker.record(False, first_chunk)
+            else:
+                breaker.cancelled(round_trip.elapsed(time.perf_counter()))
+        # 串流被垃圾回收時可能在別的 context 中關閉，此時無法（也不需要）還原
+        with suppress(ValueError):
+            _round_trip.reset(token)
+
+
+def breaker_stats() -> dict:
+    """回傳各斷路器的狀態與計數。"""
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+    return {breaker.name: breaker.stats() for breaker in breakers}
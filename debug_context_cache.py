@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+離線測試 Gemini context cache 的生命週期，不需要網路或 API Key。
+執行：python debug_context_cache.py
+用 StubCacheProvider 與可手動推進的時鐘，依序檢查：建立、命中、快到期時延長、過期後重建、
+提示太短時停用（記住模型回報的下限，同樣短的其他提示量測後不再呼叫 create）、並行只建立一次、
+超過上限時淘汰、關閉時刪除，以及低於最小 token 數的人設提示完全不呼叫 create。
+"""
+
+import asyncio
+import sys
+
+from ai_reply import GIRLFRIEND_PERSONALITIES
+from gemini_context_cache import ContextCacheManager, StubCacheProvider
+
+MODEL = "gemini-2.0-flash"
+PROMPT = "你現在是一位溫柔、可愛、有點害羞的高中生女朋友。" * 20
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def _check(label: str, ok: bool) -> bool:
+    print(f"    {'✓' if ok else '✗'} {label}")
+    return ok
+
+
+async def run() -> bool:
+    clock = FakeClock()
+    provider = StubCacheProvider(clock=clock, min_tokens=100)
+    # min_tokens=0：先不知道模型的下限，由 create 的錯誤訊息學到
+    manager = ContextCacheManager(
+        provider, ttl=600, refresh_margin=60, retry_after=300, max_entries=4, min_tokens=0, clock=clock
+    )
+    results = []
+
+    print("\n[1] 第一次請求：建立 cache")
+    name = await manager.get_cache_name(MODEL, PROMPT)
+    results.append(_check(f"取得 {name}", name is not None and provider.calls["create"] == 1))
+
+    print("[2] TTL 內再次請求：直接命中")
+    clock.now += 100
+    results.append(_check("沒有額外 API 呼叫", await manager.get_cache_name(MODEL, PROMPT) == name
+                          and provider.calls["create"] == 1 and provider.calls["refresh"] == 0))
+
+    print("[3] 剩餘 TTL 少於 refresh_margin：延長 TTL")
+    clock.now += 480
+    results.append(_check("refresh 一次且名稱不變", await manager.get_cache_name(MODEL, PROMPT) == name
+                          and provider.calls["refresh"] == 1))
+
+    print("[4] 完全過期：重新建立")
+    clock.now += 700
+    new_name = await manager.get_cache_name(MODEL, PROMPT)
+    results.append(_check(f"新 cache {new_name}", new_name not in (None, name) and provider.calls["create"] == 2))
+
+    print("[5] 提示太短：建立失敗，改用 system_instruction")
+    results.append(_check("回傳 None", await manager.get_cache_name(MODEL, "短") is None))
+    results.append(_check("retry_after 內不再重試", await manager.get_cache_name(MODEL, "短") is None
+                          and provider.calls["create"] == 3))
+    results.append(_check("同模型另一個同樣短的提示也不呼叫 create", await manager.get_cache_name(MODEL, "嗯") is None
+                          and provider.calls["create"] == 3))
+
+    print("[6] 並行請求同一提示：只建立一次")
+    await asyncio.gather(*(manager.get_cache_name(MODEL, PROMPT + "!") for _ in range(10)))
+    results.append(_check("create 只增加 1", provider.calls["create"] == 4))
+
+    print("[7] 超過 max_entries：淘汰最久沒用的並刪除其 cache")
+    for i in range(4):
+        await manager.get_cache_name(MODEL, PROMPT + "?" * (i + 1))
+    stats = manager.stats()
+    results.append(_check(f"追蹤 {stats['size']} 份、淘汰 {stats['evictions']} 份",
+                          stats["size"] == 4 and stats["evictions"] == 4 and len(provider.live_caches()) <= 4))
+
+    print("[8] 低於預設最小 token 數的內建人設提示：只量測，不呼叫 create")
+    gated_provider = StubCacheProvider(clock=clock)
+    gated = ContextCacheManager(gated_provider, clock=clock)
+    persona = GIRLFRIEND_PERSONALITIES["highschool"]["prompt"]
+    results.append(_check(f"{len(persona)} 字的人設回傳 None", await gated.get_cache_name(MODEL, persona) is None
+                          and gated_provider.calls["create"] == 0 and gated_provider.calls["count_tokens"] == 1))
+
+    print("[9] 關閉：刪除仍有效的 cache")
+    await manager.aclose()
+    results.append(_check("provider 端沒有有效的 cache", not provider.live_caches()))
+
+    print(f"\n統計: {manager.stats()}  provider 呼叫: {dict(provider.calls)}")
+    return all(results)
+
+
+def main():
+    print("=" * 60)
+    print("Gemini context cache 生命週期（離線）")
+    print("=" * 60)
+    ok = asyncio.run(run())
+    print("\n全部通過。" if ok else "\n有項目失敗，請檢查 gemini_context_cache.py。")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
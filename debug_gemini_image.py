@@ -5,6 +5,7 @@
 會載入 .env、呼叫圖片生成、存檔或印出完整錯誤。
 """
 
+import asyncio
 import os
 import sys
 from pathlib import Path
@@ -35,7 +36,7 @@ def main():
         print("\n[錯誤] 未設定 GEMINI_API_KEY")
         sys.exit(1)
 
-    from ai_image_gen import _gemini_generate_image_sync, GEMINI_IMAGE_DEFAULT_MODEL
+    from ai_image_gen import _gemini_generate_image, GEMINI_IMAGE_DEFAULT_MODEL
     model = (os.getenv("GEMINI_IMAGE_MODEL") or "").strip() or GEMINI_IMAGE_DEFAULT_MODEL
     print(f"\n[1] 使用模型: {model}")
     print("[2] 測試 prompt: 一隻可愛的貓咪")
@@ -43,7 +44,7 @@ def main():
     print("-" * 60)
 
     try:
-        image_bytes = _gemini_generate_image_sync("一隻可愛的貓咪")
+        image_bytes = asyncio.run(_gemini_generate_image("一隻可愛的貓咪"))
         if image_bytes:
             out_path = Path(__file__).resolve().parent / "debug_generated_image.jpg"
             with open(out_path, "wb") as f:
@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+"""Gemini 人設系統提示的 context cache 管理。
+
+每個 (模型, 系統提示) 在 Gemini 端建立一份 cached content，之後的請求只帶 cache 名稱與使用者訊息，
+不必每次重送整段系統提示。呼叫端傳入的是人設模板（名字以佔位文字代替，見 ai_reply），
+同一女友類型的所有用戶共用一份 cache。cache 有 TTL，快到期時自動延長，過期則重建；
+最多追蹤 max_entries 份，超過時淘汰最久沒用到的（並刪除其 cached content）。
+
+Gemini 只快取至少 N 個 token 的內容（依模型而定）。建立前先以 count_tokens 量測，
+低於門檻（GEMINI_CONTEXT_CACHE_MIN_TOKENS，或 create 回報的該模型實際下限）就不建立；
+內建的人設提示只有幾百個 token，通常走這條路，呼叫端改用代入名字的 system_instruction，
+仍可享有 Gemini 對相同前綴的隱式快取。夠長的提示（例如自訂的 AI_SYSTEM_PROMPT）才會真正建立 cache。
+建立或量測失敗時於 retry_after 秒內同樣改用 system_instruction。
+
+GeminiCacheProvider 呼叫真正的 API；StubCacheProvider 不連網，可用來離線測試整個生命週期
+（見 debug_context_cache.py）。
+"""
+
+import asyncio
+import hashlib
+import logging
+import os
+import re
+import time
+from collections import Counter, OrderedDict
+from dataclasses import dataclass
+from typing import Callable
+
+import ai_clients
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TTL = 3600.0  # 秒
+# 剩餘 TTL 少於此值時延長
+DEFAULT_REFRESH_MARGIN = 300.0
+# 建立失敗後，多久之內不再嘗試（改用 system_instruction）
+DEFAULT_RETRY_AFTER = 3600.0
+# 最多追蹤幾份 (模型, 系統提示) 的 cache handle
+DEFAULT_MAX_ENTRIES = 64
+# 可建立 cache 的最少 token 數（各模型不同，取目前模型中最小者；create 回報更高的下限時以回報為準）
+DEFAULT_MIN_TOKENS = 1024
+
+_MIN_TOKENS_PATTERN = re.compile(r"min_total_token_count\D{0,3}(\d+)")
+
+
+def _too_small_minimum(error: Exception) -> int | None:
+    """
+    create 是否因為內容低於最小快取 token 數而失敗（Gemini 回傳
+    "Cached content is too small. total_token_count=..., min_total_token_count=N"）。
+    是的話回傳 N（訊息中沒有時為 0），否則回傳 None。
+    """
+    text = str(error)
+    if "too small" not in text.lower() and "min_total_token_count" not in text:
+        return None
+    match = _MIN_TOKENS_PATTERN.search(text)
+    return int(match.group(1)) if match else 0
+
+
+class GeminiCacheProvider:
+    """透過 google-genai 的 caches API 建立 / 延長 / 刪除 cached content。"""
+
+    def _client(self):
+        api_key = (os.getenv("GEMINI_API_KEY") or "").strip()
+        return ai_clients.get_gemini_client(api_key, workload="text")
+
+    async def create(self, model: str, system_prompt: str, ttl: float) -> str:
+        from google.genai import types
+
+        cache = await self._client().aio.caches.create(
+            model=model,
+            config=types.CreateCachedContentConfig(
+                system_instruction=system_prompt,
+                ttl=f"{int(ttl)}s",
+                display_name="persona-prompt",
+            ),
+        )
+        return cache.name
+
+    async def count_tokens(self, model: str, text: str) -> int:
+        response = await self._client().aio.models.count_tokens(model=model, contents=text)
+        return response.total_token_count
+
+    async def refresh(self, model: str, name: str, ttl: float) -> None:
+        from google.genai import types
+
+        await self._client().aio.caches.update(
+            name=name,
+            config=types.UpdateCachedContentConfig(ttl=f"{int(ttl)}s"),
+        )
+
+    async def delete(self, model: str, name: str) -> None:
+        await self._client().aio.caches.delete(name=name)
+
+
+class StubCacheProvider:
+    """離線用的假 provider：在記憶體中模擬 cached content 與 TTL（以字數當 token 數）。"""
+
+    def __init__(self, clock: Callable[[], float] = time.time, min_tokens: int = 0):
+        self.clock = clock
+        self.min_tokens = min_tokens
+        self.caches: dict[str, float] = {}  # name -> 到期時間
+        self.calls: Counter = Counter()
+
+    def _check_alive(self, name: str) -> None:
+        if self.caches.get(name, 0) <= self.clock():
+            self.caches.pop(name, None)
+            raise LookupError(f"cached content {name} 不存在或已過期")
+
+    def live_caches(self) -> list[str]:
+        """目前尚未過期的 cached content 名稱。"""
+        now = self.clock()
+        return [name for name, expire_at in self.caches.items() if expire_at > now]
+
+    async def create(self, model: str, system_prompt: str, ttl: float) -> str:
+        self.calls["create"] += 1
+        if len(system_prompt) < self.min_tokens:
+            raise ValueError(
+                f"Cached content is too small. total_token_count={len(system_prompt)}, "
+                f"min_total_token_count={self.min_tokens}"
+            )
+        name = f"cachedContents/stub-{self.calls['create']}"
+        self.caches[name] = self.clock() + ttl
+        return name
+
+    async def count_tokens(self, model: str, text: str) -> int:
+        self.calls["count_tokens"] += 1
+        return len(text)
+
+    async def refresh(self, model: str, name: str, ttl: float) -> None:
+        self.calls["refresh"] += 1
+        self._check_alive(name)
+        self.caches[name] = self.clock() + ttl
+
+    async def delete(self, model: str, name: str) -> None:
+        self.calls["delete"] += 1
+        self.caches.pop(name, None)
+
+
+@dataclass
+class _CacheEntry:
+    name: str | None
+    expire_at: float
+    model: str
+
+
+class ContextCacheManager:
+    """依 (模型, 系統提示) 管理 cache handle（LRU）：建立、延長、過期重建、失敗時暫時停用。"""
+
+    def __init__(
+        self,
+        provider,
+        ttl: float = DEFAULT_TTL,
+        refresh_margin: float = DEFAULT_REFRESH_MARGIN,
+        retry_after: float = DEFAULT_RETRY_AFTER,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+        min_tokens: int = DEFAULT_MIN_TOKENS,
+        clock: Callable[[], float] = time.time,
+    ):
+        self.provider = provider
+        self.ttl = ttl
+        self.refresh_margin = refresh_margin
+        self.retry_after = retry_after
+        self.max_entries = max(1, max_entries)
+        self.min_tokens = min_tokens
+        self.clock = clock
+        # key -> handle，依最後使用時間排序
+        self._entries: OrderedDict[str, _CacheEntry] = OrderedDict()
+        self._locks: OrderedDict[str, asyncio.Lock] = OrderedDict()
+        # 模型 -> create 回報的最小快取 token 數（高於 min_tokens 時才記）
+        self._model_min_tokens: dict[str, int] = {}
+        self.counters: Counter = Counter()
+
+    @staticmethod
+    def _key(model: str, system_prompt: str) -> str:
+        return hashlib.sha256(f"{model}\0{system_prompt}".encode("utf-8")).hexdigest()
+
+    async def get_cache_name(self, model: str, system_prompt: str) -> str | None:
+        """回傳可用的 cached content 名稱；目前無法使用 cache 時回傳 None。"""
+        key = self._key(model, system_prompt)
+        entry = self._entries.get(key)
+        if entry is not None and entry.expire_at - self.clock() > self.refresh_margin:
+            self._entries.move_to_end(key)
+            self.counters["hit" if entry.name else "disabled"] += 1
+            return entry.name
+
+        lock = self._lock_for(key)
+        async with lock:
+            now = self.clock()
+            entry = self._entries.get(key)
+            if entry is not None and entry.expire_at - now > self.refresh_margin:
+                self.counters["hit" if entry.name else "disabled"] += 1
+                return entry.name
+            if entry is not None and entry.name and entry.expire_at > now:
+                try:
+                    await self.provider.refresh(model, entry.name, self.ttl)
+                    entry.expire_at = now + self.ttl
+                    self.counters["refresh"] += 1
+                    return entry.name
+                except Exception as e:
+                    logger.info("延長 context cache 失敗，改為重新建立: %s", e)
+            try:
+                tokens = await self.provider.count_tokens(model, system_prompt)
+            except Exception as e:
+                logger.info("無法計算系統提示的 token 數（%s），%d 秒內改用 system_instruction", e, self.retry_after)
+                await self._store(key, _CacheEntry(None, now + self.retry_after, model))
+                self.counters["count_failed"] += 1
+                return None
+            minimum = self._model_min_tokens.get(model, self.min_tokens)
+            if tokens < minimum:
+                # 低於模型的最小快取 token 數，呼叫 create 也只會失敗
+                logger.info("系統提示只有 %d 個 token（%s 至少要 %d），不建立 context cache", tokens, model, minimum)
+                await self._store(key, _CacheEntry(None, now + self.retry_after, model))
+                self.counters["too_small"] += 1
+                return None
+            try:
+                name = await self.provider.create(model, system_prompt, self.ttl)
+            except Exception as e:
+                reported = _too_small_minimum(e)
+                if reported is not None:
+                    # 記住該模型實際的下限，之後同樣短的提示量測後就不再呼叫 create
+                    self._model_min_tokens[model] = max(reported, tokens + 1, minimum)
+                    self.counters["too_small"] += 1
+                else:
+                    self.counters["create_failed"] += 1
+                logger.info("無法建立 context cache（%s），%d 秒內改用 system_instruction", e, self.retry_after)
+                await self._store(key, _CacheEntry(None, now + self.retry_after, model))
+                return None
+            await self._store(key, _CacheEntry(name, now + self.ttl, model))
+            self.counters["create"] += 1
+            return name
+
+    def _lock_for(self, key: str) -> asyncio.Lock:
+        """取得 key 的建立鎖；鎖的數量超過上限時丟掉最久沒用且未被持有的。"""
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+            for old_key in list(self._locks):
+                if len(self._locks) <= self.max_entries:
+                    break
+                if old_key != key and not self._locks[old_key].locked():
+                    del self._locks[old_key]
+        else:
+            self._locks.move_to_end(key)
+        return lock
+
+    async def _store(self, key: str, entry: _CacheEntry) -> None:
+        """存入 handle，超過上限時淘汰最久沒用到的，並刪除其仍有效的 cached content。"""
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        evicted = []
+        while len(self._entries) > self.max_entries:
+            _, old = self._entries.popitem(last=False)
+            evicted.append(old)
+            self.counters["evictions"] += 1
+        for old in evicted:
+            await self._delete(old)
+
+    async def _delete(self, entry: _CacheEntry) -> None:
+        if entry.name and entry.expire_at > self.clock():
+            try:
+                await self.provider.delete(entry.model, entry.name)
+            except Exception as e:
+                logger.debug("刪除 context cache 失敗: %s", e)
+
+    async def aclose(self) -> None:
+        """刪除所有仍有效的 cached content。"""
+        entries, self._entries = self._entries, OrderedDict()
+        for entry in entries.values():
+            await self._delete(entry)
+
+    def stats(self) -> dict:
+        return {
+            **self.counters,
+            "active": sum(1 for e in self._entries.values() if e.name and e.expire_at > self.clock()),
+            "size": len(self._entries),
+        }
+
+
+_manager: ContextCacheManager | None = None
+
+
+def get_context_cache() -> ContextCacheManager | None:
+    """取得 Gemini context cache 管理器；GEMINI_CONTEXT_CACHE=0 時回傳 None（停用）。"""
+    global _manager
+    if (os.getenv("GEMINI_CONTEXT_CACHE") or "1").strip().lower() in {"0", "false", "no", "off"}:
+        return None
+    if _manager is None:
+        ttl = float(os.getenv("GEMINI_CONTEXT_CACHE_TTL") or DEFAULT_TTL)
+        _manager = ContextCacheManager(
+            GeminiCacheProvider(),
+            ttl=ttl,
+            refresh_margin=min(DEFAULT_REFRESH_MARGIN, ttl / 4),
+            min_tokens=int(os.getenv("GEMINI_CONTEXT_CACHE_MIN_TOKENS") or DEFAULT_MIN_TOKENS),
+        )
+    return _manager
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""對沖請求（hedged request）：主要 provider 太慢時，同時向備援 provider 發出請求，先拿到好答案的勝出。
+
+等待多久才對沖是自適應的：取主要 provider 最近耗時的第 AI_HEDGE_PERCENTILE 百分位（預設 p90），
+限制在 [AI_HEDGE_MIN_DELAY, AI_HEDGE_MAX_DELAY] 之間；樣本不足時使用 AI_HEDGE_DEFAULT_DELAY。
+如此大約只有 10% 的請求會多打一次備援，卻能截掉主要 provider 最慢的尾巴。
+主要 provider 提早失敗（例外或空回覆）時立即改打備援，不必等到延遲時間。
+"""
+
+import asyncio
+import logging
+import os
+import time
+from collections import Counter
+from typing import Awaitable, Callable, TypeVar
+
+from latency import LatencyWindow
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+DEFAULT_PERCENTILE = 90.0
+DEFAULT_MIN_DELAY = 0.5
+DEFAULT_MAX_DELAY = 10.0
+DEFAULT_DELAY = 3.0
+# 主要 provider 至少累積這麼多筆耗時，才改用百分位數決定延遲
+MIN_SAMPLES = 20
+
+
+class Hedger:
+    """主要 / 備援兩個 provider 之間的對沖策略，記錄對沖率與延遲分布。"""
+
+    def __init__(
+        self,
+        name: str,
+        percentile: float = DEFAULT_PERCENTILE,
+        min_delay: float = DEFAULT_MIN_DELAY,
+        max_delay: float = DEFAULT_MAX_DELAY,
+        default_delay: float = DEFAULT_DELAY,
+        clock: Callable[[], float] = time.perf_counter,
+    ):
+        self.name = name
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.default_delay = default_delay
+        self.clock = clock
+        # 主要 provider 的耗時（被取消的以取消時的耗時記錄，為實際耗時的下限）
+        self.primary_latency = LatencyWindow()
+        # 對沖後實際回覆的耗時
+        self.latency = LatencyWindow()
+        self.counters: Counter = Counter()
+
+    def delay(self) -> float:
+        """目前的對沖延遲（秒）。"""
+        if self.primary_latency.count < MIN_SAMPLES:
+            delay = self.default_delay
+        else:
+            delay = self.primary_latency.percentile(self.percentile) or self.default_delay
+        return min(self.max_delay, max(self.min_delay, delay))
+
+    @staticmethod
+    def _result(task: asyncio.Task, label: str):
+        """取出已完成 task 的結果；例外視為沒有結果。"""
+        try:
+            return task.result()
+        except asyncio.CancelledError:
+            return None
+        except Exception as e:
+            logger.warning("%s 請求失敗: %s", label, e)
+            return None
+
+    async def run(
+        self,
+        primary: Callable[[], Awaitable[T | None]],
+        backup: Callable[[], Awaitable[T | None]],
+    ) -> T | None:
+        """執行主要請求，必要時對沖備援請求；回傳先到的有效結果，都失敗時回傳 None。"""
+        self.counters["requests"] += 1
+        started = self.clock()
+        primary_task = asyncio.create_task(primary())
+        backup_task: asyncio.Task | None = None
+        pending = {primary_task}
+        try:
+            done, pending = await asyncio.wait(pending, timeout=self.delay())
+            if not done:
+                self.counters["hedged"] += 1
+            while True:
+                for task in done:
+                    is_primary = task is primary_task
+                    result = self._result(task, "主要" if is_primary else "備援")
+                    if result:
+                        elapsed = self.clock() - started
+                        if is_primary:
+                            self.primary_latency.record(elapsed)
+                        self.counters["primary_won" if is_primary else "backup_won"] += 1
+                        self.latency.record(elapsed)
+                        return result
+                    if is_primary:
+                        self.counters["primary_failed"] += 1
+                if backup_task is None:
+                    # 主要請求太慢或已失敗：開始備援請求
+                    if primary_task.done():
+                        self.counters["failover"] += 1
+                    backup_task = asyncio.create_task(backup())
+                    pending = pending | {backup_task}
+                if not pending:
+                    self.counters["all_failed"] += 1
+                    return None
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in pending:
+                task.cancel()
+                if task is primary_task:
+                    self.primary_latency.record(self.clock() - started)
+
+    def stats(self) -> dict:
+        requests = self.counters["requests"]
+        return {
+            **self.counters,
+            "hedge_rate": (self.counters["hedged"] / requests) if requests else 0.0,
+            "delay": self.delay(),
+            "primary_latency": self.primary_latency.snapshot(),
+            "hedged_latency": self.latency.snapshot(),
+        }
+
+
+def hedging_enabled() -> bool:
+    return (os.getenv("AI_HEDGING") or "0").strip().lower() in {"1", "true", "yes", "on"}
+
+
+_hedgers: dict[str, Hedger] = {}
+
+
+def get_hedger(name: str) -> Hedger:
+    """取得（或依環境變數建立）指定名稱的對沖策略。"""
+    hedger = _hedgers.get(name)
+    if hedger is None:
+        hedger = Hedger(
+            name,
+            percentile=float(os.getenv("AI_HEDGE_PERCENTILE") or DEFAULT_PERCENTILE),
+            min_delay=float(os.getenv("AI_HEDGE_MIN_DELAY") or DEFAULT_MIN_DELAY),
+            max_delay=float(os.getenv("AI_HEDGE_MAX_DELAY") or DEFAULT_MAX_DELAY),
+            default_delay=float(os.getenv("AI_HEDGE_DEFAULT_DELAY") or DEFAULT_DELAY),
+        )
+        _hedgers[name] = hedger
+    return hedger
+
+
+def hedging_stats() -> dict:
+    """回傳各對沖策略的統計（對沖率、主要 provider 與對沖後的延遲百分位數）。"""
+    return {name: hedger.stats() for name, hedger in _hedgers.items()}
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""生成圖片的磁碟快取：以圖片 prompt 的雜湊為 key，每個 key 保留多張不同的圖（variant）。
+
+目錄結構：<IMAGE_CACHE_DIR>/<key 前兩碼>/<key>/<圖片內容 sha256>.jpg
+每個 key 最多保留 IMAGE_CACHE_VARIANTS 張，總大小超過 IMAGE_CACHE_MAX_MB 時淘汰最久沒用到的圖。
+最後使用時間記錄在檔案 mtime，重啟後仍能依 LRU 淘汰。
+"""
+
+import hashlib
+import logging
+import os
+import random
+import threading
+import time
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_DIR = Path(__file__).parent / ".image_cache"
+DEFAULT_VARIANTS = 3
+DEFAULT_MAX_MB = 200
+
+
+def prompt_key(prompt: str) -> str:
+    """prompt 的內容雜湊（快取 key）。"""
+    return hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+
+
+class ImageCache:
+    """以 prompt 為 key、可保留多個 variant 的圖片快取（執行緒安全，檔案 I/O 為同步）。"""
+
+    def __init__(self, root: Path, variants: int = DEFAULT_VARIANTS, max_bytes: int = DEFAULT_MAX_MB * 1024 * 1024):
+        self.root = Path(root)
+        self.variants = max(1, variants)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # key -> {path: (size, last_used)}
+        self._index: dict[str, dict[Path, tuple[int, float]]] | None = None
+        self._total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _key_dir(self, key: str) -> Path:
+        return self.root / key[:2] / key
+
+    def _load_index(self) -> dict[str, dict[Path, tuple[int, float]]]:
+        """第一次使用時掃描快取目錄建立索引。"""
+        if self._index is not None:
+            return self._index
+        index: dict[str, dict[Path, tuple[int, float]]] = {}
+        total = 0
+        if self.root.exists():
+            for path in self.root.glob("*/*/*.jpg"):
+                try:
+                    st = path.stat()
+                except FileNotFoundError:
+                    continue
+                index.setdefault(path.parent.name, {})[path] = (st.st_size, st.st_mtime)
+                total += st.st_size
+        self._index, self._total_bytes = index, total
+        return index
+
+    def variant_count(self, prompt: str) -> int:
+        with self._lock:
+            return len(self._load_index().get(prompt_key(prompt), {}))
+
+    def needs_fill(self, prompt: str) -> bool:
+        """此 prompt 的 variant 是否還沒存滿。"""
+        return self.variant_count(prompt) < self.variants
+
+    def get(self, prompt: str) -> bytes | None:
+        """隨機取一張已快取的圖，沒有時回傳 None。"""
+        key = prompt_key(prompt)
+        with self._lock:
+            entries = self._load_index().get(key)
+            if not entries:
+                self.misses += 1
+                return None
+            path = random.choice(list(entries))
+            try:
+                data = path.read_bytes()
+            except FileNotFoundError:
+                self._forget(key, path)
+                self.misses += 1
+                return None
+            now = time.time()
+            entries[path] = (entries[path][0], now)
+            try:
+                os.utime(path, (now, now))
+            except OSError:
+                pass
+            self.hits += 1
+            return data
+
+    def put(self, prompt: str, data: bytes) -> Path:
+        """存入一張圖（內容相同的圖只存一份），必要時淘汰舊圖。"""
+        key = prompt_key(prompt)
+        key_dir = self._key_dir(key)
+        path = key_dir / f"{hashlib.sha256(data).hexdigest()}.jpg"
+        with self._lock:
+            index = self._load_index()
+            entries = index.setdefault(key, {})
+            now = time.time()
+            if path not in entries:
+                key_dir.mkdir(parents=True, exist_ok=True)
+                tmp_path = path.with_suffix(".tmp")
+                tmp_path.write_bytes(data)
+                os.replace(tmp_path, path)
+                self._total_bytes += len(data)
+            entries[path] = (len(data), now)
+            # 同一個 key 超過 variant 上限時，淘汰最久沒用到的
+            while len(entries) > self.variants:
+                oldest = min(entries, key=lambda p: entries[p][1])
+                self._evict(key, oldest)
+            self._enforce_size()
+        return path
+
+    def _forget(self, key: str, path: Path) -> None:
+        entries = self._index.get(key, {})
+        size, _ = entries.pop(path, (0, 0.0))
+        self._total_bytes -= size
+        if not entries:
+            self._index.pop(key, None)
+
+    def _evict(self, key: str, path: Path) -> None:
+        self._forget(key, path)
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            pass
+        self.evictions += 1
+
+    def _enforce_size(self) -> None:
+        if self._total_bytes <= self.max_bytes:
+            return
+        candidates = sorted(
+            ((last_used, key, path) for key, entries in self._index.items() for path, (_, last_used) in entries.items()),
+        )
+        for _, key, path in candidates:
+            if self._total_bytes <= self.max_bytes:
+                break
+            self._evict(key, path)
+
+    def stats(self) -> dict:
+        with self._lock:
+            index = self._load_index()
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits / total) if total else 0.0,
+                "keys": len(index),
+                "images": sum(len(entries) for entries in index.values()),
+                "bytes": self._total_bytes,
+                "evictions": self.evictions,
+            }
+
+
+_cache: ImageCache | None = None
+
+
+def get_image_cache() -> ImageCache | None:
+    """取得全域圖片快取；IMAGE_CACHE=0 時回傳 None（停用）。"""
+    global _cache
+    if (os.getenv("IMAGE_CACHE") or "1").strip().lower() in {"0", "false", "no", "off"}:
+        return None
+    if _cache is None:
+        root = (os.getenv("IMAGE_CACHE_DIR") or "").strip() or DEFAULT_CACHE_DIR
+        variants = int(os.getenv("IMAGE_CACHE_VARIANTS") or DEFAULT_VARIANTS)
+        max_mb = float(os.getenv("IMAGE_CACHE_MAX_MB") or DEFAULT_MAX_MB)
+        _cache = ImageCache(Path(root), variants=variants, max_bytes=int(max_mb * 1024 * 1024))
+    return _cache
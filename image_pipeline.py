@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+"""生成圖片的後處理：統一轉成 Telegram 用的 JPEG，最多解碼一次，並在獨立的行程池中執行。
+
+- 輸出以「最長邊 IMAGE_MAX_EDGE、檔案大小 IMAGE_MAX_KB」為目標：Telegram 顯示照片時最長邊只到 1280，
+  更大的圖只會拖慢上傳。超過最長邊時縮圖（JPEG 以 draft 在解碼時直接縮小），
+  再以 progressive + optimize 編碼，並二分搜尋出不超過大小上限的最高品質。
+- provider 已回傳符合上述目標的 JPEG 時直接使用原始 bytes，不解碼也不重新編碼。
+- Pillow 的工作是 CPU 密集且會持有 GIL，所以放在 ProcessPoolExecutor（預設大小為 CPU 核心數，
+  IMAGE_WORKERS 可調；IMAGE_WORKERS=0 時改用執行緒），不阻塞 event loop。
+- 每個階段（decode / encode）在 worker 內以 process_time 量 CPU 時間，累計在 stats()。
+- 用戶傳來給 vision 模型看的照片也走同一個 worker 池（prepare_vision）：縮到最長邊 VISION_MAX_EDGE
+  （預設 768，Gemini 以 768×768 為一個 tile 計費，更大只會多付 token 與上傳時間），已夠小的 JPEG 直接沿用，並順便計算 dHash 供 vision_cache 使用。
+"""
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Executor, ProcessPoolExecutor
+
+from metrics import STAGE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+JPEG_MAGIC = b"\xff\xd8\xff"
+DEFAULT_MAX_EDGE = 1280
+DEFAULT_MAX_KB = 300
+DEFAULT_JPEG_QUALITY = 90
+MIN_JPEG_QUALITY = 40
+DEFAULT_VISION_MAX_EDGE = 768
+DEFAULT_VISION_QUALITY = 85
+
+
+def is_jpeg(data: bytes) -> bool:
+    return data[:3] == JPEG_MAGIC
+
+
+def _encode_jpeg(img, quality: int) -> bytes:
+    from io import BytesIO
+
+    output = BytesIO()
+    img.save(output, format="JPEG", quality=quality, optimize=True, progressive=True)
+    return output.getvalue()
+
+
+def _encode_photo(
+    data: bytes,
+    max_edge: int = DEFAULT_MAX_EDGE,
+    max_bytes: int = DEFAULT_MAX_KB * 1024,
+    quality: int = DEFAULT_JPEG_QUALITY,
+) -> tuple[bytes, dict[str, float], int | None]:
+    """
+    把圖片編碼成符合最長邊 / 大小上限的 JPEG，於 worker 行程中執行。
+    回傳 (JPEG bytes, 各階段 CPU 秒數, 使用的品質；原圖直接沿用時為 None)。
+    max_edge / max_bytes 為 0 表示不限制。
+    """
+    from io import BytesIO
+
+    from PIL import Image
+
+    timings: dict[str, float] = {}
+    started = time.process_time()
+    img = Image.open(BytesIO(data))  # 只讀檔頭，尚未解碼像素
+    too_large = bool(max_edge) and max(img.size) > max_edge
+    if img.format == "JPEG" and not too_large and (not max_bytes or len(data) <= max_bytes):
+        timings["probe"] = time.process_time() - started
+        return data, timings, None
+    if too_large and img.format == "JPEG":
+        # JPEG 可在解碼時以 DCT 直接縮小（1/2、1/4、1/8），比解完整張再縮快很多
+        img.draft("RGB", (max_edge, max_edge))
+    img.load()
+    if img.mode != "RGB":
+        # JPEG 沒有透明通道；RGBA / P 等模式需先轉換
+        img = img.convert("RGB")
+    timings["decode"] = time.process_time() - started
+
+    if max_edge and max(img.size) > max_edge:
+        started = time.process_time()
+        img.thumbnail((max_edge, max_edge), Image.LANCZOS)
+        timings["resize"] = time.process_time() - started
+
+    started = time.process_time()
+    output = _encode_jpeg(img, quality)
+    used = quality
+    if max_bytes and len(output) > max_bytes:
+        # 二分搜尋不超過大小上限的最高品質；都超過時使用最低品質
+        low, high = MIN_JPEG_QUALITY, quality - 1
+        best = None
+        while low <= high:
+            mid = (low + high) // 2
+            candidate = _encode_jpeg(img, mid)
+            if len(candidate) <= max_bytes:
+                best, used, low = candidate, mid, mid + 1
+            else:
+                high = mid - 1
+        if best is None:
+            best, used = _encode_jpeg(img, MIN_JPEG_QUALITY), MIN_JPEG_QUALITY
+        output = best
+    timings["encode"] = time.process_time() - started
+    return output, timings, used
+
+
+def _prepare_vision(data: bytes, max_edge: int, quality: int) -> tuple[bytes, dict[str, float], int | None, int]:
+    """_encode_photo 之後順便在同一個 worker 計算縮圖後的 dHash（供 vision_cache 比對近似圖）。"""
+    from vision_cache import dhash
+
+    output, timings, used = _encode_photo(data, max_edge, 0, quality)
+    started = time.process_time()
+    image_hash = dhash(output)
+    timings["hash"] = time.process_time() - started
+    return output, timings, used, image_hash
+
+
+class ImagePipeline:
+    """圖片後處理階段：管理 worker 池並累計各階段 CPU 時間。"""
+
+    def __init__(
+        self,
+        workers: int | None = None,
+        max_edge: int = DEFAULT_MAX_EDGE,
+        max_bytes: int = DEFAULT_MAX_KB * 1024,
+        quality: int = DEFAULT_JPEG_QUALITY,
+        vision_max_edge: int = DEFAULT_VISION_MAX_EDGE,
+        vision_quality: int = DEFAULT_VISION_QUALITY,
+    ):
+        # None：依 CPU 核心數；0：不開行程池，改用執行緒
+        self.workers = (os.cpu_count() or 1) if workers is None else workers
+        self.max_edge = max_edge
+        self.max_bytes = max_bytes
+        self.quality = quality
+        self.vision_max_edge = vision_max_edge
+        self.vision_quality = vision_quality
+        self._executor: Executor | None = None
+        self._lock = threading.Lock()
+        self.cpu_seconds: Counter = Counter()
+        self.counters: Counter = Counter()
+        self.wall_seconds = 0.0
+
+    def _get_executor(self) -> Executor | None:
+        if self.workers <= 0:
+            return None
+        with self._lock:
+            if self._executor is None:
+                # spawn：bot 行程中已有執行緒（HTTP 連線池等），fork 不安全
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+            return self._executor
+
+    async def _run(self, func, *args):
+        executor = self._get_executor()
+        if executor is None:
+            return await asyncio.to_thread(func, *args)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, func, *args)
+
+    async def encode_photo(self, data: bytes) -> bytes:
+        """編碼成符合最長邊 / 大小上限的 JPEG（不限尺寸且已是夠小的 JPEG 時直接回傳，不經過 worker）。"""
+        if is_jpeg(data) and not self.max_edge and (not self.max_bytes or len(data) <= self.max_bytes):
+            self.counters["passthrough"] += 1
+            return data
+        started = time.perf_counter()
+        output, timings, quality = await self._run(_encode_photo, data, self.max_edge, self.max_bytes, self.quality)
+        wall = time.perf_counter() - started
+        STAGE_SECONDS.observe(wall, "image_postprocess")
+        self.counters["passthrough" if quality is None else "converted"] += 1
+        self.counters["bytes_in"] += len(data)
+        self.counters["bytes_out"] += len(output)
+        self.cpu_seconds.update(timings)
+        self.wall_seconds += wall
+        logger.info(
+            "圖片編碼：%d -> %d bytes（省下 %d bytes，品質 %s），CPU %s，總耗時 %.0fms",
+            len(data), len(output), len(data) - len(output), quality or "原圖",
+            " ".join(f"{stage}={seconds * 1000:.0f}ms" for stage, seconds in timings.items()),
+            wall * 1000,
+        )
+        return output
+
+    async def prepare_vision(self, data: bytes | bytearray) -> tuple[bytes, int]:
+        """
+        把用戶傳來的照片縮到 vision 模型實際用得到的解析度（最長邊 vision_max_edge），
+        已經夠小的 JPEG 直接沿用。回傳 (JPEG bytes, dHash)。統計以 vision_ 開頭，與生成圖片的後處理分開。
+        """
+        started = time.perf_counter()
+        output, timings, quality, image_hash = await self._run(
+            _prepare_vision, data, self.vision_max_edge, self.vision_quality
+        )
+        wall = time.perf_counter() - started
+        STAGE_SECONDS.observe(wall, "vision_preprocess")
+        self.counters["vision_passthrough" if quality is None else "vision_converted"] += 1
+        self.counters["vision_bytes_in"] += len(data)
+        self.counters["vision_bytes_out"] += len(output)
+        self.cpu_seconds.update({f"vision_{stage}": seconds for stage, seconds in timings.items()})
+        self.wall_seconds += wall
+        logger.info(
+            "照片縮圖（vision）：%d -> %d bytes（品質 %s），總耗時 %.0fms",
+            len(data), len(output), quality or "原圖", wall * 1000,
+        )
+        return bytes(output), image_hash
+
+    def shutdown(self) -> None:
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> dict:
+        return {
+            **self.counters,
+            "bytes_saved": self.counters["bytes_in"] - self.counters["bytes_out"],
+            "vision_bytes_saved": self.counters["vision_bytes_in"] - self.counters["vision_bytes_out"],
+            "workers": self.workers,
+            "cpu_seconds": dict(self.cpu_seconds),
+            "wall_seconds": self.wall_seconds,
+        }
+
+
+_pipeline: ImagePipeline | None = None
+
+
+def get_image_pipeline() -> ImagePipeline:
+    """取得全域圖片後處理階段（IMAGE_WORKERS 可指定行程數，0 為改用執行緒）。"""
+    global _pipeline
+    if _pipeline is None:
+        workers = (os.getenv("IMAGE_WORKERS") or "").strip()
+        _pipeline = ImagePipeline(
+            int(workers) if workers else None,
+            max_edge=int(os.getenv("IMAGE_MAX_EDGE") or DEFAULT_MAX_EDGE),
+            max_bytes=int(float(os.getenv("IMAGE_MAX_KB") or DEFAULT_MAX_KB) * 1024),
+            quality=int(os.getenv("IMAGE_JPEG_QUALITY") or DEFAULT_JPEG_QUALITY),
+            vision_max_edge=int(os.getenv("VISION_MAX_EDGE") or DEFAULT_VISION_MAX_EDGE),
+            vision_quality=int(os.getenv("VISION_JPEG_QUALITY") or DEFAULT_VISION_QUALITY),
+        )
+    return _pipeline
@@ -0,0 +1,406 @@
+#!/usr/bin/env python3
+"""熱門拍照觸發圖片的背景預先生成。
+
+TriggerStats 依 (女友類型, 關鍵字) 記錄被觸發的次數與「一天中哪個小時」被觸發，
+次數隨時間半衰（PREGEN_HALF_LIFE_DAYS），並定期寫入 JSON 檔，重啟後仍保留。
+
+PregenScheduler 在機器人閒置（PREGEN_IDLE_SECONDS 秒內沒有觸發）時，找出接下來
+PREGEN_LOOKAHEAD_HOURS 小時內最常被觸發的組合（例如早上前的「早安」、晚上前的「晚安」），
+替快取還沒存滿、或最後一次預先生成已超過 PREGEN_MAX_AGE_HOURS 的 prompt 先生成圖片，
+尖峰時用戶就能直接拿到快取。每天最多呼叫 provider PREGEN_DAILY_BUDGET 次，
+同時最多 PREGEN_CONCURRENCY 張。IMAGE_PREGEN=1 時啟用（預設關閉）。
+
+預算以實際的 provider 呼叫計算：ai_image_gen._generate_image 每次要呼叫 provider 前
+呼叫 reserve_provider_call()（Gemini 失敗改打 DALL-E 算兩次），
+與進行中的即時生成合併（single-flight 的 follower）則不會呼叫 provider，也不扣預算。
+"""
+
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+from collections import Counter
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Awaitable, Callable, Iterable
+
+from image_cache import ImageCache, prompt_key
+
+logger = logging.getLogger(__name__)
+
+STATS_FILENAME = "trigger_stats.json"
+
+DEFAULT_HALF_LIFE_DAYS = 7.0
+DEFAULT_DAILY_BUDGET = 50
+DEFAULT_CONCURRENCY = 1
+DEFAULT_IDLE_SECONDS = 60.0
+DEFAULT_INTERVAL = 300.0
+DEFAULT_LOOKAHEAD_HOURS = 2
+DEFAULT_TOP_N = 10
+# 近期（半衰後）至少被觸發這麼多次才算熱門
+DEFAULT_MIN_REQUESTS = 3.0
+DEFAULT_MAX_AGE_HOURS = 24.0
+
+# JSON 裡代表「沒有女友類型」（沒有 user_id）的 key
+_NO_PERSONA = ""
+
+
+def _local_hour(ts: float) -> int:
+    return time.localtime(ts).tm_hour
+
+
+def _local_day(ts: float) -> str:
+    return time.strftime("%Y-%m-%d", time.localtime(ts))
+
+
+class TriggerStats:
+    """(女友類型, 關鍵字) 的觸發次數統計：每組保留 24 個小時桶，次數依半衰期衰減（執行緒安全）。"""
+
+    def __init__(
+        self,
+        path: Path | None = None,
+        half_life_days: float = DEFAULT_HALF_LIFE_DAYS,
+        clock: Callable[[], float] = time.time,
+    ):
+        self.path = Path(path) if path else None
+        self.half_life = max(1.0, half_life_days * 86400)
+        self.clock = clock
+        self._lock = threading.Lock()
+        # (persona, keyword) -> [最後衰減時間, 24 個小時桶]
+        self._entries: dict[tuple[str, str], list] = {}
+        # prompt key -> 最後一次預先生成的時間
+        self.generated_at: dict[str, float] = {}
+        # 預算使用量：(日期, 已呼叫次數)
+        self.budget_day = ""
+        self.budget_used = 0
+        self.last_activity = 0.0
+        self._dirty = False
+        if self.path is not None:
+            self.load()
+
+    def _decay(self, entry: list, now: float) -> list[float]:
+        elapsed = now - entry[0]
+        if elapsed > 0:
+            factor = 0.5 ** (elapsed / self.half_life)
+            entry[1] = [count * factor for count in entry[1]]
+            entry[0] = now
+        return entry[1]
+
+    def record(self, persona: str | None, keyword: str) -> None:
+        """記錄一次觸發。"""
+        now = self.clock()
+        with self._lock:
+            entry = self._entries.setdefault((persona or _NO_PERSONA, keyword), [now, [0.0] * 24])
+            self._decay(entry, now)[_local_hour(now)] += 1
+            self.last_activity = now
+            self._dirty = True
+
+    def top(self, hours: Iterable[int], min_count: float = 0.0, limit: int | None = None) -> list[tuple[float, str | None, str]]:
+        """回傳在指定小時內觸發次數最多的 (次數, 女友類型, 關鍵字)，由多到少排序。"""
+        hours = list(hours)
+        now = self.clock()
+        ranked = []
+        with self._lock:
+            for (persona, keyword), entry in self._entries.items():
+                buckets = self._decay(entry, now)
+                score = sum(buckets[h % 24] for h in hours)
+                if score >= min_count and score > 0:
+                    ranked.append((score, persona or None, keyword))
+        ranked.sort(key=lambda item: item[0], reverse=True)
+        return ranked[:limit] if limit is not None else ranked
+
+    def budget_remaining(self, daily_budget: int) -> int:
+        with self._lock:
+            if self.budget_day != _local_day(self.clock()):
+                return daily_budget
+            return max(0, daily_budget - self.budget_used)
+
+    def try_charge(self, daily_budget: int) -> bool:
+        """預算還有剩時記一次 provider 呼叫並回傳 True（跨日時歸零）。"""
+        with self._lock:
+            today = _local_day(self.clock())
+            if self.budget_day != today:
+                self.budget_day, self.budget_used = today, 0
+            if self.budget_used >= daily_budget:
+                return False
+            self.budget_used += 1
+            self._dirty = True
+            return True
+
+    def refund(self) -> None:
+        """退還一次已記下、但最後沒有呼叫 provider 的預算。"""
+        with self._lock:
+            if self.budget_used > 0:
+                self.budget_used -= 1
+                self._dirty = True
+
+    def mark_generated(self, prompt: str, ts: float | None = None) -> None:
+        with self._lock:
+            self.generated_at[prompt_key(prompt)] = self.clock() if ts is None else ts
+            self._dirty = True
+
+    def last_generated(self, prompt: str) -> float | None:
+        with self._lock:
+            return self.generated_at.get(prompt_key(prompt))
+
+    def load(self) -> None:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logger.warning("讀取觸發統計失敗，重新統計: %s", e)
+            return
+        with self._lock:
+            for item in data.get("triggers", []):
+                buckets = [float(c) for c in item.get("hours", [])][:24]
+                if len(buckets) != 24:
+                    continue
+                self._entries[(item.get("persona") or _NO_PERSONA, item["keyword"])] = [float(item["ts"]), buckets]
+            self.generated_at = {k: float(v) for k, v in data.get("generated_at", {}).items()}
+            self.budget_day = data.get("budget_day", "")
+            self.budget_used = int(data.get("budget_used", 0))
+
+    def save(self) -> bool:
+        """有變更時以「暫存檔 + rename」原子寫入統計檔。"""
+        if self.path is None:
+            return True
+        with self._lock:
+            if not self._dirty:
+                return True
+            data = {
+                "triggers": [
+                    {"persona": persona, "keyword": keyword, "ts": entry[0], "hours": entry[1]}
+                    for (persona, keyword), entry in self._entries.items()
+                ],
+                "generated_at": self.generated_at,
+                "budget_day": self.budget_day,
+                "budget_used": self.budget_used,
+            }
+            tmp_path = self.path.with_name(self.path.name + ".tmp")
+            try:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(data, f, ensure_ascii=False)
+                os.replace(tmp_path, self.path)
+                self._dirty = False
+            except Exception as e:
+                logger.warning("寫入觸發統計失敗: %s", e)
+                return False
+        return True
+
+
+class PregenScheduler:
+    """閒置時替即將到來的熱門 (女友類型, 關鍵字) 預先生成圖片存入快取。
+
+    render(persona, keyword) 組出圖片 prompt，generate(prompt) 生成圖片並寫入快取（排程本身不寫快取，
+    寫入只在 generate 一處）；由 ai_image_gen.create_pregen_scheduler 注入，避免循環 import。
+    """
+
+    def __init__(
+        self,
+        triggers: TriggerStats,
+        cache: ImageCache,
+        render: Callable[[str | None, str], str],
+        generate: Callable[[str], Awaitable[bytes | None]],
+        keywords: Callable[[], Iterable[str]] | None = None,
+        daily_budget: int = DEFAULT_DAILY_BUDGET,
+        concurrency: int = DEFAULT_CONCURRENCY,
+        idle_seconds: float = DEFAULT_IDLE_SECONDS,
+        interval: float = DEFAULT_INTERVAL,
+        lookahead_hours: int = DEFAULT_LOOKAHEAD_HOURS,
+        top_n: int = DEFAULT_TOP_N,
+        min_requests: float = DEFAULT_MIN_REQUESTS,
+        max_age: float = DEFAULT_MAX_AGE_HOURS * 3600,
+        clock: Callable[[], float] = time.time,
+    ):
+        self.triggers = triggers
+        self.cache = cache
+        self.render = render
+        self.generate = generate
+        self.keywords = keywords
+        self.daily_budget = daily_budget
+        self.concurrency = max(1, concurrency)
+        self.idle_seconds = idle_seconds
+        self.interval = interval
+        self.lookahead_hours = max(1, lookahead_hours)
+        self.top_n = top_n
+        self.min_requests = min_requests
+        self.max_age = max_age
+        self.clock = clock
+        self.counters: Counter = Counter()
+
+    def _is_stale(self, prompt: str, now: float) -> bool:
+        if self.cache.needs_fill(prompt):
+            return True
+        generated = self.triggers.last_generated(prompt)
+        if generated is None:
+            # 已由用戶流量存滿，從現在開始計算新鮮度
+            self.triggers.mark_generated(prompt, now)
+            return False
+        return now - generated > self.max_age
+
+    def plan(self) -> list[tuple[str | None, str, str]]:
+        """回傳本輪需要預先生成的 (女友類型, 關鍵字, prompt)，熱門者在前。"""
+        now = self.clock()
+        current = _local_hour(now)
+        # 包含目前這個小時：整點前後的尖峰也算「即將到來」
+        hours = range(current, current + self.lookahead_hours + 1)
+        active = set(self.keywords()) if self.keywords is not None else None
+        plan = []
+        for _, persona, keyword in self.triggers.top(hours, self.min_requests):
+            if active is not None and keyword not in active:
+                continue
+            try:
+                prompt = self.render(persona, keyword)
+            except KeyError:
+                # 女友類型已被移除
+                continue
+            if self._is_stale(prompt, now):
+                plan.append((persona, keyword, prompt))
+            if len(plan) >= self.top_n:
+                break
+        return plan
+
+    def _reserve(self) -> bool:
+        if self.triggers.try_charge(self.daily_budget):
+            self.counters["provider_calls"] += 1
+            return True
+        self.counters["budget_exhausted"] += 1
+        return False
+
+    def _release(self) -> None:
+        self.triggers.refund()
+        self.counters["provider_calls"] -= 1
+
+    async def _pregenerate(self, semaphore: asyncio.Semaphore, persona: str | None, keyword: str, prompt: str) -> bool:
+        async with semaphore:
+            # generate 中實際呼叫 provider 時才扣預算（見 reserve_provider_call）
+            token = _active_scheduler.set(self)
+            try:
+                image_bytes = await self.generate(prompt)
+                if not image_bytes:
+                    self.counters["failed"] += 1
+                    return False
+            except Exception as e:
+                logger.warning("預先生成圖片失敗（%s / %s）: %s", persona, keyword, e)
+                self.counters["failed"] += 1
+                return False
+            finally:
+                _active_scheduler.reset(token)
+            self.triggers.mark_generated(prompt)
+            self.counters["generated"] += 1
+            logger.info("已預先生成圖片：%s / %s", persona or "-", keyword)
+            return True
+
+    async def run_once(self) -> int:
+        """執行一輪：不閒置或預算用完時跳過，回傳成功生成的張數。"""
+        self.counters["runs"] += 1
+        if self.clock() - self.triggers.last_activity < self.idle_seconds:
+            self.counters["skipped_busy"] += 1
+            return 0
+        remaining = self.triggers.budget_remaining(self.daily_budget)
+        if remaining <= 0:
+            self.counters["skipped_budget"] += 1
+            return 0
+        plan = (await asyncio.to_thread(self.plan))[:remaining]
+        if not plan:
+            return 0
+        semaphore = asyncio.Semaphore(self.concurrency)
+        results = await asyncio.gather(
+            *(self._pregenerate(semaphore, persona, keyword, prompt) for persona, keyword, prompt in plan)
+        )
+        return sum(results)
+
+    async def run_forever(self) -> None:
+        """每隔 interval 秒執行一輪，並寫入統計檔；被取消時也會寫入。"""
+        try:
+            while True:
+                await asyncio.sleep(self.interval)
+                try:
+                    await self.run_once()
+                except Exception as e:
+                    logger.warning("預先生成排程執行失敗: %s", e)
+                await asyncio.to_thread(self.triggers.save)
+        finally:
+            self.triggers.save()
+
+    def stats(self) -> dict:
+        return {
+            **self.counters,
+            "budget_remaining": self.triggers.budget_remaining(self.daily_budget),
+        }
+
+
+_stats: TriggerStats | None = None
+
+
+def get_trigger_stats() -> TriggerStats:
+    """取得全域觸發統計（統計檔預設放在圖片快取目錄，可用 PREGEN_STATS_FILE 指定）。"""
+    global _stats
+    if _stats is None:
+        from image_cache import DEFAULT_CACHE_DIR
+
+        path = (os.getenv("PREGEN_STATS_FILE") or "").strip()
+        if not path:
+            root = (os.getenv("IMAGE_CACHE_DIR") or "").strip() or DEFAULT_CACHE_DIR
+            path = Path(root) / STATS_FILENAME
+        half_life = float(os.getenv("PREGEN_HALF_LIFE_DAYS") or DEFAULT_HALF_LIFE_DAYS)
+        _stats = TriggerStats(Path(path), half_life_days=half_life)
+    return _stats
+
+
+# 目前這個 task 是否在替某個排程預先生成（single-flight 的工作 task 會複製 leader 的 context）
+_active_scheduler: ContextVar[PregenScheduler | None] = ContextVar("pregen_scheduler", default=None)
+
+
+def reserve_provider_call() -> bool:
+    """
+    圖片生成每次要呼叫 provider 前呼叫。預先生成發起的生成會扣一次每日預算，
+    預算用完時回傳 False（不應呼叫）；即時請求不受影響，永遠回傳 True。
+    """
+    scheduler = _active_scheduler.get()
+    return scheduler is None or scheduler._reserve()
+
+
+def release_provider_call() -> None:
+    """reserve_provider_call 之後最後沒有呼叫 provider（例如斷路器為 open）時退還預算。"""
+    scheduler = _active_scheduler.get()
+    if scheduler is not None:
+        scheduler._release()
+
+
+def record_trigger(persona: str | None, keyword: str) -> None:
+    """記錄一次拍照觸發（供預先生成排程參考）。"""
+    get_trigger_stats().record(persona, keyword)
+
+
+def pregen_enabled() -> bool:
+    return (os.getenv("IMAGE_PREGEN") or "0").strip().lower() in {"1", "true", "yes", "on"}
+
+
+def create_scheduler(
+    cache: ImageCache,
+    render: Callable[[str | None, str], str],
+    generate: Callable[[str], Awaitable[bytes | None]],
+    keywords: Callable[[], Iterable[str]] | None = None,
+) -> PregenScheduler:
+    """依環境變數建立預先生成排程。"""
+    return PregenScheduler(
+        get_trigger_stats(),
+        cache,
+        render,
+        generate,
+        keywords=keywords,
+        daily_budget=int(os.getenv("PREGEN_DAILY_BUDGET") or DEFAULT_DAILY_BUDGET),
+        concurrency=int(os.getenv("PREGEN_CONCURRENCY") or DEFAULT_CONCURRENCY),
+        idle_seconds=float(os.getenv("PREGEN_IDLE_SECONDS") or DEFAULT_IDLE_SECONDS),
+        interval=float(os.getenv("PREGEN_INTERVAL") or DEFAULT_INTERVAL),
+        lookahead_hours=int(os.getenv("PREGEN_LOOKAHEAD_HOURS") or DEFAULT_LOOKAHEAD_HOURS),
+        top_n=int(os.getenv("PREGEN_TOP_N") or DEFAULT_TOP_N),
+        min_requests=float(os.getenv("PREGEN_MIN_REQUESTS") or DEFAULT_MIN_REQUESTS),
+        max_age=float(os.getenv("PREGEN_MAX_AGE_HOURS") or DEFAULT_MAX_AGE_HOURS) * 3600,
+    )
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""多關鍵字比對：把關鍵字集合編譯成 Aho–Corasick 自動機，一次掃過訊息即可找出所有命中的關鍵字。
+
+成本只與訊息長度（加上命中數）成正比，與關鍵字數量無關，關鍵字可以放心增加到上千個。
+"""
+
+import logging
+import os
+import threading
+import time
+from collections import deque
+from pathlib import Path
+from typing import Iterable, Iterator
+
+logger = logging.getLogger(__name__)
+
+# 兩次檢查關鍵字檔案 mtime 之間的最短間隔（秒）
+DEFAULT_CHECK_INTERVAL = 1.0
+
+
+class AhoCorasick:
+    """Aho–Corasick 自動機。建立後為唯讀，可在多執行緒間共用。"""
+
+    def __init__(self, patterns: Iterable[str]):
+        self._goto: list[dict[str, int]] = [{}]
+        self._fail: list[int] = [0]
+        # 每個節點結尾的關鍵字（若有）
+        self._pattern: list[str | None] = [None]
+        # 沿 fail 鏈可到達的下一個「有關鍵字結尾」的節點，方便列舉所有命中
+        self._output_link: list[int] = [0]
+        # 在此節點結尾的最長關鍵字（含 fail 鏈上的）
+        self._longest: list[str | None] = [None]
+        self.patterns = frozenset(p for p in patterns if p)
+        for pattern in self.patterns:
+            self._add(pattern)
+        self._build()
+
+    def _add(self, pattern: str) -> None:
+        node = 0
+        for ch in pattern:
+            nxt = self._goto[node].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[node][ch] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._pattern.append(None)
+                self._output_link.append(0)
+                self._longest.append(None)
+            node = nxt
+        self._pattern[node] = pattern
+
+    def _build(self) -> None:
+        queue = deque()
+        for child in self._goto[0].values():
+            queue.append(child)
+            self._longest[child] = self._pattern[child]
+        while queue:
+            node = queue.popleft()
+            for ch, child in self._goto[node].items():
+                queue.append(child)
+                fail = self._fail[node]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                fail = self._goto[fail].get(ch, 0)
+                self._fail[child] = fail
+                self._output_link[child] = fail if self._pattern[fail] is not None else self._output_link[fail]
+                own, inherited = self._pattern[child], self._longest[fail]
+                self._longest[child] = own if own is not None else inherited
+
+    def _step(self, node: int, ch: str) -> int:
+        goto, fail = self._goto, self._fail
+        while node and ch not in goto[node]:
+            node = fail[node]
+        return goto[node].get(ch, 0)
+
+    def iter_matches(self, text: str) -> Iterator[tuple[int, str]]:
+        """依結尾位置順序列出所有命中，回傳 (起始位置, 關鍵字)。"""
+        node = 0
+        for end, ch in enumerate(text, 1):
+            node = self._step(node, ch)
+            out = node if self._pattern[node] is not None else self._output_link[node]
+            while out:
+                pattern = self._pattern[out]
+                yield end - len(pattern), pattern
+                out = self._output_link[out]
+
+    def longest_match(self, text: str) -> str | None:
+        """回傳訊息中出現的最長關鍵字；長度相同時取最先出現者。"""
+        best: str | None = None
+        best_start = 0
+        node = 0
+        longest = self._longest
+        for end, ch in enumerate(text, 1):
+            node = self._step(node, ch)
+            candidate = longest[node]
+            if candidate is None:
+                continue
+            start = end - len(candidate)
+            if best is None or len(candidate) > len(best) or (
+                len(candidate) == len(best) and start < best_start
+            ):
+                best, best_start = candidate, start
+        return best
+
+
+def load_keywords_file(path: Path) -> frozenset[str]:
+    """讀取關鍵字檔：每行一個關鍵字，空行與 # 開頭的行略過。"""
+    keywords = set()
+    for line in Path(path).read_text(encoding="utf-8").splitlines():
+        line = line.strip()
+        if line and not line.startswith("#"):
+            keywords.add(line)
+    return frozenset(keywords)
+
+
+class ReloadableKeywordMatcher:
+    """關鍵字自動機，可由檔案熱更新。
+
+    設定了 path 時以檔案內容為準（檔案 mtime 改變就重新編譯），否則使用 default_keywords。
+    """
+
+    def __init__(
+        self,
+        default_keywords: Iterable[str],
+        path: Path | None = None,
+        check_interval: float = DEFAULT_CHECK_INTERVAL,
+    ):
+        self.default_keywords = frozenset(default_keywords)
+        self.path = Path(path) if path else None
+        self.check_interval = check_interval
+        self.version = 0
+        self._lock = threading.Lock()
+        self._mtime: int | None = None
+        self._last_check = 0.0
+        self._automaton = AhoCorasick(self.default_keywords)
+        self._refresh(force=True)
+
+    def _refresh(self, force: bool = False) -> None:
+        if self.path is None:
+            return
+        now = time.monotonic()
+        if not force and now - self._last_check < self.check_interval:
+            return
+        with self._lock:
+            self._last_check = now
+            try:
+                mtime = os.stat(self.path).st_mtime_ns
+            except FileNotFoundError:
+                mtime = None
+            if mtime == self._mtime and not force:
+                return
+            self._mtime = mtime
+            try:
+                keywords = load_keywords_file(self.path) if mtime is not None else self.default_keywords
+            except Exception as e:
+                logger.warning("讀取關鍵字檔 %s 失敗，沿用目前的關鍵字: %s", self.path, e)
+                return
+            self._automaton = AhoCorasick(keywords)
+            self.version += 1
+            logger.info("已載入 %d 個觸發關鍵字（%s）", len(keywords), self.path)
+
+    @property
+    def automaton(self) -> AhoCorasick:
+        """目前生效的自動機（必要時先熱更新）。"""
+        self._refresh()
+        return self._automaton
+
+    @property
+    def keywords(self) -> frozenset[str]:
+        return self.automaton.patterns
+
+    def longest_match(self, text: str) -> str | None:
+        return self.automaton.longest_match(text)
@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+"""延遲統計：保留最近 N 筆耗時，計算百分位數。"""
+
+import threading
+from collections import deque
+
+
+class LatencyWindow:
+    """最近 size 筆耗時（秒）的滑動視窗。"""
+
+    def __init__(self, size: int = 500):
+        self._samples: deque[float] = deque(maxlen=size)
+        self._lock = threading.Lock()
+        self.count = 0
+
+    def record(self, seconds: float) -> None:
+        with self._lock:
+            self._samples.append(seconds)
+            self.count += 1
+
+    def percentile(self, p: float) -> float | None:
+        """回傳第 p 百分位（0–100）；沒有資料時回傳 None。"""
+        with self._lock:
+            if not self._samples:
+                return None
+            ordered = sorted(self._samples)
+        index = min(len(ordered) - 1, max(0, round(p / 100 * (len(ordered) - 1))))
+        return ordered[index]
+
+    def snapshot(self) -> dict:
+        """回傳 p50 / p90 / p99 與樣本數。"""
+        return {
+            "count": self.count,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+        }
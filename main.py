@@ -5,7 +5,7 @@ import os
 import sys
 from pathlib import Path
 
-from logic import get_reply
+from message_router import classify_message
 
 TELEGRAM_AVAILABLE = True
 _IMPORT_ERROR: Exception | None = None
@@ -27,7 +27,7 @@ def _load_env() -> None:
 
 
 try:
-    from bot import run_bot
+    from bot import WebhookConfig, run_bot
 except Exception as exc:  # 包含 telegram 未安裝時的 ImportError
     TELEGRAM_AVAILABLE = False
     _IMPORT_ERROR = exc
@@ -48,8 +48,36 @@ def _local_simulation() -> None:
         if text.lower() in {"exit", "quit"}:
             print("結束本地模擬。")
             break
-        reply = get_reply(text)
-        print(f"Bot：{reply}")
+        route = classify_message(text)
+        print(f"Bot：{route.fallback_reply}")
+        if route.trigger is not None:
+            print(f"Bot：（觸發拍照：{route.trigger}）")
+
+
+def _webhook_config():
+    """
+    TELEGRAM_MODE=webhook 時依環境變數建立 webhook 設定，否則回傳 None（long polling）。
+    缺少必要設定時印出說明並結束程式。
+    """
+    mode = (os.getenv("TELEGRAM_MODE") or "polling").strip().lower()
+    if mode != "webhook":
+        return None
+
+    base_url = (os.getenv("TELEGRAM_WEBHOOK_URL") or "").strip().rstrip("/")
+    secret = (os.getenv("TELEGRAM_WEBHOOK_SECRET") or "").strip()
+    if not base_url or not secret:
+        print("錯誤：webhook 模式需要設定 TELEGRAM_WEBHOOK_URL 與 TELEGRAM_WEBHOOK_SECRET")
+        print("例如：TELEGRAM_WEBHOOK_URL=https://example.com TELEGRAM_WEBHOOK_SECRET=隨機字串（1-256 個英數、_ 或 -）")
+        sys.exit(1)
+
+    url_path = (os.getenv("TELEGRAM_WEBHOOK_PATH") or "telegram").strip().strip("/")
+    return WebhookConfig(
+        url=f"{base_url}/{url_path}",
+        secret_token=secret,
+        listen=(os.getenv("TELEGRAM_WEBHOOK_LISTEN") or "0.0.0.0").strip(),
+        port=int(os.getenv("TELEGRAM_WEBHOOK_PORT") or 8443),
+        url_path=url_path,
+    )
 
 
 def main() -> None:
@@ -64,7 +92,7 @@ def main() -> None:
             print("方式二：執行時設定：TELEGRAM_BOT_TOKEN=你的Token python main.py")
             sys.exit(1)
 
-        run_bot(token)
+        run_bot(token, webhook=_webhook_config())
     else:
         _local_simulation()
 
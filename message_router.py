@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""訊息分類：一次掃描同時找出拍照觸發關鍵字與 logic.KEYWORD_REPLIES 的關鍵字回覆。
+
+觸發關鍵字與關鍵字回覆編譯進同一個 Aho–Corasick 自動機，並先把訊息正規化
+（全形轉半形、不分大小寫、連續空白合併），bot 與本地模擬都只需掃描訊息一次。
+"""
+
+import re
+import threading
+import unicodedata
+from typing import NamedTuple
+
+from ai_image_gen import get_trigger_matcher
+from keyword_matcher import AhoCorasick
+from logic import DEFAULT_REPLY, KEYWORD_REPLIES
+
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def normalize_text(text: str) -> str:
+    """正規化訊息：NFKC（全形英數 / 空白轉半形）、casefold、連續空白合併為一個、去除頭尾空白。"""
+    if not text:
+        return ""
+    text = unicodedata.normalize("NFKC", text).casefold()
+    return _WHITESPACE_RE.sub(" ", text).strip()
+
+
+class MessageRoute(NamedTuple):
+    """一則訊息的分類結果。"""
+
+    # 拍照觸發關鍵字（原始寫法，用於組圖片 prompt）；沒有則為 None
+    trigger: str | None
+    # KEYWORD_REPLIES 中第一個命中的回覆；沒有則為 None
+    keyword_reply: str | None
+    # 正規化後的訊息
+    normalized: str
+
+    @property
+    def fallback_reply(self) -> str:
+        """AI 無法回覆時使用的關鍵字回覆（等同 logic.get_reply）。"""
+        return self.keyword_reply or DEFAULT_REPLY
+
+
+class _CompiledRoutes(NamedTuple):
+    trigger_version: int
+    automaton: AhoCorasick
+    # 正規化後的關鍵字 -> 原始觸發關鍵字
+    triggers: dict[str, str]
+    # 正規化後的關鍵字 -> KEYWORD_REPLIES 中的順序
+    reply_ranks: dict[str, int]
+    replies: tuple[str, ...]
+
+
+_compiled: _CompiledRoutes | None = None
+_compile_lock = threading.Lock()
+
+
+def _compile() -> _CompiledRoutes:
+    """觸發關鍵字有熱更新（版本改變）時重新編譯。"""
+    global _compiled
+    matcher = get_trigger_matcher()
+    keywords = matcher.keywords
+    compiled = _compiled
+    if compiled is not None and compiled.trigger_version == matcher.version:
+        return compiled
+    with _compile_lock:
+        if _compiled is not None and _compiled.trigger_version == matcher.version:
+            return _compiled
+        triggers = {}
+        for keyword in keywords:
+            triggers.setdefault(normalize_text(keyword), keyword)
+        reply_ranks = {}
+        for rank, keyword in enumerate(KEYWORD_REPLIES):
+            reply_ranks.setdefault(normalize_text(keyword), rank)
+        automaton = AhoCorasick(set(triggers) | set(reply_ranks))
+        replies = tuple(KEYWORD_REPLIES.values())
+        _compiled = _CompiledRoutes(matcher.version, automaton, triggers, reply_ranks, replies)
+        return _compiled
+
+
+def classify_message(text: str) -> MessageRoute:
+    """一次掃描訊息，回傳觸發關鍵字（最長者優先）、關鍵字回覆與正規化文字。"""
+    normalized = normalize_text(text)
+    if not normalized:
+        return MessageRoute(None, None, normalized)
+
+    compiled = _compile()
+    best_trigger: str | None = None
+    best_start = 0
+    best_rank: int | None = None
+    for start, pattern in compiled.automaton.iter_matches(normalized):
+        rank = compiled.reply_ranks.get(pattern)
+        if rank is not None and (best_rank is None or rank < best_rank):
+            best_rank = rank
+        if pattern in compiled.triggers and (
+            best_trigger is None
+            or len(pattern) > len(best_trigger)
+            or (len(pattern) == len(best_trigger) and start < best_start)
+        ):
+            best_trigger, best_start = pattern, start
+
+    trigger = compiled.triggers[best_trigger] if best_trigger is not None else None
+    keyword_reply = compiled.replies[best_rank] if best_rank is not None else None
+    return MessageRoute(trigger, keyword_reply, normalized)
@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+"""Prometheus 文字格式的指標：各階段耗時直方圖、fallback 計數與進行中請求數，由本機 HTTP 端點提供。
+
+- 以標準函式庫實作（不需要 prometheus_client）：observe / inc 只是在鎖內更新幾個數字，開銷在微秒等級，
+  計時器以 perf_counter 量測。
+- 設定 METRICS_PORT（例如 9100）時在 METRICS_ADDR（預設 127.0.0.1，只給本機的 Prometheus 抓）啟動 /metrics；
+  未設定時照常記錄，只是不對外提供。
+- 既有子系統的 stats()（准入控制、斷路器、各種快取…）以 register_stats 登記，被抓取時才呼叫並轉成 gauge。
+"""
+
+import bisect
+import logging
+import os
+import re
+import threading
+import time
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Iterable
+
+logger = logging.getLogger(__name__)
+
+# 從 0.5ms（觸發比對、提示渲染）到 60s（圖片生成）
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_registry: list["_Metric"] = []
+# (名稱前綴, 取得 stats 的函式, 第一層 key 的 label 名稱或 None)
+_stats_sources: list[tuple[str, Callable[[], dict | None], str | None]] = []
+_NAME_RE = re.compile(r"[^a-zA-Z0-9_]")
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels: dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(str(value))}"' for name, value in labels.items()) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values: dict[tuple[str, ...], object] = {}
+        _registry.append(self)
+
+    def _key(self, labels: tuple) -> tuple[str, ...]:
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"{self.name} 需要 label {self.labelnames}，收到 {labels}")
+        return tuple(str(value) for value in labels)
+
+    def _labels(self, key: tuple[str, ...], **extra: str) -> dict[str, str]:
+        return {**dict(zip(self.labelnames, key)), **extra}
+
+    def samples(self) -> list[tuple[str, dict[str, str], float]]:
+        """回傳 (名稱, labels, 值) 列表。"""
+        with self._lock:
+            return [(self.name, self._labels(key), value) for key, value in self._values.items()]
+
+
+class Counter(_Metric):
+    """只增不減的計數。"""
+
+    kind = "counter"
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """可增可減的量（例如進行中的請求數）。"""
+
+    kind = "gauge"
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, *labels, amount: float = 1) -> None:
+        self.inc(*labels, amount=-amount)
+
+    def set(self, value: float, *labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def track(self, *labels) -> "_InFlight":
+        """with 區塊期間 +1，離開時 -1。"""
+        return _InFlight(self, labels)
+
+
+class _InFlight:
+    __slots__ = ("gauge", "labels")
+
+    def __init__(self, gauge: Gauge, labels: tuple):
+        self.gauge = gauge
+        self.labels = labels
+
+    def __enter__(self) -> None:
+        self.gauge.inc(*self.labels)
+
+    def __exit__(self, *exc_info) -> None:
+        self.gauge.dec(*self.labels)
+
+
+class Histogram(_Metric):
+    """累計分布（Prometheus histogram）：每組 label 記各 bucket 的次數、總和與次數。"""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Iterable[str] = (), buckets: Iterable[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *labels) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # 各 bucket 的次數（最後一格為超過最大 bucket）、總和、次數
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def time(self, *labels) -> "_Timer":
+        """with 區塊的耗時記入直方圖。"""
+        return _Timer(self, labels)
+
+    def samples(self) -> list[tuple[str, dict[str, str], float]]:
+        with self._lock:
+            snapshot = [(key, list(state[0]), state[1], state[2]) for key, state in self._values.items()]
+        result = []
+        for key, counts, total, count in snapshot:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                result.append((f"{self.name}_bucket", self._labels(key, le=_format_value(bound)), cumulative))
+            result.append((f"{self.name}_sum", self._labels(key), total))
+            result.append((f"{self.name}_count", self._labels(key), count))
+        return result
+
+
+class _Timer:
+    __slots__ = ("histogram", "labels", "started")
+
+    def __init__(self, histogram: Histogram, labels: tuple):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self) -> None:
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc_info) -> None:
+        self.histogram.observe(time.perf_counter() - self.started, *self.labels)
+
+
+# ---------- 指標定義 ----------
+
+STAGE_SECONDS = Histogram(
+    "bot_stage_seconds",
+    "各處理階段的耗時（觸發比對、讀取用戶配置、提示渲染、圖片後處理、Telegram 傳送…）",
+    ["stage"],
+)
+PROVIDER_SECONDS = Histogram(
+    "bot_provider_call_seconds",
+    "AI provider 呼叫耗時（不含等待並行上限），outcome 為 ok / error / cancelled",
+    ["provider", "model", "workload", "outcome"],
+)
+PROVIDER_IN_FLIGHT = Gauge("bot_provider_in_flight", "進行中的 AI provider 呼叫數", ["provider", "workload"])
+HANDLER_SECONDS = Histogram("bot_handler_seconds", "Telegram handler 從收到到處理完的耗時", ["handler"])
+HANDLER_IN_FLIGHT = Gauge("bot_handler_in_flight", "進行中的 Telegram handler 數", ["handler"])
+FALLBACKS = Counter(
+    "bot_fallbacks_total",
+    "送出備援回覆的次數（gemini_text：GEMINI_FALLBACK_MSG、keyword_reply：logic.get_reply 關鍵字回覆、"
+    "image_gen：IMAGE_GEN_FALLBACK_MSG、vision：看圖失敗提示）",
+    ["kind"],
+)
+
+
+class _ProviderCall:
+    __slots__ = ("provider", "model", "workload", "started")
+
+    def __init__(self, provider: str, model: str, workload: str):
+        self.provider = provider
+        self.model = model
+        self.workload = workload
+
+    def __enter__(self) -> None:
+        PROVIDER_IN_FLIGHT.inc(self.provider, self.workload)
+        self.started = time.perf_counter()
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        elapsed = time.perf_counter() - self.started
+        PROVIDER_IN_FLIGHT.dec(self.provider, self.workload)
+        if exc_type is None:
+            outcome = "ok"
+        elif issubclass(exc_type, Exception):
+            outcome = "error"
+        else:
+            # CancelledError（對沖的輸家、逾時）或串流被提前關閉（GeneratorExit）
+            outcome = "cancelled"
+        PROVIDER_SECONDS.observe(elapsed, self.provider, self.model, self.workload, outcome)
+
+
+def provider_call(provider: str, model: str, workload: str) -> _ProviderCall:
+    """with 區塊為一次 provider 呼叫：記錄耗時與結果，期間計入進行中的呼叫數。"""
+    return _ProviderCall(provider, model, workload)
+
+
+def instrument_handler(name: str):
+    """Telegram handler 的裝飾器：記錄總耗時與進行中的數量。"""
+
+    def decorator(handler):
+        @wraps(handler)
+        async def wrapper(*args, **kwargs):
+            with HANDLER_IN_FLIGHT.track(name), HANDLER_SECONDS.time(name):
+                return await handler(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+# ---------- 既有 stats() 轉成 gauge ----------
+
+def register_stats(prefix: str, source: Callable[[], dict | None], label: str | None = None) -> None:
+    """
+    登記一個 stats 來源，抓取時轉成 bot_<prefix>_<key> 的 gauge。
+    label 不為 None 時，source 回傳 {名稱: stats}，名稱放在該 label（例如各斷路器）。
+    數值直接輸出；字串輸出為 <key>{<key>="值"} 1（例如斷路器狀態）；巢狀 dict 以 key label 展開；None 略過。
+    """
+    _stats_sources.append((prefix, source, label))
+
+
+def _metric_name(*parts: str) -> str:
+    return _NAME_RE.sub("_", "_".join(("bot",) + parts))
+
+
+def _flatten(prefix: str, stats: dict, labels: dict[str, str]) -> list[tuple[str, dict[str, str], float]]:
+    result = []
+    for key, value in stats.items():
+        name = _metric_name(prefix, str(key))
+        if isinstance(value, bool):
+            result.append((name, labels, int(value)))
+        elif isinstance(value, (int, float)):
+            result.append((name, labels, value))
+        elif isinstance(value, str):
+            result.append((name, {**labels, str(key): value}, 1))
+        elif isinstance(value, dict):
+            for sub_key, sub_value in value.items():
+                if isinstance(sub_value, (int, float)):
+                    result.append((name, {**labels, "key": str(sub_key)}, sub_value))
+    return result
+
+
+def _stats_samples() -> list[tuple[str, dict[str, str], float]]:
+    result = []
+    for prefix, source, label in list(_stats_sources):
+        try:
+            stats = source()
+        except Exception as e:
+            logger.debug("讀取 %s 統計失敗: %s", prefix, e)
+            continue
+        if not stats:
+            continue
+        if label is None:
+            result.extend(_flatten(prefix, stats, {}))
+        else:
+            for entity, entity_stats in stats.items():
+                if isinstance(entity_stats, dict):
+                    result.extend(_flatten(prefix, entity_stats, {label: str(entity)}))
+    return result
+
+
+def render() -> str:
+    """以 Prometheus 文字格式輸出所有指標。"""
+    lines = []
+    for metric in list(_registry):
+        samples = metric.samples()
+        if not samples:
+            continue
+        lines.append(f"# HELP {metric.name} {_escape(metric.help)}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, labels, value in samples:
+            lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+    # 同名的樣本必須連續輸出（例如各斷路器的同一個計數）
+    families: dict[str, list[tuple[dict[str, str], float]]] = {}
+    for name, labels, value in _stats_samples():
+        families.setdefault(name, []).append((labels, value))
+    for name, samples in families.items():
+        lines.append(f"# TYPE {name} gauge")
+        for labels, value in samples:
+            lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+# ---------- HTTP 端點 ----------
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        payload = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def start_metrics_server(port: int, addr: str = "127.0.0.1") -> ThreadingHTTPServer:
+    """在背景執行緒啟動 /metrics 端點，回傳 server（shutdown() 可停止）。"""
+    server = ThreadingHTTPServer((addr, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logger.info("指標端點：http://%s:%d/metrics", addr, server.server_address[1])
+    return server
+
+
+def start_from_env() -> ThreadingHTTPServer | None:
+    """設定 METRICS_PORT 時啟動指標端點；未設定時回傳 None。"""
+    port = (os.getenv("METRICS_PORT") or "").strip()
+    if not port or port == "0":
+        return None
+    return start_metrics_server(int(port), (os.getenv("METRICS_ADDR") or "127.0.0.1").strip())
@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+"""
+把 users_config.json 一次性匯入 SQLite 用戶配置資料庫。
+執行：python migrate_users_to_sqlite.py [來源 JSON] [目標 DB]
+完成後在 .env 設定 USER_STORE_BACKEND=sqlite（及 USER_STORE_SQLITE_PATH，若不是預設路徑）。
+"comment" / "example" 等說明用 key 會被略過；重複執行只會覆寫相同 user_id，不會產生重複資料。
+"""
+
+import sys
+from pathlib import Path
+
+from user_store import CONFIG_FILE, SQLITE_FILE, migrate_json_to_sqlite
+
+
+def main():
+    json_path = Path(sys.argv[1]) if len(sys.argv) > 1 else CONFIG_FILE
+    db_path = Path(sys.argv[2]) if len(sys.argv) > 2 else SQLITE_FILE
+
+    print("=" * 60)
+    print("用戶配置遷移：JSON → SQLite")
+    print("=" * 60)
+    print(f"\n[1] 來源: {json_path}")
+    print(f"[2] 目標: {db_path}")
+
+    if not json_path.exists():
+        print(f"\n[錯誤] 找不到來源檔案 {json_path}")
+        sys.exit(1)
+
+    try:
+        count = migrate_json_to_sqlite(json_path, db_path)
+    except Exception as e:
+        print(f"\n[錯誤] 遷移失敗: {type(e).__name__}: {e}")
+        sys.exit(1)
+
+    print(f"\n[3] 已匯入 {count} 位用戶")
+    print("\n請在 .env 加上 USER_STORE_BACKEND=sqlite 後重新啟動機器人。")
+
+
+if __name__ == "__main__":
+    main()
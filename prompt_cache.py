@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""人設系統提示的渲染快取：同一組 (女友類型, 女友名字, 用戶名字) 只 format 一次。
+
+快取有上限（PROMPT_CACHE_SIZE，預設 1024 組，LRU 淘汰）。
+key 已包含所有會影響提示的欄位，用戶改設定只會用到另一組 key，不需要清除快取。
+"""
+
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable
+
+from metrics import STAGE_SECONDS
+
+DEFAULT_PROMPT_CACHE_SIZE = 1024
+
+
+class PromptCache:
+    """有上限的 LRU 快取，記錄命中率。"""
+
+    def __init__(self, name: str, maxsize: int | None = None):
+        self.name = name
+        self._maxsize = maxsize
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[tuple, str] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def maxsize(self) -> int:
+        # 延後讀環境變數：模組載入時 .env 可能還沒載入
+        if self._maxsize is None:
+            self._maxsize = int(os.getenv("PROMPT_CACHE_SIZE") or DEFAULT_PROMPT_CACHE_SIZE)
+        return self._maxsize
+
+    def get(self, key: tuple, render: Callable[[], str]) -> str:
+        """回傳 key 對應的提示；沒有快取時呼叫 render 產生並存入。"""
+        with STAGE_SECONDS.time("prompt_render"):
+            return self._get(key, render)
+
+    def _get(self, key: tuple, render: Callable[[], str]) -> str:
+        with self._lock:
+            prompt = self._entries.get(key)
+            if prompt is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return prompt
+            self.misses += 1
+        prompt = render()
+        with self._lock:
+            self._entries[key] = prompt
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return prompt
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits / total) if total else 0.0,
+                "size": len(self._entries),
+            }
+
+
+_caches: list[PromptCache] = []
+
+
+def create_prompt_cache(name: str) -> PromptCache:
+    """建立並登記一個提示快取（納入 prompt_cache_stats）。"""
+    cache = PromptCache(name)
+    _caches.append(cache)
+    return cache
+
+
+def prompt_cache_stats() -> dict:
+    """回傳各提示快取的命中統計。"""
+    return {cache.name: cache.stats() for cache in _caches}
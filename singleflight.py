@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""Single-flight：相同 key 的並行請求共用同一個進行中的工作，只實際執行一次。
+
+例如早上 7 點很多人同時傳「早安」，相同（女友類型, 關鍵字）的 prompt 只會生成一張圖，
+其他人等同一個結果。每位呼叫者可以各自設定逾時或被取消，都不會取消共用的工作；
+共用工作會跑完（結果照常寫入快取），完成後才從表中移除。
+"""
+
+import asyncio
+import logging
+from collections import Counter
+from typing import Awaitable, Callable, Hashable, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    """以 key 合併並行中的相同工作（只在單一 event loop 中使用）。"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._inflight: dict[Hashable, asyncio.Task] = {}
+        self.counters: Counter = Counter()
+
+    def _done(self, key: Hashable, task: asyncio.Task) -> None:
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        # 所有等待者都已逾時 / 取消時，避免「exception was never retrieved」警告
+        if not task.cancelled() and task.exception() is not None:
+            logger.debug("%s 共用工作失敗: %s", self.name, task.exception())
+
+    async def do(
+        self,
+        key: Hashable,
+        work: Callable[[], Awaitable[T]],
+        timeout: float | None = None,
+    ) -> T:
+        """
+        執行 work（相同 key 已有進行中的工作時改為等待它），回傳結果或拋出相同的例外。
+        timeout 只限制這位呼叫者的等待時間（逾時拋出 asyncio.TimeoutError），不影響共用工作。
+        """
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(work())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._done(key, t))
+            self.counters["leader"] += 1
+        else:
+            self.counters["shared"] += 1
+        waiter = asyncio.shield(task)
+        if timeout is None:
+            return await waiter
+        return await asyncio.wait_for(waiter, timeout)
+
+    def in_flight(self) -> int:
+        return len(self._inflight)
+
+    def stats(self) -> dict:
+        return {**self.counters, "in_flight": self.in_flight()}
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""Telegram file_id 登記表：同一張圖片第二次以後改送 file_id，不必重新上傳。
+
+以圖片內容的 sha256 為 key，記錄第一次上傳後 Telegram 回傳的 file_id。
+每筆新紀錄附加一行到 telegram_file_ids.jsonl，重啟後重播即可還原；
+紀錄數超過上限（TELEGRAM_FILE_ID_CACHE_SIZE）時淘汰最久沒用到的，檔案過長時在載入時壓縮重寫。
+file_id 只對同一個 bot 有效，換了 token 之後送出會失敗，呼叫端應 forget 後改回上傳。
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_FILE = Path(__file__).parent / "telegram_file_ids.jsonl"
+DEFAULT_MAX_ENTRIES = 10000
+
+
+def image_key(data: bytes) -> str:
+    """圖片內容的雜湊（登記表 key）。"""
+    return hashlib.sha256(data).hexdigest()
+
+
+class FileIdRegistry:
+    """圖片雜湊 -> Telegram file_id 的 LRU 對照表，附加寫入檔案保存（執行緒安全）。"""
+
+    def __init__(self, path: Path | None = DEFAULT_FILE, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.path = Path(path) if path else None
+        self.max_entries = max(1, max_entries)
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[str, str] | None = None
+        self.hits = 0
+        self.misses = 0
+        self.uploads = 0
+        self.stale = 0
+
+    def _load(self) -> OrderedDict[str, str]:
+        """第一次使用時重播檔案；重複或已刪除的行太多時壓縮重寫。"""
+        if self._entries is not None:
+            return self._entries
+        entries: OrderedDict[str, str] = OrderedDict()
+        lines = 0
+        if self.path is not None and self.path.exists():
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    for line in f:
+                        line = line.strip()
+                        if not line:
+                            continue
+                        lines += 1
+                        try:
+                            record = json.loads(line)
+                        except json.JSONDecodeError:
+                            continue
+                        key = record.get("k")
+                        if not key:
+                            continue
+                        entries.pop(key, None)
+                        if record.get("f"):
+                            entries[key] = record["f"]
+                        while len(entries) > self.max_entries:
+                            entries.popitem(last=False)
+            except Exception as e:
+                logger.warning("讀取 file_id 登記表失敗，重新記錄: %s", e)
+        self._entries = entries
+        if lines > 2 * max(len(entries), 1):
+            self._rewrite()
+        return entries
+
+    def _append(self, key: str, file_id: str | None) -> None:
+        if self.path is None:
+            return
+        try:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"k": key, "f": file_id}, separators=(",", ":")) + "\n")
+        except Exception as e:
+            logger.warning("寫入 file_id 登記表失敗: %s", e)
+
+    def _rewrite(self) -> None:
+        """以「暫存檔 + rename」把目前的紀錄重寫成精簡檔案。"""
+        if self.path is None:
+            return
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                for key, file_id in self._entries.items():
+                    f.write(json.dumps({"k": key, "f": file_id}, separators=(",", ":")) + "\n")
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            logger.warning("壓縮 file_id 登記表失敗: %s", e)
+
+    def get(self, key: str) -> str | None:
+        with self._lock:
+            entries = self._load()
+            file_id = entries.get(key)
+            if file_id is None:
+                self.misses += 1
+                return None
+            entries.move_to_end(key)
+            self.hits += 1
+            return file_id
+
+    def put(self, key: str, file_id: str) -> None:
+        with self._lock:
+            entries = self._load()
+            self.uploads += 1
+            if entries.get(key) == file_id:
+                entries.move_to_end(key)
+                return
+            entries[key] = file_id
+            while len(entries) > self.max_entries:
+                entries.popitem(last=False)
+            self._append(key, file_id)
+
+    def forget(self, key: str) -> None:
+        """移除已失效的 file_id（例如換了 bot token）。"""
+        with self._lock:
+            if self._load().pop(key, None) is not None:
+                self.stale += 1
+                self._append(key, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits / total) if total else 0.0,
+                "uploads": self.uploads,
+                "stale": self.stale,
+                "size": len(self._entries or ()),
+            }
+
+
+_registry: FileIdRegistry | None = None
+
+
+def get_file_id_registry() -> FileIdRegistry | None:
+    """取得全域 file_id 登記表；TELEGRAM_FILE_ID_CACHE=0 時回傳 None（停用，每次都上傳）。"""
+    global _registry
+    if (os.getenv("TELEGRAM_FILE_ID_CACHE") or "1").strip().lower() in {"0", "false", "no", "off"}:
+        return None
+    if _registry is None:
+        path = (os.getenv("TELEGRAM_FILE_ID_FILE") or "").strip() or DEFAULT_FILE
+        max_entries = int(os.getenv("TELEGRAM_FILE_ID_CACHE_SIZE") or DEFAULT_MAX_ENTRIES)
+        _registry = FileIdRegistry(Path(path), max_entries=max_entries)
+    return _registry
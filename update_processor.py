@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""並行處理 Telegram 更新，同一個聊天室的更新仍依序處理。
+
+python-telegram-bot 預設一次只處理一個更新，一位用戶 15 秒的拍照會卡住所有人的回覆。
+ChatOrderedUpdateProcessor 讓不同聊天室的更新同時處理（上限 TELEGRAM_CONCURRENT_UPDATES），
+同一個聊天室則依收到順序一則一則處理，/start 的 ConversationHandler 流程與拍照時的多則回覆都不會交錯。
+
+並行上限由基底類別的 process_update（semaphore）負責。若在 do_process_update 中等待聊天室鎖，
+排隊中的更新會佔著名額、擋住其他聊天室（head-of-line blocking），所以改成：聊天室已有更新在處理時，
+新的更新放進該聊天室的佇列後立即返回（釋放名額），由正在處理的那一則依序接著處理，
+每個聊天室同時最多只佔一個名額。
+"""
+
+import logging
+from collections import deque
+from typing import Any, Awaitable
+
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONCURRENT_UPDATES = 16
+
+
+def _chat_key(update: object) -> int | None:
+    chat = getattr(update, "effective_chat", None)
+    if chat is not None:
+        return chat.id
+    user = getattr(update, "effective_user", None)
+    if user is not None:
+        return user.id
+    return None
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """不同聊天室並行、同一聊天室依序處理的 update processor。"""
+
+    def __init__(self, limit: int = DEFAULT_CONCURRENT_UPDATES):
+        super().__init__(max_concurrent_updates=max(1, limit))
+        self._active = 0
+        # 聊天室 -> 排隊中的更新；有 key 代表該聊天室正有更新在處理，處理完佇列後移除
+        self._chats: dict[int, deque] = {}
+
+    async def _run(self, key: int | None, coroutine: Awaitable[Any]) -> None:
+        self._active += 1
+        try:
+            await coroutine
+        except Exception:
+            # 同一聊天室後面排隊的更新仍要繼續處理
+            logger.exception("處理聊天室 %s 的更新時發生錯誤", key)
+        finally:
+            self._active -= 1
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        key = _chat_key(update)
+        if key is None:
+            await self._run(key, coroutine)
+            return
+
+        queued = self._chats.get(key)
+        if queued is not None:
+            # 由正在處理這個聊天室的那一則接著處理，這裡不佔用並行名額
+            queued.append(coroutine)
+            return
+
+        queued = self._chats[key] = deque([coroutine])
+        try:
+            while queued:
+                await self._run(key, queued.popleft())
+        finally:
+            del self._chats[key]
+            # 被取消（例如關閉機器人）時丟棄尚未處理的更新
+            for pending in queued:
+                pending.close()
+
+    def in_flight(self) -> int:
+        """目前正在處理的更新數（不含排隊中的）。"""
+        return self._active
+
+    def queued_chats(self) -> int:
+        """目前有更新在處理或排隊中的聊天室數。"""
+        return len(self._chats)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
@@ -0,0 +1,469 @@
+#!/usr/bin/env python3
+"""用戶配置存取層：提供 JSON 與 SQLite 兩種儲存後端，查詢由記憶體快取回應。
+
+- json（預設）：users_config.json 只解析一次，檔案被外部修改（mtime / inode / 大小改變）時自動重新載入；
+  寫入先附加到 journal，再由背景定期原子寫回主檔。
+- sqlite：USER_STORE_BACKEND=sqlite 時使用，WAL 模式、以 user_id 為主鍵，適合大量用戶。
+
+兩種後端都提供命中 / 未命中計數方便觀察快取效果。
+"""
+
+import asyncio
+import atexit
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+from metrics import STAGE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+CONFIG_FILE = Path(__file__).parent / "users_config.json"
+SQLITE_FILE = Path(__file__).parent / "users_config.db"
+
+# users_config.json 裡的說明用 key，不是用戶資料
+RESERVED_KEYS = frozenset({"comment", "example"})
+
+# 兩次檢查檔案 mtime / inode 之間的最短間隔（秒），避免每次查詢都 stat
+DEFAULT_CHECK_INTERVAL = 1.0
+
+# JSON 後端把 journal 中的變更寫回主檔的間隔（秒）
+DEFAULT_FLUSH_INTERVAL = 30.0
+
+
+def default_user_config() -> dict:
+    """尚未設定過的用戶所使用的預設配置。"""
+    return {
+        "girlfriend_type": None,
+        "user_name": None,
+    }
+
+
+class JsonUserStore:
+    """以記憶體 dict 快取整份 users_config.json，依檔案簽章判斷是否需要重新載入。
+
+    寫入採 write-behind：每次 save 只在 journal（users_config.json.journal）附加一行精簡 JSON，
+    由背景執行緒每隔 flush_interval 秒（或關閉時）把整份資料以「暫存檔 + rename」原子寫回，
+    之後清空 journal。載入時會先讀主檔再重播 journal，程式中途當掉也不會遺失已保存的配置。
+    """
+
+    def __init__(
+        self,
+        path: Path = CONFIG_FILE,
+        check_interval: float = DEFAULT_CHECK_INTERVAL,
+        flush_interval: float = DEFAULT_FLUSH_INTERVAL,
+    ):
+        self.path = Path(path)
+        self.journal_path = self.path.with_name(self.path.name + ".journal")
+        self.check_interval = check_interval
+        self.flush_interval = flush_interval
+        self._lock = threading.RLock()
+        self._data: dict | None = None
+        self._signature: tuple | None = None
+        self._last_check = 0.0
+        self._dirty: set[str] = set()
+        # 用戶數（載入時計算、新增時累加），stats() 不必每次掃過整份資料
+        self._users = 0
+        self._flusher: threading.Thread | None = None
+        self._stop = threading.Event()
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+        self.journal_writes = 0
+        self.flushes = 0
+
+    def _stat_signature(self) -> tuple | None:
+        """回傳 (device, inode, mtime_ns, size)；檔案不存在時回傳 None。"""
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (st.st_dev, st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def _read_file(self) -> dict:
+        data = {}
+        if self.path.exists():
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+        replayed = self._replay_journal(data)
+        if replayed:
+            logger.info("已從 journal 重播 %d 筆用戶配置", replayed)
+        return data
+
+    def _replay_journal(self, data: dict) -> int:
+        """把 journal 中尚未寫回主檔的變更套用到 data，回傳套用筆數。"""
+        if not self.journal_path.exists():
+            return 0
+        count = 0
+        with open(self.journal_path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # 最後一行可能因當機只寫了一半，忽略即可
+                    continue
+                data[entry["id"]] = entry["config"]
+                self._dirty.add(entry["id"])
+                count += 1
+        return count
+
+    def _ensure_fresh(self) -> bool:
+        """必要時重新載入檔案。回傳 True 表示這次查詢由記憶體直接回應。"""
+        now = time.monotonic()
+        if self._data is not None and now - self._last_check < self.check_interval:
+            return True
+        self._last_check = now
+        signature = self._stat_signature()
+        if self._data is not None and signature == self._signature:
+            return True
+        try:
+            self._data = self._read_file()
+        except Exception as e:
+            logger.warning(f"讀取用戶配置失敗: {e}")
+            if self._data is None:
+                self._data = {}
+        self._users = sum(1 for key in self._data if key not in RESERVED_KEYS)
+        self._signature = signature
+        self.reloads += 1
+        return False
+
+    def get(self, user_id: int) -> dict:
+        """讀取特定用戶配置，找不到時回傳預設配置。"""
+        with self._lock:
+            if self._ensure_fresh():
+                self.hits += 1
+            else:
+                self.misses += 1
+            config = self._data.get(str(user_id))
+        if not isinstance(config, dict):
+            return default_user_config()
+        return dict(config)
+
+    def save(self, user_id: int, config: dict) -> bool:
+        """更新記憶體中的配置並附加到 journal（O(1) I/O），主檔由背景定期寫回。"""
+        key = str(user_id)
+        line = json.dumps({"id": key, "config": config}, ensure_ascii=False, separators=(",", ":"))
+        with self._lock:
+            try:
+                self._ensure_fresh()
+                with open(self.journal_path, "a", encoding="utf-8") as f:
+                    f.write(line + "\n")
+                    f.flush()
+                    os.fsync(f.fileno())
+                if key not in self._data:
+                    self._users += 1
+                self._data[key] = dict(config)
+                self._dirty.add(key)
+                self.journal_writes += 1
+            except Exception as e:
+                logger.error(f"保存用戶配置失敗: {e}")
+                return False
+        self._start_flusher()
+        return True
+
+    def flush(self) -> bool:
+        """把尚未寫回的變更以「暫存檔 + rename」原子寫回主檔，成功後清空 journal。"""
+        with self._lock:
+            if not self._dirty or self._data is None:
+                return True
+            tmp_path = self.path.with_name(self.path.name + ".tmp")
+            try:
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(self._data, f, ensure_ascii=False, indent=2)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.path)
+                # 主檔已含全部變更，journal 可以清空
+                with open(self.journal_path, "w", encoding="utf-8"):
+                    pass
+                self._signature = self._stat_signature()
+                flushed = len(self._dirty)
+                self._dirty.clear()
+                self.flushes += 1
+            except Exception as e:
+                logger.error(f"寫回用戶配置失敗（變更仍保留在 journal）: {e}")
+                return False
+        logger.info("已寫回 %d 筆用戶配置到 %s", flushed, self.path.name)
+        return True
+
+    def _start_flusher(self) -> None:
+        if self._flusher is not None or self.flush_interval <= 0:
+            return
+        with self._lock:
+            if self._flusher is None:
+                self._flusher = threading.Thread(
+                    target=self._flush_loop, name="user-store-flusher", daemon=True
+                )
+                self._flusher.start()
+
+    def _flush_loop(self) -> None:
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def close(self) -> None:
+        """停止背景寫回並把剩餘變更寫回主檔。"""
+        self._stop.set()
+        self.flush()
+
+    def invalidate(self) -> None:
+        """丟棄記憶體內容，下次查詢時重新讀檔。"""
+        with self._lock:
+            self._data = None
+            self._signature = None
+            self._users = 0
+
+    def stats(self) -> dict:
+        """回傳快取命中統計。"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "reloads": self.reloads,
+                "hit_rate": (self.hits / total) if total else 0.0,
+                "users": self._users,
+                "dirty": len(self._dirty),
+                "journal_writes": self.journal_writes,
+                "flushes": self.flushes,
+            }
+
+
+# ---------- SQLite ----------
+# SQL 皆為常數字串，sqlite3 會依字串快取編譯好的 prepared statement
+_SQL_CREATE = (
+    "CREATE TABLE IF NOT EXISTS user_profiles ("
+    "user_id INTEGER PRIMARY KEY, "
+    "config TEXT NOT NULL, "
+    "updated_at REAL NOT NULL)"
+)
+_SQL_SELECT = "SELECT config FROM user_profiles WHERE user_id = ?"
+_SQL_EXISTS = "SELECT 1 FROM user_profiles WHERE user_id = ?"
+_SQL_UPSERT = (
+    "INSERT INTO user_profiles (user_id, config, updated_at) VALUES (?, ?, ?) "
+    "ON CONFLICT(user_id) DO UPDATE SET config = excluded.config, updated_at = excluded.updated_at"
+)
+_SQL_COUNT = "SELECT COUNT(*) FROM user_profiles"
+
+# SQLite 後端記憶體快取的最大筆數
+DEFAULT_SQLITE_CACHE_SIZE = 10000
+
+
+class SqliteUserStore:
+    """以 SQLite 儲存用戶配置（user_id 為主鍵，查詢 / 寫入皆為 O(log n)），前面加一層 LRU 快取。
+
+    其他程序寫入資料庫時 PRAGMA data_version 會改變，此時清空 LRU 快取。
+    stats() 的用戶數為開啟時的 COUNT 加上本程序新增的筆數（其他程序新增的要重新開啟後才會計入），
+    抓取指標時不必在鎖內掃整張表。
+    """
+
+    def __init__(
+        self,
+        path: Path = SQLITE_FILE,
+        check_interval: float = DEFAULT_CHECK_INTERVAL,
+        cache_size: int = DEFAULT_SQLITE_CACHE_SIZE,
+    ):
+        self.path = Path(path)
+        self.check_interval = check_interval
+        self.cache_size = cache_size
+        self._lock = threading.RLock()
+        self._cache: OrderedDict[int, dict | None] = OrderedDict()
+        self._data_version: int | None = None
+        self._last_check = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+        self._conn = sqlite3.connect(
+            str(self.path),
+            check_same_thread=False,
+            isolation_level=None,
+            cached_statements=64,
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(_SQL_CREATE)
+        self._users = self._conn.execute(_SQL_COUNT).fetchone()[0]
+
+    def _ensure_fresh(self) -> None:
+        now = time.monotonic()
+        if now - self._last_check < self.check_interval:
+            return
+        self._last_check = now
+        version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+        if self._data_version is not None and version != self._data_version:
+            self._cache.clear()
+            self.reloads += 1
+        self._data_version = version
+
+    def _remember(self, user_id: int, config: dict | None) -> None:
+        self._cache[user_id] = config
+        self._cache.move_to_end(user_id)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def get(self, user_id: int) -> dict:
+        """讀取特定用戶配置，找不到時回傳預設配置。"""
+        user_id = int(user_id)
+        with self._lock:
+            try:
+                self._ensure_fresh()
+                if user_id in self._cache:
+                    self.hits += 1
+                    self._cache.move_to_end(user_id)
+                    config = self._cache[user_id]
+                else:
+                    self.misses += 1
+                    row = self._conn.execute(_SQL_SELECT, (user_id,)).fetchone()
+                    config = json.loads(row[0]) if row else None
+                    self._remember(user_id, config)
+            except Exception as e:
+                logger.warning(f"讀取用戶配置失敗: {e}")
+                config = None
+        if not isinstance(config, dict):
+            return default_user_config()
+        return dict(config)
+
+    def save(self, user_id: int, config: dict) -> bool:
+        """寫入（或更新）單一用戶配置。"""
+        user_id = int(user_id)
+        with self._lock:
+            try:
+                cached = self._cache.get(user_id)
+                if cached is not None:
+                    existed = True
+                else:
+                    existed = self._conn.execute(_SQL_EXISTS, (user_id,)).fetchone() is not None
+                self._conn.execute(
+                    _SQL_UPSERT,
+                    (user_id, json.dumps(config, ensure_ascii=False), time.time()),
+                )
+                if not existed:
+                    self._users += 1
+                self._remember(user_id, dict(config))
+                return True
+            except Exception as e:
+                logger.error(f"保存用戶配置失敗: {e}")
+                return False
+
+    def import_profiles(self, profiles: dict) -> int:
+        """批次匯入 {user_id: config}，略過非數字 key（例如 comment / example）。回傳匯入筆數。"""
+        now = time.time()
+        rows = [
+            (int(key), json.dumps(config, ensure_ascii=False), now)
+            for key, config in profiles.items()
+            if key not in RESERVED_KEYS and str(key).lstrip("-").isdigit() and isinstance(config, dict)
+        ]
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(_SQL_UPSERT, rows)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._cache.clear()
+            self._users = self._conn.execute(_SQL_COUNT).fetchone()[0]
+        return len(rows)
+
+    def invalidate(self) -> None:
+        """清空 LRU 快取，下次查詢時重新讀資料庫。"""
+        with self._lock:
+            self._cache.clear()
+
+    def flush(self) -> bool:
+        """SQLite 每次寫入即提交，沒有需要額外寫回的資料。"""
+        return True
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    def stats(self) -> dict:
+        """回傳快取命中統計。"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "reloads": self.reloads,
+                "hit_rate": (self.hits / total) if total else 0.0,
+                "users": self._users,
+            }
+
+
+def migrate_json_to_sqlite(json_path: Path = CONFIG_FILE, db_path: Path = SQLITE_FILE) -> int:
+    """把 users_config.json 匯入 SQLite（略過 comment / example）。回傳匯入筆數。"""
+    with open(json_path, encoding="utf-8") as f:
+        profiles = json.load(f)
+    store = SqliteUserStore(db_path)
+    try:
+        return store.import_profiles(profiles)
+    finally:
+        store.close()
+
+
+# ---------- 全域存取層 ----------
+_store: "JsonUserStore | SqliteUserStore | None" = None
+_store_lock = threading.Lock()
+
+
+def _create_store() -> "JsonUserStore | SqliteUserStore":
+    backend = (os.getenv("USER_STORE_BACKEND") or "json").strip().lower()
+    interval = float(os.getenv("USER_CONFIG_CHECK_INTERVAL") or DEFAULT_CHECK_INTERVAL)
+    if backend == "sqlite":
+        path = (os.getenv("USER_STORE_SQLITE_PATH") or "").strip() or SQLITE_FILE
+        cache_size = int(os.getenv("USER_STORE_SQLITE_CACHE") or DEFAULT_SQLITE_CACHE_SIZE)
+        logger.info("用戶配置使用 SQLite 後端: %s", path)
+        return SqliteUserStore(Path(path), check_interval=interval, cache_size=cache_size)
+    if backend != "json":
+        logger.warning("未知的 USER_STORE_BACKEND=%s，改用 json", backend)
+    flush_interval = float(os.getenv("USER_CONFIG_FLUSH_INTERVAL") or DEFAULT_FLUSH_INTERVAL)
+    return JsonUserStore(CONFIG_FILE, check_interval=interval, flush_interval=flush_interval)
+
+
+def get_store() -> "JsonUserStore | SqliteUserStore":
+    """取得全域共用的用戶配置存取層（第一次呼叫時依 USER_STORE_BACKEND 建立）。"""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = _create_store()
+                atexit.register(_store.flush)
+    return _store
+
+
+def load_user_config(user_id: int) -> dict:
+    """讀取特定用戶配置（記憶體快取）。"""
+    with STAGE_SECONDS.time("profile_load"):
+        return get_store().get(user_id)
+
+
+def save_user_config(user_id: int, config: dict) -> bool:
+    """保存用戶配置。"""
+    return get_store().save(user_id, config)
+
+
+def flush_user_store() -> bool:
+    """把尚未寫回的用戶配置寫回儲存（關閉機器人前呼叫）。"""
+    if _store is None:
+        return True
+    return _store.flush()
+
+
+async def aload_user_config(user_id: int) -> dict:
+    """非同步版 load_user_config：在執行緒中查詢，不阻塞 event loop。"""
+    return await asyncio.to_thread(load_user_config, user_id)
+
+
+async def asave_user_config(user_id: int, config: dict) -> bool:
+    """非同步版 save_user_config：在執行緒中寫入，不阻塞 event loop。"""
+    return await asyncio.to_thread(save_user_config, user_id, config)
+
+
+def cache_stats() -> dict:
+    """回傳用戶配置快取的命中 / 未命中統計。"""
+    return get_store().stats()
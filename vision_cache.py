@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""看圖回覆的感知雜湊（dHash）快取：重複轉傳的梗圖不必每次都打 vision API。
+
+vision 呼叫同時回傳「圖片描述」與「回覆」（見 ai_reply_image）。描述以
+（女友類型, 照片說明文字, dHash）存在記憶體中；之後收到幾乎相同的圖（dHash 漢明距離 ≤ VISION_CACHE_MAX_DISTANCE，
+重新壓縮、縮放、加浮水印通常只差幾個 bit）時沿用描述，只用便宜的文字模型重新產生有人設語氣的回覆。
+
+- 描述是依該女友的系統提示與用戶的問題寫的，所以女友類型與說明文字都是 key 的一部分，不同組合不共用。
+- 最多保留 VISION_CACHE_SIZE 筆（LRU 淘汰），只存 64-bit 雜湊與描述文字，不存圖片。
+- VISION_CACHE=0 時停用。
+"""
+
+import os
+import threading
+from collections import Counter, OrderedDict
+from io import BytesIO
+from typing import NamedTuple
+
+DEFAULT_MAX_ENTRIES = 2000
+DEFAULT_MAX_DISTANCE = 6
+HASH_SIZE = 8
+
+
+def dhash(data: bytes, size: int = HASH_SIZE) -> int:
+    """
+    計算圖片的 difference hash（size × size bit）：縮成 (size+1) × size 的灰階圖，
+    比較每列相鄰像素的亮度。於 image_pipeline 的 worker 中執行。
+    """
+    from PIL import Image
+
+    img = Image.open(BytesIO(data))
+    # JPEG 可在解碼時直接縮小，只需要很小的圖
+    img.draft("L", (size * 8, size * 8))
+    pixels = img.convert("L").resize((size + 1, size), Image.LANCZOS).tobytes()
+    value = 0
+    for row in range(size):
+        offset = row * (size + 1)
+        for col in range(size):
+            value = (value << 1) | (pixels[offset + col] < pixels[offset + col + 1])
+    return value
+
+
+def hamming(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+def _normalize_caption(caption: str | None) -> str:
+    return " ".join((caption or "").split()).casefold()
+
+
+class VisionHit(NamedTuple):
+    description: str
+    distance: int
+
+
+class VisionCache:
+    """以 (女友類型, 說明文字) 分組、組內以 dHash 漢明距離找近似圖的 LRU 快取（執行緒安全）。"""
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES, max_distance: int = DEFAULT_MAX_DISTANCE):
+        self.max_entries = max(1, max_entries)
+        self.max_distance = max_distance
+        self._lock = threading.Lock()
+        # (女友類型, 說明文字, dHash) -> 描述，依最後使用時間排序
+        self._entries: OrderedDict[tuple[str, str, int], str] = OrderedDict()
+        # (女友類型, 說明文字) -> 該組的 dHash；近似比對只掃同一組
+        self._groups: dict[tuple[str, str], set[int]] = {}
+        self.counters: Counter = Counter()
+
+    def get(self, persona: str, caption: str | None, image_hash: int) -> VisionHit | None:
+        """找同一組中最接近且在距離門檻內的描述，沒有時回傳 None。"""
+        group = (persona, _normalize_caption(caption))
+        with self._lock:
+            hashes = self._groups.get(group)
+            best, best_distance = None, 0
+            if hashes:
+                if image_hash in hashes:
+                    best, best_distance = image_hash, 0
+                else:
+                    closest = min(hashes, key=lambda candidate: (candidate ^ image_hash).bit_count())
+                    distance = hamming(closest, image_hash)
+                    if distance <= self.max_distance:
+                        best, best_distance = closest, distance
+            if best is None:
+                self.counters["misses"] += 1
+                return None
+            key = (*group, best)
+            self._entries.move_to_end(key)
+            self.counters["hits_exact" if best_distance == 0 else "hits_near"] += 1
+            return VisionHit(self._entries[key], best_distance)
+
+    def put(self, persona: str, caption: str | None, image_hash: int, description: str) -> None:
+        group = (persona, _normalize_caption(caption))
+        key = (*group, image_hash)
+        with self._lock:
+            self._entries[key] = description
+            self._entries.move_to_end(key)
+            self._groups.setdefault(group, set()).add(image_hash)
+            while len(self._entries) > self.max_entries:
+                (old_persona, old_caption, old_hash), _ = self._entries.popitem(last=False)
+                old_group = (old_persona, old_caption)
+                hashes = self._groups[old_group]
+                hashes.discard(old_hash)
+                if not hashes:
+                    del self._groups[old_group]
+                self.counters["evictions"] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            hits = self.counters["hits_exact"] + self.counters["hits_near"]
+            total = hits + self.counters["misses"]
+            return {
+                **self.counters,
+                "hit_rate": (hits / total) if total else 0.0,
+                "size": len(self._entries),
+                "groups": len(self._groups),
+            }
+
+
+_cache: VisionCache | None = None
+_cache_loaded = False
+_cache_lock = threading.Lock()
+
+
+def get_vision_cache() -> VisionCache | None:
+    """取得全域看圖描述快取；VISION_CACHE=0 時回傳 None。"""
+    global _cache, _cache_loaded
+    with _cache_lock:
+        if not _cache_loaded:
+            _cache_loaded = True
+            if (os.getenv("VISION_CACHE") or "1").strip().lower() not in {"0", "false", "no", "off"}:
+                _cache = VisionCache(
+                    max_entries=int(os.getenv("VISION_CACHE_SIZE") or DEFAULT_MAX_ENTRIES),
+                    max_distance=int(os.getenv("VISION_CACHE_MAX_DISTANCE") or DEFAULT_MAX_DISTANCE),
+                )
+        return _cache